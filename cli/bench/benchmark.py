@@ -0,0 +1,345 @@
+"""
+使用MockServer测量CLI各项操作的吞吐量。在cli目录下执行:
+    python bench/benchmark.py --scenario apply --size 1000
+配置仍读取cli/conf.local.json，但每个场景都在临时的appdata目录中运行，不会触及真实的频道数据。
+"""
+import copy
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "../src"))
+
+import click
+import yaml
+from module.channel import ChannelManager
+from module.cli_data import CliData
+from module.local_config import LocalConfig
+from module.server import Server, ServerHttpClient, RequestStats
+from mock_server import MockServer
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+
+SCENARIOS = ("apply", "export", "import-add", "import-save", "latency-tcp", "latency-unix", "latency-compare", "session-pooled", "session-per-call",
+             "schema-compiled", "schema-plain", "encode-json", "encode-orjson", "encode-orjson-gzip")
+
+
+class Benchmark:
+    """
+    使用MockServer测量CLI各项操作的吞吐量。每个场景都在独立的临时appdata目录与新的MockServer中运行，不会触及真实的频道数据。
+    """
+    def __init__(self, local_config: LocalConfig, concurrency: int = 4, latency: float = 0.0, error_rate: float = 0.0, conflict_rate: float = 0.0):
+        """
+        :param concurrency: apply的submit并发数，以及import add的并发请求数
+        :param latency: 注入到MockServer的每请求延迟，单位为秒
+        """
+        self.__local_config = local_config
+        self.__concurrency = concurrency
+        self.__latency = latency
+        self.__error_rate = error_rate
+        self.__conflict_rate = conflict_rate
+
+    def run(self, scenario: str, size: int):
+        """
+        运行一个场景。
+        :return: {scenario, size, items, seconds, errors, requests, p50, p99, bytes, transports}，其中p50/p99为单个请求的耗时，单位为秒；
+                 bytes为编码后的body字节数，只有encode场景有此项；transports为{transport: {requests, p50, p99}}，只有latency-compare场景有此项
+        """
+        appdata_path = tempfile.mkdtemp(prefix="hedge-bench-")
+        try:
+            local_config = copy.copy(self.__local_config)
+            local_config.appdata_path = appdata_path
+            if scenario.startswith("latency-"):
+                local_config.http_unix_socket = scenario != "latency-tcp"
+            elif scenario.startswith("session-"):
+                # 两种方式都经由TCP端口，使差异只来自连接是否复用
+                local_config.http_unix_socket = False
+            channel_manager = ChannelManager(appdata_path, CliData(appdata_path))
+            channel_path = channel_manager.path()
+            os.makedirs(channel_path)
+            with open(os.path.join(channel_path, "public.dat"), "w") as f:
+                json.dump({"dbPath": "@/default"}, f)
+            server = Server(local_config, channel_manager)
+            with MockServer(channel_path, latency=self.__latency, error_rate=self.__error_rate, conflict_rate=self.__conflict_rate, seed=size,
+                            unix_socket=local_config.http_unix_socket) as mock:
+                server.check_then_start()
+                server.http_client.stats = RequestStats(keep_samples=True)
+                encoded_bytes = None
+                transports = None
+                if scenario == "apply":
+                    items, seconds, errors = self.__run_apply(server, size)
+                elif scenario == "export":
+                    items, seconds, errors = self.__run_export(server, size)
+                elif scenario == "import-add":
+                    items, seconds, errors = self.__run_import_add(server, channel_path, appdata_path, size)
+                elif scenario == "import-save":
+                    items, seconds, errors = self.__run_import_save(server, mock, size)
+                elif scenario == "latency-compare":
+                    items, seconds, errors, transports = self.__run_latency_compare(server, mock, size)
+                elif scenario.startswith("latency-") or scenario == "session-pooled":
+                    items, seconds, errors = self.__run_latency(server, size)
+                elif scenario == "session-per-call":
+                    items, seconds, errors = self.__run_per_call(server, mock, size)
+                elif scenario.startswith("schema-"):
+                    items, seconds, errors = self.__run_schema(size, scenario == "schema-compiled")
+                elif scenario.startswith("encode-"):
+                    items, seconds, errors, encoded_bytes = self.__run_encode(scenario, size)
+                else:
+                    raise Exception("Scenario '%s' is invalid." % (scenario,))
+            stats = server.http_client.stats
+            server.http_client.close()
+            return {"scenario": scenario, "size": size, "items": items, "seconds": seconds, "errors": errors,
+                    "requests": stats.count, "p50": stats.percentile(50), "p99": stats.percentile(99), "bytes": encoded_bytes, "transports": transports}
+        finally:
+            shutil.rmtree(appdata_path, ignore_errors=True)
+
+    def __run_apply(self, server: Server, size: int):
+        from module.apply import Applier
+        docs, items = generate_apply_documents(size)
+        text = yaml.dump_all(docs, Dumper=SafeDumper, allow_unicode=True)
+        applier = Applier(server, concurrency=self.__concurrency)
+        start = time.perf_counter()
+        applier.apply(text)
+        applier.submit()
+        return items, time.perf_counter() - start, len(applier.submit_errors)
+
+    def __run_export(self, server: Server, size: int):
+        from module.apply import Applier
+        from module.export import Exporter, DocumentWriter, EXPORT_KINDS
+        docs, items = generate_apply_documents(size)
+        applier = Applier(server, concurrency=self.__concurrency)
+        applier.apply(yaml.dump_all(docs, Dumper=SafeDumper, allow_unicode=True))
+        applier.submit()
+        # 只测量导出，准备数据的请求不计入统计
+        server.http_client.stats = RequestStats(keep_samples=True)
+        with open(os.devnull, "w") as out:
+            exporter = Exporter(server, DocumentWriter(out), concurrency=self.__concurrency)
+            start = time.perf_counter()
+            exporter.export(EXPORT_KINDS)
+            seconds = time.perf_counter() - start
+        return sum(exporter.exported.values()), seconds, len(applier.submit_errors)
+
+    def __run_import_add(self, server: Server, channel_path: str, appdata_path: str, size: int):
+        from module.importation import Importation
+        from module.import_index import ImportIndex
+        files_path = os.path.join(appdata_path, "files")
+        os.makedirs(files_path)
+        filepaths = []
+        for i in range(size):
+            filepath = os.path.join(files_path, "%s.jpg" % (i,))
+            with open(filepath, "wb") as f:
+                f.write(os.urandom(4096))
+            filepaths.append(filepath)
+        index = ImportIndex(channel_path)
+        importation = Importation(server, index)
+        start = time.perf_counter()
+        importation.sync_index(channel_path, self.__concurrency)
+        errors = sum(1 for (_, e, _) in importation.add_all(filepaths, False, self.__concurrency) if e is not None)
+        index.save()
+        return size, time.perf_counter() - start, errors
+
+    @staticmethod
+    def __run_import_save(server: Server, mock: MockServer, size: int):
+        from module.importation import Importation
+        mock.add_imports(size)
+        importation = Importation(server)
+        start = time.perf_counter()
+        try:
+            importation.save()
+            errors = 0
+        except Exception:
+            errors = 1
+        return size, time.perf_counter() - start, errors
+
+    @staticmethod
+    def __run_latency(server: Server, size: int):
+        """
+        逐个发出size个小请求，测量单个请求的往返耗时。这类请求在apply中占多数，其耗时主要由传输方式决定。
+        """
+        start = time.perf_counter()
+        errors = 0
+        for _ in range(size):
+            ok, _ = server.http_client.req("GET", "/api/setting/import")
+            if not ok:
+                errors += 1
+        return size, time.perf_counter() - start, errors
+
+    @staticmethod
+    def __run_latency_compare(server: Server, mock: MockServer, size: int):
+        """
+        对同一个MockServer交替经由unix socket与TCP端口各发出size个小请求，分别统计耗时。
+        两种传输方式交替进行，使机器负载的波动对两者的影响相同。
+        """
+        if server.http_client.transport != "unix":
+            raise Exception("Scenario 'latency-compare' requires unix domain socket, which is not available.")
+        tcp_client = ServerHttpClient(unix_socket=False)
+        tcp_client.set_access(mock.port, "mock")
+        tcp_client.stats = RequestStats(keep_samples=True)
+        clients = (server.http_client, tcp_client)
+        start = time.perf_counter()
+        errors = 0
+        try:
+            for i in range(size * 2):
+                ok, _ = clients[i % 2].req("GET", "/api/setting/import")
+                if not ok:
+                    errors += 1
+        finally:
+            tcp_client.close()
+        seconds = time.perf_counter() - start
+        if server.http_client.transport != "unix":
+            # 中途回退到了TCP，比较失去意义
+            raise Exception("Requests fell back from unix domain socket to TCP.")
+        transports = {name: {"requests": c.stats.count, "p50": c.stats.percentile(50), "p99": c.stats.percentile(99)}
+                      for (name, c) in (("unix", server.http_client), ("tcp", tcp_client))}
+        return size * 2, seconds, errors, transports
+
+    @staticmethod
+    def __run_per_call(server: Server, mock: MockServer, size: int):
+        """
+        与latency相同的请求，但每次都调用模块级的requests.request，即ServerHttpClient改用连接池之前的做法。
+        每个请求都新建session与TCP连接，用于与session-pooled对比。
+        """
+        import requests
+        url = "http://localhost:%s/api/setting/import" % (mock.port,)
+        headers = {"Authorization": "Bearer mock"}
+        start = time.perf_counter()
+        errors = 0
+        for _ in range(size):
+            request_start = time.perf_counter()
+            res = requests.request("GET", url, headers=headers)
+            server.http_client.stats.record("GET", "/api/setting/import", time.perf_counter() - request_start)
+            if not res.ok:
+                errors += 1
+        return size, time.perf_counter() - start, errors
+
+    @staticmethod
+    def __run_schema(size: int, compiled: bool):
+        """
+        校验生成的apply文档，比较编译后的CompiledSchema与schema库原始的Schema.validate。只测量校验，不访问server。
+        topic与tag的children仍经由编译后的schema递归校验，它们在生成的文档中占比很小。
+        """
+        from schema import Schema
+        from module.apply import DOCUMENT_SCHEMAS
+        docs, items = generate_apply_documents(size)
+        schemas = {kind: get_schema() if compiled else Schema(get_schema().schema) for (kind, get_schema) in DOCUMENT_SCHEMAS.items()}
+        start = time.perf_counter()
+        errors = 0
+        for doc in docs:
+            try:
+                schemas[doc["kind"]].validate(doc["spec"])
+            except Exception:
+                errors += 1
+        return items, time.perf_counter() - start, errors
+
+    @staticmethod
+    def __run_encode(scenario: str, size: int):
+        """
+        将size个source按bulk提交的批次大小编码为request body，测量序列化耗时与编码后的字节数。
+        encode-json是改用orjson之前requests对json参数的编码方式；encode-orjson-gzip与ServerHttpClient对大body的处理相同。
+        """
+        import gzip
+        from module.apply import SOURCE_BATCH_SIZE
+        from module.server import get_orjson
+        orjson = get_orjson()
+        if scenario != "encode-json" and orjson is None:
+            raise Exception("Scenario '%s' requires orjson, which is not installed." % (scenario,))
+        sources = generate_source_items(size)
+        batches = [{"items": sources[i:i + SOURCE_BATCH_SIZE]} for i in range(0, size, SOURCE_BATCH_SIZE)]
+        encoded_bytes = 0
+        start = time.perf_counter()
+        for body in batches:
+            if scenario == "encode-json":
+                data = json.dumps(body).encode("utf-8")
+            else:
+                data = orjson.dumps(body)
+                if scenario == "encode-orjson-gzip":
+                    data = gzip.compress(data, compresslevel=1)
+            encoded_bytes += len(data)
+        return size, time.perf_counter() - start, 0, encoded_bytes
+
+
+def available_scenarios():
+    """
+    :return: 当前环境中可以运行的场景。未安装orjson时不包括依赖它的encode场景；不支持unix domain socket的平台上不包括经由它的latency场景
+    """
+    import socket
+    from module.server import get_orjson
+    return tuple(s for s in SCENARIOS if (get_orjson() is not None or not s.startswith("encode-orjson"))
+                 and (hasattr(socket, "AF_UNIX") or s not in ("latency-unix", "latency-compare")))
+
+
+def generate_source_items(size: int):
+    """
+    生成size个内容完整的source，带有标题、描述、标签、pool与关联，接近实际导入的数据，用于测量大body的编码。
+    """
+    return [{"source": "bench", "sourceId": i, "title": "bench source %s 标题" % (i,),
+             "description": "description of bench source %s, 来自生成的测试数据。" % (i,) * 3,
+             "tags": [{"name": "tag-%s" % ((i + j) % 500,), "displayName": "标签 %s" % ((i + j) % 500,), "type": "TAG"} for j in range(8)],
+             "pools": [{"key": "pool-%s" % (i // 20,), "title": "bench pool %s" % (i // 20,)}],
+             "relations": [i - j for j in range(1, 6) if i - j >= 0]}
+            for i in range(size)]
+
+
+def generate_apply_documents(size: int):
+    """
+    生成规模与size相当的apply文档：size个source，以及按比例生成的annotation、author、topic与tag。
+    :return: (文档列表, 数据项总数)
+    """
+    annotation_count = max(1, size // 100)
+    author_count = max(1, size // 20)
+    topic_count = max(1, size // 80)
+    tag_count = max(1, size // 100)
+    annotations = [{"name": "bench-annotation-%s" % (i,), "canBeExported": True} for i in range(annotation_count)]
+    sources = [{"source": "bench", "sourceId": i, "title": "bench source %s" % (i,),
+                "tags": [{"name": "tag-%s" % (i % 50,), "type": "TAG"}, {"name": "artist-%s" % (i % 20,), "type": "ARTIST"}]}
+               for i in range(size)]
+    authors = [{"name": "bench-author-%s" % (i,), "type": "ARTIST", "annotations": ["bench-annotation-%s" % (i % annotation_count,)]}
+               for i in range(author_count)]
+    # 每个topic下有3个child，每个tag下有10个child，使树形的提交路径也被测量
+    topics = [{"name": "bench-topic-%s" % (i,), "type": "COPYRIGHT",
+               "children": [{"name": "bench-topic-%s-%s" % (i, j), "type": "CHARACTER"} for j in range(3)]}
+              for i in range(topic_count)]
+    tags = [{"name": "bench-tag-%s" % (i,), "type": "TAG",
+             "children": [{"name": "bench-tag-%s-%s" % (i, j), "type": "TAG"} for j in range(10)]}
+            for i in range(tag_count)]
+    docs = [
+        {"kind": "setting", "spec": {"source": {"sites": [{"name": "bench"}]}}},
+        {"kind": "annotation", "spec": annotations},
+        {"kind": "source", "spec": sources},
+        {"kind": "author", "spec": authors},
+        {"kind": "topic", "spec": topics},
+        {"kind": "tag", "spec": tags},
+    ]
+    items = 1 + annotation_count + size + author_count + topic_count * 4 + tag_count * 11
+    return docs, items
+
+
+@click.command(help="使用模拟server测量CLI的吞吐量")
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(SCENARIOS), help="要运行的场景，可指定多次。默认运行全部场景")
+@click.option("--size", "sizes", multiple=True, type=click.IntRange(min=1), default=[100, 1000, 10000], show_default=True, help="数据规模，可指定多次")
+@click.option("--concurrency", "-c", type=click.IntRange(min=1), default=4, show_default=True, help="并发请求的数量")
+@click.option("--latency", type=click.FloatRange(min=0), default=0, show_default=True, help="模拟server的每请求延迟(毫秒)")
+@click.option("--error-rate", type=click.FloatRange(min=0, max=1), default=0, show_default=True, help="模拟server返回错误的概率")
+@click.option("--conflict-rate", type=click.FloatRange(min=0, max=1), default=0, show_default=True, help="模拟server对新建项返回ALREADY_EXISTS的概率")
+def main(scenarios, sizes, concurrency, latency, error_rate, conflict_rate):
+    benchmark = Benchmark(LocalConfig(), concurrency=concurrency, latency=latency / 1000, error_rate=error_rate, conflict_rate=conflict_rate)
+    print("%-18s %8s %8s %9s %10s %9s %9s %8s %6s %9s" % ("scenario", "size", "items", "seconds", "items/s", "p50(ms)", "p99(ms)", "requests", "errors", "sent(KB)"))
+    for scenario in scenarios or available_scenarios():
+        for size in sizes:
+            r = benchmark.run(scenario, size)
+            sent = "%.1f" % (r["bytes"] / 1024,) if r["bytes"] is not None else "-"
+            print("%-18s %8s %8s %9.3f %10.1f %9.2f %9.2f %8s %6s %9s" % (r["scenario"], r["size"], r["items"], r["seconds"], r["items"] / r["seconds"],
+                                                                         (r["p50"] or 0) * 1000, (r["p99"] or 0) * 1000, r["requests"], r["errors"], sent))
+            for (transport, t) in (r["transports"] or {}).items():
+                print("  %-16s %8s %8s %9s %10s %9.2f %9.2f %8s" % (transport, "", "", "", "", t["p50"] * 1000, t["p99"] * 1000, t["requests"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+from module.channel import get_folders_path
+
+
+class MockServer:
+    """
+    进程内的server替身，实现CLI所使用的endpoint，用于测试，以及在没有真实server时测量CLI自身的性能。
+    它在本进程的线程中提供HTTP服务，并在频道目录写入指向自己的server.pid，因此Server.check_then_start()会直接连接它而不会启动真实server。
+    数据只保存在内存中，不做数据库写入；只有开启store_files时才会像真实server一样复制导入的文件。
+    """
+    def __init__(self, channel_path: str, latency: float = 0.0, error_rate: float = 0.0, conflict_rate: float = 0.0, seed: int = None,
+                 unix_socket: bool = False, reject_unix: bool = False, store_files: bool = False):
+        """
+        :param latency: 每个请求附加的处理延迟，单位为秒
+        :param error_rate: /api请求以500 INTERNAL_ERROR失败的概率
+        :param conflict_rate: 新建元数据项时假装其已存在的概率。此时项仍被创建，但返回409 ALREADY_EXISTS，以模拟向已有数据的频道apply
+        :param unix_socket: 额外在频道目录的server.sock上提供服务，并在server.pid中声明它
+        :param reject_unix: 以403 REMOTE_DISABLED拒绝经由unix socket的全部请求，模拟只信任loopback地址的server
+        :param store_files: 将导入的文件复制到频道的存储目录中，删除导入项时删除文件。存储目录由频道的public.dat决定
+        """
+        self.__channel_path = channel_path
+        self.__store_files = store_files
+        self.__pid_path = os.path.join(channel_path, "server.pid")
+        self.__socket_path = os.path.join(channel_path, "server.sock") if unix_socket else None
+        self.__reject_unix = reject_unix
+        self.__latency = latency
+        self.__error_rate = error_rate
+        self.__conflict_rate = conflict_rate
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__httpd = None
+        self.__unix_httpd = None
+        self.__origin_pid_file = None
+        self.__next_id = 1
+        self.__entities = {}
+        self.__entity_index = {}
+        self.__settings = {}
+        self.__sites = {}
+        self.__sources = {}
+        self.__imports = []
+        self.request_count = 0
+        self.connection_count = 0
+        self.gzip_request_count = 0
+        self.rejected_count = 0
+
+    @property
+    def port(self):
+        return self.__httpd.server_address[1]
+
+    def start(self):
+        """
+        启动HTTP服务并写入server.pid。频道目录中原有的server.pid会在stop()时恢复。
+        """
+        handler_class = self.__handler_class()
+        self.__httpd = ThreadingHTTPServer(("localhost", 0), handler_class)
+        self.__httpd.daemon_threads = True
+        threading.Thread(target=self.__httpd.serve_forever, name="hedge-mock-server", daemon=True).start()
+        os.makedirs(os.path.dirname(self.__pid_path), exist_ok=True)
+        if self.__socket_path is not None:
+            if os.path.exists(self.__socket_path):
+                os.remove(self.__socket_path)
+            # unix socket上不能设置TCP_NODELAY
+            self.__unix_httpd = ThreadingUnixStreamServer(self.__socket_path, type("UnixHandler", (handler_class,), {"disable_nagle_algorithm": False, "via_unix": True}))
+            self.__unix_httpd.daemon_threads = True
+            threading.Thread(target=self.__unix_httpd.serve_forever, name="hedge-mock-server-unix", daemon=True).start()
+        try:
+            with open(self.__pid_path) as f:
+                self.__origin_pid_file = f.read()
+        except FileNotFoundError:
+            self.__origin_pid_file = None
+        with open(self.__pid_path, "w") as f:
+            json.dump({"pid": os.getpid(), "port": self.port, "token": "mock", "socket": self.__socket_path, "startTime": int(time.time() * 1000)}, f)
+        return self
+
+    def stop(self):
+        if self.__httpd is None:
+            return
+        self.__httpd.shutdown()
+        self.__httpd.server_close()
+        self.__httpd = None
+        if self.__unix_httpd is not None:
+            self.__unix_httpd.shutdown()
+            self.__unix_httpd.server_close()
+            self.__unix_httpd = None
+            os.remove(self.__socket_path)
+        if self.__origin_pid_file is not None:
+            with open(self.__pid_path, "w") as f:
+                f.write(self.__origin_pid_file)
+        else:
+            try:
+                os.remove(self.__pid_path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def add_imports(self, count: int):
+        """
+        直接向导入列表中添加若干项，用于准备import list/save的测试数据。
+        """
+        with self.__lock:
+            for _ in range(count):
+                self.__new_import("mock.jpg")
+
+    def __handler_class(self):
+        mock = self
+        reject_unix = self.__reject_unix
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # 头部与body分两次发送，开启Nagle算法时会与客户端的延迟ACK互相等待，使每个请求多出几十毫秒
+            disable_nagle_algorithm = True
+            via_unix = False
+
+            def setup(self):
+                super().setup()
+                mock.count_connection()
+
+            def handle_request(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length > 0 else b""
+                if self.headers.get("Content-Encoding", None) == "gzip":
+                    raw = gzip.decompress(raw)
+                    mock.count_gzip_request()
+                url = urllib.parse.urlparse(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                body = json.loads(raw) if len(raw) > 0 else None
+                if reject_unix and self.via_unix:
+                    status, content = mock.reject_remote()
+                else:
+                    status, content = mock.dispatch(self.command, url.path, query, body)
+                data = json.dumps(content).encode() if content is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def count_connection(self):
+        with self.__lock:
+            self.connection_count += 1
+
+    def count_gzip_request(self):
+        with self.__lock:
+            self.gzip_request_count += 1
+
+    def reject_remote(self):
+        with self.__lock:
+            self.rejected_count += 1
+        return error_response(403, "REMOTE_DISABLED", "This Token can only be used in localhost.")
+
+    def dispatch(self, method: str, path: str, query: dict, body):
+        """
+        处理一个请求。
+        :return: (status code, json content)
+        """
+        if self.__latency > 0:
+            time.sleep(self.__latency)
+        with self.__lock:
+            self.request_count += 1
+            if path.startswith("/api/") and self.__error_rate > 0 and self.__random.random() < self.__error_rate:
+                return error_response(500, "INTERNAL_ERROR", "Injected error.")
+            if path == "/app/health":
+                return 200, {"status": "LOADED", "requestEncodings": ["gzip"]}
+            if path.startswith("/app/lifetime/"):
+                return 200, None
+            if path.startswith("/api/setting/"):
+                return self.__dispatch_setting(method, path, body)
+            if path.startswith("/api/imports"):
+                return self.__dispatch_import(method, path, query, body)
+            if path.startswith("/api/source-images"):
+                return self.__dispatch_source(method, path, query, body)
+            match = re.match(r"^/api/(tags|topics|authors|annotations)(?:/(\d+))?$", path)
+            if match is not None:
+                return self.__dispatch_entity(method, match.group(1), match.group(2), query, body)
+            return error_response(404, "NOT_FOUND", "Resource not found.")
+
+    def __dispatch_setting(self, method: str, path: str, body):
+        if path == "/api/setting/source/sites":
+            if method == "GET":
+                return 200, list(self.__sites.values())
+            if body["name"] in self.__sites:
+                return error_response(409, "ALREADY_EXISTS", "Site already exists.")
+            self.__sites[body["name"]] = dict(body)
+            return 201, None
+        if path.startswith("/api/setting/source/sites/"):
+            site = self.__sites.get(path[len("/api/setting/source/sites/"):], None)
+            if site is None:
+                return error_response(404, "NOT_FOUND", "Resource not found.")
+            if method == "PUT":
+                site.update(body)
+                return 200, None
+            return 200, site
+        setting = self.__settings.setdefault(path[len("/api/setting/"):], {})
+        if method == "PATCH":
+            setting.update(body)
+            return 200, None
+        return 200, setting
+
+    def __dispatch_import(self, method: str, path: str, query: dict, body):
+        if path == "/api/imports" and method == "GET":
+            result = sorted(self.__imports, key=lambda i: i["id"], reverse=query.get("order") == "-id")
+            offset = int(query.get("offset", 0))
+            limit = int(query.get("limit", 500))
+            return 200, {"total": len(result), "result": result[offset:offset + limit]}
+        if path == "/api/imports/import" and method == "POST":
+            if not os.path.isfile(body["filepath"]):
+                return error_response(404, "FILE_NOT_FOUND", "File not found.")
+            return 201, {"id": self.__new_import(body["filepath"]), "warnings": []}
+        if path == "/api/imports/batch-update" and method == "POST":
+            return 200, None
+        if path == "/api/imports/save" and method == "POST":
+            # 确认保存的项从导入列表中移除，但它们的文件仍留在存储中
+            total = len(self.__imports)
+            self.__imports = []
+            return 200, {"total": total}
+        match = re.match(r"^/api/imports/(\d+)$", path)
+        if match is not None:
+            item = next((i for i in self.__imports if i["id"] == int(match.group(1))), None)
+            if item is None:
+                return error_response(404, "NOT_FOUND", "Resource not found.")
+            if method == "GET":
+                return 200, item
+            if method == "DELETE":
+                self.__imports.remove(item)
+                if self.__store_files:
+                    try:
+                        os.remove(os.path.join(get_folders_path(self.__channel_path), item["file"]))
+                    except FileNotFoundError:
+                        pass
+                return 204, None
+        return error_response(404, "NOT_FOUND", "Resource not found.")
+
+    def __new_import(self, filepath: str):
+        import_id = self.__next_id
+        self.__next_id += 1
+        extension = os.path.splitext(filepath)[1].lstrip(".")
+        if self.__store_files and os.path.isfile(filepath):
+            stored_path = os.path.join(get_folders_path(self.__channel_path), "mock/%s.%s" % (import_id, extension))
+            os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+            shutil.copyfile(filepath, stored_path)
+        self.__imports.append({"id": import_id, "file": "mock/%s.%s" % (import_id, extension), "fileName": os.path.basename(filepath),
+                               "source": None, "sourceId": None, "sourcePart": None, "tagme": ["TAG", "AUTHOR", "TOPIC", "SOURCE"],
+                               "partitionTime": "2021-01-01", "orderTime": "2021-01-01T00:00:00Z"})
+        return import_id
+
+    def __dispatch_source(self, method: str, path: str, query: dict, body):
+        if path == "/api/source-images/bulk" and method == "POST":
+            for item in body["items"]:
+                self.__sources.setdefault((item["source"], item["sourceId"]), {}).update(item)
+            return 200, None
+        if path == "/api/source-images" and method == "GET":
+            offset = int(query.get("offset", 0))
+            limit = int(query.get("limit", 100))
+            result = [{"source": s["source"], "sourceId": s["sourceId"], "empty": not any(s.get(k, None) for k in ("title", "description", "tags", "pools", "relations"))}
+                      for s in list(self.__sources.values())[offset:offset + limit]]
+            return 200, {"total": len(self.__sources), "result": result}
+        match = re.match(r"^/api/source-images/([^/]+)/(\d+)$", path)
+        if match is not None and method == "GET":
+            item = self.__sources.get((match.group(1), int(match.group(2))), None)
+            if item is None:
+                return error_response(404, "NOT_FOUND", "Resource not found.")
+            return 200, dict({"title": None, "description": None, "tags": [], "pools": [], "relations": []}, **item)
+        return error_response(404, "NOT_FOUND", "Resource not found.")
+
+    def __dispatch_entity(self, method: str, kind: str, entity_id: str or None, query: dict, body):
+        entities = self.__entities.setdefault(kind, {})
+        index = self.__entity_index.setdefault(kind, {})
+        if entity_id is None and method == "POST":
+            key = (body["name"], body.get("parentId", None))
+            if key in index:
+                return error_response(409, "ALREADY_EXISTS", "Entity already exists.")
+            entity_id = self.__next_id
+            self.__next_id += 1
+            entities[entity_id] = dict(body, id=entity_id)
+            if kind == "tags" and "ordinal" not in body:
+                entities[entity_id]["ordinal"] = sum(1 for (_, p) in index.keys() if p == key[1])
+            index[key] = entity_id
+            if self.__conflict_rate > 0 and self.__random.random() < self.__conflict_rate:
+                return error_response(409, "ALREADY_EXISTS", "Entity already exists.")
+            return 201, {"id": entity_id}
+        if entity_id is None and method == "GET":
+            name = query.get("name") or query.get("search") or query.get("query", "").strip("`")
+            parent = query.get("parentId", query.get("parent", None))
+            result = [e for e in entities.values() if (not name or e["name"] == name) and (parent is None or str(e.get("parentId", None)) == parent)]
+            offset = int(query.get("offset", 0))
+            limit = int(query.get("limit", 100))
+            return 200, {"total": len(result), "result": [self.__entity_response(kind, e) for e in result[offset:offset + limit]]}
+        if entity_id is not None:
+            entity = entities.get(int(entity_id), None)
+            if entity is None:
+                return error_response(404, "NOT_FOUND", "Resource not found.")
+            if method == "PATCH":
+                entity.update(body)
+                return 200, None
+            if method == "GET":
+                return 200, self.__entity_response(kind, entity)
+        return error_response(404, "NOT_FOUND", "Resource not found.")
+
+    def __entity_response(self, kind: str, entity: dict):
+        """
+        server对引用其他项的字段返回的是被引用项的摘要，而不是提交时的id或名称。
+        """
+        response = dict(entity)
+        if "annotations" in entity:
+            annotations = self.__entities.get("annotations", {})
+            names = self.__entity_index.get("annotations", {})
+            response["annotations"] = [{"id": a, "name": annotations[a]["name"]} if a in annotations else {"id": names.get((a, None), 0), "name": a}
+                                       for a in entity["annotations"]]
+        if kind == "tags":
+            tags = self.__entities.get("tags", {})
+            response["links"] = [{"id": i, "name": tags[i]["name"] if i in tags else ""} for i in entity.get("links", None) or () if isinstance(i, int)]
+            response["examples"] = [{"id": i} for i in entity.get("examples", None) or ()]
+        return response
+
+
+def error_response(status: int, code: str, message: str):
+    return status, {"code": code, "message": message}
@@ -1,19 +1,61 @@
-import subprocess
 import sys
+from module.agent_client import forward
+
+if __name__ == "__main__":
+    # agent正在运行时将命令交给它执行，本进程不再加载click等依赖
+    forward(sys.argv[1:])
+
+import contextlib
+import subprocess
 import time
 import click
 import os
 from module.cli_data import CliData
-from module.importation import Importation
 from module.local_config import LocalConfig
 from module.channel import ChannelManager
-from module.server import Server
-from module.apply import Applier
+from module.server import Server, RequestStats
 
 
 @click.group("hedge", help="Hedge App 命令行管理工具 (CLI)")
-def app():
-    pass
+@click.option("--trace", "trace_path", type=click.Path(dir_okay=False, writable=True), help="将HTTP请求与各阶段的耗时以Chrome trace格式写入此文件，并在结束时输出各endpoint的耗时统计")
+@click.option("--profile", is_flag=True, help="使用cProfile运行命令，并在结束时输出按累计耗时排序的统计。只统计主线程")
+@click.pass_context
+def app(ctx, trace_path, profile):
+    if trace_path is not None:
+        from utils.trace import tracer
+        tracer.enable()
+
+        def save_trace():
+            tracer.save(trace_path)
+            print_request_summary()
+        ctx.call_on_close(save_trace)
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+
+        def print_profile():
+            import pstats
+            profiler.disable()
+            click.echo(err=True)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(40)
+        ctx.call_on_close(print_profile)
+        profiler.enable()
+
+
+# 除全局的server以外，执行命令的各个频道的Server的请求统计。多频道执行时由子进程传回
+channel_stats = []
+
+
+def print_request_summary():
+    stats = RequestStats()
+    for i in [server.http_client.stats] + channel_stats:
+        stats.merge(i.export())
+    summary = stats.summary()
+    if len(summary) == 0:
+        return
+    click.echo("\n%-48s %8s %10s %10s %10s" % ("endpoint", "count", "total(s)", "avg(ms)", "max(ms)"), err=True)
+    for (endpoint, count, total, avg, max_time) in summary:
+        click.echo("%-48s %8s %10.3f %10.2f %10.2f" % (endpoint, count, total, avg * 1000, max_time * 1000), err=True)
 
 
 @app.command("app", help="启动Hedge App")
@@ -30,56 +72,293 @@ def start_app():
     subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 
+def channel_options(func):
+    """
+    为命令添加--channel与--all-channels选项，使其可以在当前频道以外的频道上执行。
+    """
+    func = click.option("--all-channels", is_flag=True, help="在所有频道上并行执行")(func)
+    func = click.option("--channel", "channel_names", multiple=True, help="在指定的频道上执行，不改变当前所用的频道。可指定多次")(func)
+    return func
+
+
+def get_target_channels(channel_names, all_channels):
+    """
+    :return: 要执行的频道名称列表。未指定任何频道选项时返回None，表示在当前所用的频道上执行
+    """
+    if all_channels:
+        channels = sorted(channel_manager.list())
+        if len(channels) == 0:
+            raise click.UsageError("频道列表为空。")
+        return channels
+    if len(channel_names) > 0:
+        existing = set(channel_manager.list())
+        for channel_name in channel_names:
+            if channel_name not in existing:
+                raise click.BadParameter("频道'%s'不存在。" % (channel_name,), param_hint="--channel")
+        return list(dict.fromkeys(channel_names))
+    return None
+
+
+def run_on_channels(channels, func):
+    """
+    在目标频道上执行func(server, channel_path, out)。
+    channels为None时使用全局的server在当前频道上执行；只有一个频道时直接执行；有多个频道时，每个频道在独立的子进程中使用独立的Server实例并行执行。
+    解析与序列化是CPU密集的，使用子进程而不是线程，使总耗时接近最慢的频道。各频道的输出先写入缓冲，再按频道顺序输出，失败的频道不影响其他频道。
+    """
+    if channels is None:
+        func(server, channel_manager.path(), sys.stdout)
+        return
+    if len(channels) == 1:
+        channel_server = Server(local_config, channel_manager, channels[0])
+        channel_stats.append(channel_server.http_client.stats)
+        func(channel_server, channel_manager.path(channels[0]), sys.stdout)
+        return
+
+    import io
+    import multiprocessing
+    # 使用fork，使子进程直接继承命令的参数与func闭包，不需要序列化它们
+    context = multiprocessing.get_context("fork")
+
+    def run(channel_name, conn):
+        channel_server = Server(local_config, channel_manager, channel_name)
+        out = io.StringIO()
+        error = None
+        try:
+            func(channel_server, channel_manager.path(channel_name), out)
+        except Exception as e:
+            error = str(e)
+        finally:
+            channel_server.http_client.close()
+        conn.send((out.getvalue(), error, channel_server.http_client.stats.export()))
+        conn.close()
+
+    processes = []
+    for channel_name in channels:
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=run, args=(channel_name, sender), name="hedge-channel-%s" % (channel_name,))
+        process.start()
+        sender.close()
+        processes.append((channel_name, process, receiver))
+
+    failed = 0
+    for (channel_name, process, receiver) in processes:
+        try:
+            output, error, endpoints = receiver.recv()
+            stats = RequestStats()
+            stats.merge(endpoints)
+            channel_stats.append(stats)
+        except EOFError:
+            output, error = "", "进程异常退出(exit code %s)。" % (process.exitcode,)
+        process.join()
+        print("[频道 %s]" % (channel_name,))
+        sys.stdout.write(output)
+        if error is not None:
+            failed += 1
+            print("* 执行失败: %s" % (error,))
+        sys.stdout.flush()
+    print("\n已在%s个频道上执行%s。" % (len(channels), "，%s个频道失败" % (failed,) if failed > 0 else ""))
+    if failed > 0:
+        sys.exit(1)
+
+
+# apply -d读取的文件。ndjson文件每行是一个文档，与hedge export --format ndjson的输出相同
+APPLY_FILE_EXTENSIONS = ('.yml', '.yaml', '.ndjson')
+
+
 @app.command("apply", help="应用文件以导入或更新数据")
 @click.option("--directory", "-d", help="指定一个目录，读取该目录下的所有可识别文件以应用更改")
 @click.option("--file", "-f", help="指定一个文件，读取该文件内容以应用更改")
 @click.option("-i", is_flag=True, help="从输入流读取内容以应用更改")
 @click.option("-q", is_flag=True, help="不显示任何输出")
-def apply(directory, file, i, q):
-    applier = Applier(server)
-    if i:
-        applier.apply(sys.stdin.read())
-    if file is not None:
-        with open(file) as f:
-            applier.apply(f.read())
+@click.option("--stream", "-s", is_flag=True, help="流式应用：边解析边提交来源数据，适用于超大的文件")
+@click.option("--concurrency", "-c", type=click.IntRange(min=1), default=4, show_default=True, help="提交时并发请求的数量")
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=1, show_default=True, help="读取多个文件时，在此数量的进程中并发解析与校验")
+@click.option("--refresh-cache", is_flag=True, help="丢弃本地缓存的元数据项id，重新从server查询")
+@click.option("--full", is_flag=True, help="完全应用所有内容，不跳过上次应用后未变更的文件和数据项")
+@click.option("--diff", is_flag=True, help="与server上的现有数据比较，对已有项只提交有变化的字段")
+@click.option("--plan", is_flag=True, help="与server上的现有数据比较，列出将要新建和修改的项，但不做任何写入")
+@click.option("--resume", is_flag=True, help="从上次中断的位置继续apply，不重复提交已完成的内容。输入的文件必须与上次相同")
+@channel_options
+def apply(directory, file, i, q, stream, concurrency, jobs, refresh_cache, full, diff, plan, resume, channel_names, all_channels):
+    from module.apply import Applier, iter_documents, parse_files
+    from module.apply_journal import ApplyJournal
+    from module.entity_cache import EntityCache
+    from module.manifest import ApplyManifest
+    if resume and i:
+        raise click.UsageError("--resume不能与-i同时使用，因为无法确认输入流的内容与上次相同。")
+    if resume and plan:
+        raise click.UsageError("--resume不能与--plan同时使用。")
+    channels = get_target_channels(channel_names, all_channels)
+    # 断点日志以source在输入中的序号记录进度，因此目录中文件的读取顺序必须是确定的
+    filepaths = [file] if file is not None else []
     if directory is not None:
-        for _, dirs, non_dirs in os.walk(directory):
-            for i in non_dirs:
-                if i.endswith('.yml') or i.endswith('.yaml'):
-                    with open(os.path.join(directory, i)) as f:
-                        applier.apply(f.read())
-    server.check_then_start()
-    server.register_signal()
-    applier.submit()
-
-    if not q:
-        if applier.updated.get('setting', None) is not None:
-            print("* 已更新%s个设置项。" % (applier.updated['setting'],))
-        if applier.updated.get('source', None) is not None:
-            print("* 已更新%s个来源数据项。" % (applier.updated['source'],))
-        if applier.updated.get('annotation', None) is not None:
-            print("* 已更新%s个注解项。" % (applier.updated['annotation'],))
-        if applier.updated.get('author', None) is not None:
-            print("* 已更新%s个作者项。" % (applier.updated['author'],))
-        if applier.updated.get('topic', None) is not None:
-            print("* 已更新%s个主题项。" % (applier.updated['topic'],))
-        if applier.updated.get('tag', None) is not None:
-            print("* 已更新%s个标签项。" % (applier.updated['tag'],))
-        if applier.created.get('setting', None) is not None:
-            print("* 已添加%s个设置项。" % (applier.created['setting'],))
-        if applier.created.get('source', None) is not None:
-            print("* 已添加%s个来源数据项。" % (applier.created['source'],))
-        if applier.created.get('annotation', None) is not None:
-            print("* 已添加%s个注解项。" % (applier.created['annotation'],))
-        if applier.created.get('author', None) is not None:
-            print("* 已添加%s个作者项。" % (applier.created['author'],))
-        if applier.created.get('topic', None) is not None:
-            print("* 已添加%s个主题项。" % (applier.created['topic'],))
-        if applier.created.get('tag', None) is not None:
-            print("* 已添加%s个标签项。" % (applier.created['tag'],))
-        if len(applier.submit_errors) > 0:
-            for e in applier.submit_errors:
-                print("* 错误项%s [%s]: %s" % e)
+        for dirpath, dirs, non_dirs in os.walk(directory):
+            dirs.sort()
+            filepaths += [os.path.join(dirpath, filename) for filename in sorted(non_dirs) if filename.endswith(APPLY_FILE_EXTENSIONS)]
+    signature = {"stdin": i, "files": [get_file_signature(filepath) for filepath in filepaths]}
+    # 输入流只能读取一次，多个频道时先读出全部内容
+    stdin_text = sys.stdin.read() if i and channels is not None and len(channels) > 1 else None
+    if plan:
+        # plan不做任何写入，因此不能边解析边提交来源数据，也不使用和更新本地缓存
+        stream = False
+    if stream and jobs > 1:
+        # 流式模式在读取文件之前已启动了心跳与提交线程，此时不能再fork解析进程
+        raise click.UsageError("--stream不能与--jobs同时使用。")
+
+    def apply_channel(channel_server, channel_path, out):
+        if plan:
+            entity_cache = None
+        else:
+            entity_cache = EntityCache(channel_path)
+            if refresh_cache:
+                entity_cache.clear()
+        manifest = ApplyManifest(channel_path, full=full or plan)
+        if plan:
+            journal = None
+        else:
+            journal = ApplyJournal(channel_path)
+            if not resume:
+                journal.begin(signature)
+            elif not journal.resume(signature):
+                raise click.UsageError("没有可以继续的apply，或者输入的文件已与上次不同。")
+        applier = Applier(channel_server, stream=stream, concurrency=concurrency, entity_cache=entity_cache, manifest=manifest if not plan else None,
+                          diff=diff, dry_run=plan, journal=journal)
+        applied_files = []
+        # 差异模式以server上的数据为准做比较，因此未变更的文件也要读取，其中的元数据项会与server比较；source仍按记录的hash跳过
+        pending_files = [(filepath, manifest.check_file(filepath)) for filepath in filepaths]
+        if not diff:
+            pending_files = [(filepath, digest) for (filepath, digest) in pending_files if digest is not None]
+        skipped_files = len(filepaths) - len(pending_files)
+
+        def read_files():
+            """
+            :return: 按文件顺序产出(filepath, digest, 已校验的文档)
+            """
+            if jobs > 1 and len(pending_files) > 1:
+                # 解析与校验在子进程中并发进行，本进程仍按文件顺序合并，因此结果与逐个读取时相同
+                for (docs, (filepath, digest)) in zip(parse_files([f for (f, _) in pending_files], jobs), pending_files):
+                    yield filepath, digest, docs
+            else:
+                for (filepath, digest) in pending_files:
+                    with open(filepath) as f:
+                        yield filepath, digest, iter_documents(f, "ndjson" if filepath.endswith(".ndjson") else "yaml", filepath)
+
+        with contextlib.ExitStack() as stack:
+            if journal is not None:
+                stack.callback(journal.close)
+            if stream:
+                channel_server.check_then_start()
+                stack.enter_context(channel_server.heartbeat())
+            if i:
+                applier.apply(sys.stdin if stdin_text is None else stdin_text, "<stdin>")
+            for (filepath, digest, docs) in read_files():
+                for (kind, version, spec) in docs:
+                    applier.apply_validated(kind, version, spec)
+                if digest is not None:
+                    applied_files.append((filepath, digest))
+            if not stream:
+                channel_server.check_then_start()
+                stack.enter_context(channel_server.heartbeat())
+            applier.submit()
+        if plan:
+            print_plan(applier, out)
+            return
+        if len(applier.submit_errors) == 0:
+            # 只有全部内容都成功提交时才记录文件hash，否则下次仍需处理这些文件中失败的项
+            for (filepath, digest) in applied_files:
+                manifest.set_file(filepath, digest)
+            manifest.save()
+            journal.discard()
+
+        if not q:
+            if diff:
+                for (action, kind, name, fields) in applier.plan:
+                    print_plan_item(action, kind, name, fields, out)
+            if skipped_files > 0:
+                print("* 跳过%s个未变更的文件。" % (skipped_files,), file=out)
+            kind_names = {'setting': '设置', 'source': '来源数据', 'annotation': '注解', 'author': '作者', 'topic': '主题', 'tag': '标签'}
+            for kind in kind_names.keys():
+                if applier.updated.get(kind, None) is not None:
+                    print("* 已更新%s个%s项。" % (applier.updated[kind], kind_names[kind]), file=out)
+            for kind in kind_names.keys():
+                if applier.created.get(kind, None) is not None:
+                    print("* 已添加%s个%s项。" % (applier.created[kind], kind_names[kind]), file=out)
+            for (kind, cnt) in applier.unchanged.items():
+                print("* 跳过%s个未变更的%s项。" % (cnt, kind_names[kind]), file=out)
+            for (kind, cnt) in applier.resumed.items():
+                print("* 跳过%s个上次已完成的%s项。" % (cnt, kind_names[kind]), file=out)
+            if len(applier.submit_errors) > 0:
+                for e in applier.submit_errors:
+                    print("* 错误项%s [%s]: %s" % e, file=out)
+            print_wait_time(channel_server, out)
+
+    run_on_channels(channels, apply_channel)
+
+
+def get_file_signature(filepath):
+    stat = os.stat(filepath)
+    return [os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns]
+
+
+def print_plan(applier, out=sys.stdout):
+    for (action, kind, name, fields) in applier.plan:
+        print_plan_item(action, kind, name, fields, out)
+    created = sum(cnt for (kind, cnt) in applier.created.items())
+    updated = sum(cnt for (kind, cnt) in applier.updated.items() if kind != 'source')
+    unchanged = sum(cnt for (kind, cnt) in applier.unchanged.items())
+    print("计划: 新建%s项，修改%s项，%s项无变化。" % (created, updated, unchanged), file=out)
+    if applier.updated.get('source', None) is not None:
+        print("另有%s个来源数据项将被提交。" % (applier.updated['source'],), file=out)
+    if len(applier.submit_errors) > 0:
+        for e in applier.submit_errors:
+            print("* 错误项%s [%s]: %s" % e, file=out)
+
+
+def print_plan_item(action, kind, name, fields, out=sys.stdout):
+    if action == 'create':
+        print("+ [%s] %s" % (kind, name), file=out)
+    else:
+        print("~ [%s] %s: %s" % (kind, name, ", ".join(fields)), file=out)
+
+
+@app.command("export", help="将元数据导出为apply可读取的文件，用于备份或迁移到其他频道")
+@click.option("--kind", "kinds", multiple=True, type=click.Choice(["setting", "annotation", "author", "topic", "tag", "source"]), help="要导出的数据种类，可指定多次。默认导出全部")
+@click.option("--format", "fmt", type=click.Choice(["yaml", "ndjson"]), default=None, help="输出格式。默认按输出文件的扩展名决定，其余情况为yaml")
+@click.option("--output", "-o", type=click.Path(dir_okay=False, writable=True), default=None, help="写入此文件。默认写到标准输出")
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=8, show_default=True, help="并发请求的数量")
+@click.option("--channel", "channel_name", default=None, help="从指定的频道导出，不改变当前所用的频道")
+def export(kinds, fmt, output, jobs, channel_name):
+    from module.export import Exporter, DocumentWriter, EXPORT_KINDS
+    if channel_name is not None and channel_name not in channel_manager.list():
+        raise click.BadParameter("频道'%s'不存在。" % (channel_name,), param_hint="--channel")
+    if fmt is None:
+        fmt = "ndjson" if output is not None and output.endswith(".ndjson") else "yaml"
+    channel_server = Server(local_config, channel_manager, channel_name) if channel_name is not None else server
+    channel_server.check_then_start()
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(channel_server.heartbeat())
+        if output is None:
+            out = sys.stdout
+        else:
+            # 先写入临时文件，全部导出成功后才替换目标文件，失败时不会留下不完整的备份
+            tmp_path = output + ".tmp"
+            out = stack.enter_context(open(tmp_path, "w"))
+        exporter = Exporter(channel_server, DocumentWriter(out, fmt), concurrency=jobs)
+        try:
+            exporter.export(kinds or EXPORT_KINDS)
+        except BrokenPipeError:
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return
+        except BaseException:
+            if output is not None:
+                out.close()
+                os.remove(tmp_path)
+            raise
+    if output is not None:
+        os.replace(tmp_path, output)
+    kind_names = {'setting': '设置', 'annotation': '注解', 'author': '作者', 'topic': '主题', 'tag': '标签', 'source': '来源数据'}
+    for (kind, cnt) in exporter.exported.items():
+        click.echo("* 已导出%s个%s项。" % (cnt, kind_names[kind]), err=True)
 
 
 @app.group("import", help="文件导入")
@@ -90,33 +369,187 @@ def import_group():
 @import_group.command("add", help="添加新的文件")
 @click.argument("filename")
 @click.option("--remove", "-r", is_flag=True, help="移除原始文件")
-def import_add(filename, remove):
-    importation = Importation(server)
-    server.check_then_start()
-    server.register_signal()
-    if os.path.isdir(filename):
-        for _, dirs, non_dirs in os.walk(filename):
-            for i in non_dirs:
-                e = importation.add(os.path.join(filename, i), remove)
-                if e is not None:
-                    print("%s: %s" % (i, e))
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=4, show_default=True, help="导入目录时并发请求的数量")
+@click.option("--duplicate", type=click.Choice(["skip", "report", "allow"]), default="skip", show_default=True,
+              help="对内容已导入过的文件的处理。skip: 跳过并报告数量; report: 跳过并列出每个文件; allow: 不做检查，照常导入")
+@channel_options
+def import_add(filename, remove, jobs, duplicate, channel_names, all_channels):
+    from module.importation import Importation
+    from module.import_index import ImportIndex
+    channels = get_target_channels(channel_names, all_channels)
+    multiple = channels is not None and len(channels) > 1
+    if remove and multiple:
+        raise click.UsageError("向多个频道导入时不能使用--remove，因为原始文件需要被每个频道读取。")
+
+    def import_channel(channel_server, channel_path, out):
+        index = ImportIndex(channel_path) if duplicate != "allow" else None
+        importation = Importation(channel_server, index)
+        channel_server.check_then_start()
+        with channel_server.heartbeat():
+            try:
+                if index is not None:
+                    importation.sync_index(channel_path, jobs)
+                if os.path.isdir(filename):
+                    filepaths = [os.path.join(dirpath, i) for (dirpath, _, non_dirs) in os.walk(filename) for i in non_dirs]
+                    errors = []
+                    duplicates = []
+                    start_time = last_print_time = time.time()
+                    for (cnt, (filepath, e, skipped)) in enumerate(importation.add_all(filepaths, remove, jobs), start=1):
+                        if e is not None:
+                            errors.append((filepath, e))
+                        elif skipped:
+                            duplicates.append(filepath)
+                        now = time.time()
+                        # 多个频道并行导入时不显示进度，避免各频道的进度行互相覆盖
+                        if not multiple and (now - last_print_time >= 0.1 or cnt == len(filepaths)):
+                            last_print_time = now
+                            click.echo("\r已处理 %s/%s  重复 %s  失败 %s  %.1f个/秒" % (cnt, len(filepaths), len(duplicates), len(errors), cnt / max(now - start_time, 0.001)), nl=False, err=True)
+                    if not multiple:
+                        click.echo(err=True)
+                    print("已添加%s个文件。" % (len(filepaths) - len(errors) - len(duplicates),), file=out)
+                    if len(duplicates) > 0:
+                        print("跳过%s个重复的文件%s" % (len(duplicates), ":" if duplicate == "report" else "。"), file=out)
+                        if duplicate == "report":
+                            for filepath in duplicates:
+                                print("* %s" % (filepath,), file=out)
+                    if len(errors) > 0:
+                        print("%s个文件添加失败:" % (len(errors),), file=out)
+                        for (filepath, e) in errors:
+                            print("* %s: %s" % (filepath, e), file=out)
                 else:
-                    print(i)
-    else:
-        e = importation.add(filename, remove)
-        if e is not None:
-            print("%s: %s" % (filename, e))
-        else:
-            print(filename)
+                    e, skipped = importation.add(filename, remove)
+                    if e is not None:
+                        print("%s: %s" % (filename, e), file=out)
+                    elif skipped:
+                        print("%s: 文件重复，已跳过" % (filename,), file=out)
+                    else:
+                        print(filename, file=out)
+            finally:
+                if index is not None:
+                    index.save()
+        print_wait_time(channel_server, out)
+
+    run_on_channels(channels, import_channel)
+
+
+@import_group.command("watch", help="持续监视目录，将写入完成的文件合批导入")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.option("--remove", "-r", is_flag=True, help="移除原始文件")
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=4, show_default=True, help="导入每批文件时并发请求的数量")
+@click.option("--duplicate", type=click.Choice(["skip", "report", "allow"]), default="skip", show_default=True,
+              help="对内容已导入过的文件的处理。skip: 跳过并报告数量; report: 跳过并列出每个文件; allow: 不做检查，照常导入")
+@click.option("--debounce", type=click.FloatRange(min=0, min_open=True), default=2, show_default=True, help="合批的等待窗口(秒)。目录在此时间内没有新文件完成时，导入已完成的文件")
+@click.option("--max-batch", type=click.IntRange(min=1), default=200, show_default=True, help="单个批次的最大文件数")
+@click.option("--tagme", "-t", help="对每批导入的文件修改Tagme")
+@click.option("--partition-time", "-p", help="对每批导入的文件修改时间分区")
+@click.option("--create-time", "-c", help="对每批导入的文件按策略修改创建时间")
+@click.option("--order-time", "-o", help="对每批导入的文件按策略修改排序时间")
+@click.option("--analyse-source", "-s", is_flag=True, help="对每批导入的文件分析来源数据")
+@click.option("--save", is_flag=True, help="每批导入后确认保存所有导入文件")
+def import_watch(directory, remove, jobs, duplicate, debounce, max_batch, tagme, partition_time, create_time, order_time, analyse_source, save):
+    import signal
+    from module.importation import Importation
+    from module.import_index import ImportIndex
+    from module.import_watch import ImportWatcher
+    index = ImportIndex(channel_manager.path()) if duplicate != "allow" else None
+    importation = Importation(server, index)
+    update = tagme is not None or partition_time is not None or create_time is not None or order_time is not None or analyse_source
+    added = duplicated = failed = 0
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+    # 作为后台服务运行时通常以SIGTERM停止，与Ctrl-C一样保存索引并输出汇总
+    signal.signal(signal.SIGTERM, stop)
+    # 整个监视期间只启动一次server并保持心跳，使每批文件都通过已建立的连接导入
+    server.check_then_start()
+    with server.heartbeat(), ImportWatcher(directory, debounce=debounce, max_batch=max_batch) as watcher:
+        try:
+            if index is not None:
+                importation.sync_index(channel_manager.path(), jobs)
+            print("正在监视%s (%s)，按Ctrl-C停止。" % (directory, "inotify" if watcher.native else "轮询"), flush=True)
+            for batch in watcher.batches():
+                if len(batch) == 0:
+                    continue
+                import_ids = []
+                errors = []
+                duplicates = []
+                for (filepath, e, skipped, import_id) in importation.add_all(batch, remove, jobs, with_id=True):
+                    if e is not None:
+                        errors.append((filepath, e))
+                    elif skipped:
+                        duplicates.append(filepath)
+                    else:
+                        import_ids.append(import_id)
+                if index is not None:
+                    index.save()
+                added += len(import_ids)
+                duplicated += len(duplicates)
+                failed += len(errors)
+                print("[%s] 已添加%s个文件，跳过%s个重复的文件，%s个文件添加失败。" % (time.strftime("%H:%M:%S"), len(import_ids), len(duplicates), len(errors)))
+                if duplicate == "report":
+                    for filepath in duplicates:
+                        print("* 重复: %s" % (filepath,))
+                for (filepath, e) in errors:
+                    print("* %s: %s" % (filepath, e))
+                # 批次的后续处理失败时只报告错误，继续监视
+                if update and len(import_ids) > 0:
+                    try:
+                        importation.batch_update(tagme, partition_time, create_time, order_time, analyse_source, target=import_ids)
+                    except Exception as e:
+                        print("* 修改导入文件的属性失败: %s" % (e,))
+                if save and len(import_ids) > 0:
+                    try:
+                        print("* 已导入%s个项目。" % (importation.save(),))
+                    except Exception as e:
+                        print("* 确认保存失败: %s" % (e,))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if index is not None:
+                index.save()
+    print("\n共添加%s个文件，跳过%s个重复的文件，%s个文件添加失败。" % (added, duplicated, failed))
+    print_wait_time(server, sys.stdout)
 
 
 @import_group.command("list", help="列出所有导入文件")
-def import_list():
+@click.option("--format", "fmt", type=click.Choice(["table", "tsv", "ndjson"]), default="table", show_default=True, help="输出格式")
+@click.option("--limit", type=click.IntRange(min=0), default=None, help="最多列出的项数")
+@click.option("--offset", type=click.IntRange(min=0), default=0, help="跳过前面的项数")
+def import_list(fmt, limit, offset):
+    import json
+    from module.importation import Importation
     importation = Importation(server)
     server.check_then_start()
     server.register_signal()
-    for (i, n, t) in importation.list():
-        print("[%s] %-48s  | %s" % (i, n, t))
+    if fmt == "ndjson":
+        def format_row(r):
+            return json.dumps(r, ensure_ascii=False)
+    elif fmt == "tsv":
+        columns = ["id", "fileName", "source", "sourceId", "sourcePart", "tagme", "partitionTime", "orderTime", "file"]
+        sys.stdout.write("\t".join(columns) + "\n")
+
+        def format_row(r):
+            return "\t".join(format_tsv_value(r.get(c)) for c in columns)
+    else:
+        def format_row(r):
+            return "[%s] %-48s  | %s" % (r["id"], r["fileName"], r["orderTime"])
+    try:
+        # 每一页输出一次并立即flush，使管道下游能尽早开始处理，同时内存占用只与页大小有关
+        for page in importation.list_pages(limit, offset):
+            sys.stdout.write("".join(format_row(r) + "\n" for r in page))
+            sys.stdout.flush()
+    except BrokenPipeError:
+        # 下游已关闭管道(例如head)。将stdout重定向到devnull，避免解释器退出时再次flush报错
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+def format_tsv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return ",".join(str(i) for i in value)
+    return str(value).replace("\t", " ").replace("\n", " ")
 
 
 @import_group.command("batch", help="修改导入文件的属性")
@@ -125,20 +558,37 @@ def import_list():
 @click.option("--create-time", "-c", help="按策略修改创建时间")
 @click.option("--order-time", "-o", help="按策略修改排序时间")
 @click.option("--analyse-source", "-s", is_flag=True, help="分析来源数据")
-def import_batch_update(tagme, partition_time, create_time, order_time, analyse_source):
-    importation = Importation(server)
-    server.check_then_start()
-    server.register_signal()
-    importation.batch_update(tagme, partition_time, create_time, order_time, analyse_source)
+@channel_options
+def import_batch_update(tagme, partition_time, create_time, order_time, analyse_source, channel_names, all_channels):
+    from module.importation import Importation
+
+    def batch_update_channel(channel_server, channel_path, out):
+        importation = Importation(channel_server)
+        channel_server.check_then_start()
+        with channel_server.heartbeat():
+            importation.batch_update(tagme, partition_time, create_time, order_time, analyse_source)
+
+    run_on_channels(get_target_channels(channel_names, all_channels), batch_update_channel)
 
 
 @import_group.command("save", help="确认保存所有导入文件")
-def import_save():
-    importation = Importation(server)
-    server.check_then_start()
-    server.register_signal()
-    cnt = importation.save()
-    print("已导入%s个项目。" % (cnt,))
+@channel_options
+def import_save(channel_names, all_channels):
+    from module.importation import Importation
+
+    def save_channel(channel_server, channel_path, out):
+        importation = Importation(channel_server)
+        channel_server.check_then_start()
+        with channel_server.heartbeat():
+            cnt = importation.save()
+        print("已导入%s个项目。" % (cnt,), file=out)
+
+    run_on_channels(get_target_channels(channel_names, all_channels), save_channel)
+
+
+def print_wait_time(channel_server, out):
+    if channel_server.wait_time > 0:
+        print("* 等待server启动就绪耗时%.1f秒。" % (channel_server.wait_time,), file=out)
 
 
 @app.group("channel", help="Hedge CLI 频道控制")
@@ -170,21 +620,25 @@ def server():
 
 
 @server.command("status", help="查看后台进程状态")
-def server_status():
-    stat = server.status()
-    print("运行状态: %s" % (stat["status"],))
-    if stat["status"] != "STOP":
-        print()
-        if "pid" in stat:
-            print("进程PID: %s" % (stat["pid"],))
-        if "port" in stat:
-            print("进程Port: %s" % (stat["port"],))
-        if "start_time" in stat:
-            millis = int(time.time() - stat["start_time"] / 1000)
-            seconds = millis % 60
-            minutes = (millis % 3600) // 60
-            hours = millis // 3600
-            print("已运行时长: %02d:%02d:%02d" % (hours, minutes, seconds))
+@channel_options
+def server_status(channel_names, all_channels):
+    def status_channel(channel_server, channel_path, out):
+        stat = channel_server.status()
+        print("运行状态: %s" % (stat["status"],), file=out)
+        if stat["status"] != "STOP":
+            print(file=out)
+            if "pid" in stat:
+                print("进程PID: %s" % (stat["pid"],), file=out)
+            if "port" in stat:
+                print("进程Port: %s" % (stat["port"],), file=out)
+            if "start_time" in stat:
+                millis = int(time.time() - stat["start_time"] / 1000)
+                seconds = millis % 60
+                minutes = (millis % 3600) // 60
+                hours = millis // 3600
+                print("已运行时长: %02d:%02d:%02d" % (hours, minutes, seconds), file=out)
+
+    run_on_channels(get_target_channels(channel_names, all_channels), status_channel)
 
 
 @server.command("start", help="启动后台服务进程，使其常驻后台")
@@ -199,6 +653,113 @@ def server_stop():
         server.set_permanent_flag(False)
 
 
+@app.group("agent", help="Hedge CLI 常驻进程控制。agent运行时，hedge命令会交给它执行，省去每次启动与加载依赖的时间")
+def agent():
+    pass
+
+
+# agent在启动时预先加载的模块，执行命令的子进程直接继承它们
+AGENT_PRELOAD_MODULES = ["requests", "yaml", "schema", "utils.fast_schema", "module.apply", "module.apply_journal", "module.entity_cache", "module.manifest", "module.plan",
+                         "module.importation", "module.import_index", "module.import_watch", "module.export"]
+
+
+@agent.command("start", help="在后台启动agent")
+@click.option("--idle-timeout", type=click.FloatRange(min=0), default=1800, show_default=True, help="没有命令执行超过此秒数时自动退出。为0时不退出")
+def agent_start(idle_timeout):
+    from module.agent import AGENT_LOG
+    from module.agent_client import request_control
+    status = request_control("status")
+    if status is not None:
+        print("agent已在运行 (PID %s)。" % (status["pid"],))
+        return
+    log_path = os.path.join(local_config.appdata_path, AGENT_LOG)
+    os.makedirs(local_config.appdata_path, exist_ok=True)
+    with open(log_path, "a") as log:
+        process = subprocess.Popen([sys.executable, os.path.realpath(__file__), "agent", "run", "--idle-timeout", str(idle_timeout)],
+                                   stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+    deadline = time.monotonic() + 10
+    while True:
+        status = request_control("status")
+        if status is not None:
+            print("agent已启动 (PID %s)。" % (status["pid"],))
+            return
+        if process.poll() is not None or time.monotonic() >= deadline:
+            print("agent启动失败，详见%s。" % (log_path,))
+            exit(1)
+        time.sleep(0.05)
+
+
+@agent.command("run", help="在前台运行agent")
+@click.option("--idle-timeout", type=click.FloatRange(min=0), default=1800, show_default=True, help="没有命令执行超过此秒数时自动退出。为0时不退出")
+def agent_run(idle_timeout):
+    import gc
+    import importlib
+    import signal
+    from module.agent import Agent, ChannelKeeper
+    from module.agent_client import get_socket_path
+    for name in AGENT_PRELOAD_MODULES:
+        importlib.import_module(name)
+    # 已加载的对象不再被gc扫描，fork出的子进程因此不会触发这些内存页的复制
+    gc.freeze()
+    socket_path = get_socket_path()
+    with Agent(socket_path, execute_forwarded, idle_timeout or None) as agent_process:
+        def stop(signum, frame):
+            agent_process.stop()
+        signal.signal(signal.SIGTERM, stop)
+        print("[%s] agent正在%s上运行 (PID %s)。" % (time.strftime("%H:%M:%S"), socket_path, os.getpid()), flush=True)
+        with ChannelKeeper(local_config, after_fork=agent_process.close_inherited):
+            agent_process.serve_forever()
+    if agent_process.restart_requested:
+        print("[%s] CLI的代码已更新，agent正在重启。" % (time.strftime("%H:%M:%S"),), flush=True)
+        os.execv(sys.executable, [sys.executable, os.path.realpath(__file__), "agent", "run", "--idle-timeout", str(idle_timeout)])
+    print("[%s] agent已停止。" % (time.strftime("%H:%M:%S"),), flush=True)
+
+
+@agent.command("stop", help="停止agent")
+def agent_stop():
+    from module.agent_client import request_control
+    from module.server import is_process_alive
+    status = request_control("stop")
+    if status is None:
+        print("agent未运行。")
+        return
+    deadline = time.monotonic() + 10
+    while is_process_alive(status["pid"]):
+        if time.monotonic() >= deadline:
+            print("agent将在正在执行的命令结束后停止 (PID %s)。" % (status["pid"],))
+            return
+        time.sleep(0.05)
+    print("agent已停止。")
+
+
+@agent.command("status", help="查看agent的运行状态")
+def agent_status():
+    from module.agent_client import request_control
+    status = request_control("status")
+    if status is None:
+        print("运行状态: STOP")
+        return
+    print("运行状态: RUNNING")
+    print()
+    print("进程PID: %s" % (status["pid"],))
+    seconds = int(time.time() - status["startTime"] / 1000)
+    print("已运行时长: %02d:%02d:%02d" % (seconds // 3600, (seconds % 3600) // 60, seconds % 60))
+    print("已执行命令: %s" % (status["requests"],))
+    print("正在执行: %s" % (status["running"],))
+
+
+def execute_forwarded(argv):
+    """
+    在agent的子进程中执行转发来的命令。
+    cli.json可能已被之前的命令修改(例如切换了频道)，因此重新读取它并使用新的Server实例；conf.local.json的修改需要重启agent才会生效。
+    """
+    global cli_data, channel_manager, server
+    cli_data = CliData(local_config.appdata_path)
+    channel_manager = ChannelManager(local_config.appdata_path, cli_data)
+    server = Server(local_config, channel_manager)
+    app.main(args=argv)
+
+
 if __name__ == "__main__":
     local_config = LocalConfig()
     cli_data = CliData(local_config.appdata_path)
@@ -0,0 +1,388 @@
+import os
+import struct
+import sys
+import threading
+import time
+from module.agent_client import get_source_signature, send_message, recv_message
+from module.local_config import LocalConfig
+
+
+AGENT_LOG = "cli-agent.log"
+
+
+class Agent:
+    """
+    常驻的CLI进程。在本地unix socket上接收hedge.py转发来的命令，为每个命令fork一个子进程执行。
+    子进程继承了agent已加载的模块，不需要重新启动解释器和import依赖，因此命令的额外开销只有一次fork。
+    子进程使用客户端传来的stdin/stdout/stderr、工作目录与环境变量，执行结束后将退出码回复给客户端。
+    命令在子进程中执行，一个命令的崩溃或阻塞不会影响agent和其他命令。
+    fork只复制调用它的线程，其他线程当时持有的锁在子进程中永远不会被释放，因此agent只有一个线程：
+    接收连接、转交信号与回收子进程都在serve_forever()的事件循环中进行，需要线程的ChannelKeeper运行在单独的进程中。
+    """
+    def __init__(self, socket_path: str, execute, idle_timeout: float = None):
+        """
+        :param execute: 在子进程中执行命令的函数，参数为命令行参数列表(不含程序名)
+        :param idle_timeout: 没有命令执行超过此秒数时自动退出。为None时不退出
+        """
+        self.__socket_path = socket_path
+        self.__execute = execute
+        self.__idle_timeout = idle_timeout
+        self.__source = get_source_signature()
+        self.__listener = None
+        self.__selector = None
+        self.__wakeup = None
+        self.__stopping = False
+        self.__children = {}
+        self.__last_active_time = time.monotonic()
+        self.__start_time = int(time.time() * 1000)
+        self.request_count = 0
+        self.restart_requested = False
+
+    def __enter__(self):
+        import selectors
+        import signal
+        import socket
+        os.makedirs(os.path.dirname(self.__socket_path), exist_ok=True)
+        if os.path.exists(self.__socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(self.__socket_path)
+                    raise Exception("Another agent is already running on %s." % (self.__socket_path,))
+                except ConnectionRefusedError:
+                    # 上次异常退出遗留的socket文件
+                    os.remove(self.__socket_path)
+        self.__listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # 任何能连接socket的进程都能以当前用户的身份执行命令，因此socket只对当前用户可访问
+        umask = os.umask(0o077)
+        try:
+            self.__listener.bind(self.__socket_path)
+        finally:
+            os.umask(umask)
+        self.__listener.listen(64)
+        self.__listener.setblocking(False)
+        # 子进程退出时的SIGCHLD通过wakeup fd唤醒事件循环
+        self.__wakeup = os.pipe()
+        for fd in self.__wakeup:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.__wakeup[1])
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(self.__listener, selectors.EVENT_READ)
+        self.__selector.register(self.__wakeup[0], selectors.EVENT_READ)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        import signal
+        self.__selector.unregister(self.__listener)
+        self.__listener.close()
+        try:
+            os.remove(self.__socket_path)
+        except FileNotFoundError:
+            pass
+        # 等待已开始的命令结束，使它们的客户端能收到退出码
+        while len(self.__children) > 0:
+            self.__process_events(1.0)
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        self.__selector.close()
+        for fd in self.__wakeup:
+            os.close(fd)
+
+    def stop(self):
+        self.__stopping = True
+
+    def serve_forever(self):
+        """
+        在当前线程中接收并执行命令，直到stop()被调用或空闲超时。必须在主线程中调用。
+        """
+        while not self.__stopping:
+            self.__process_events(1.0)
+            if self.__is_idle():
+                print("[%s] 空闲超过%s秒，agent退出。" % (time.strftime("%H:%M:%S"), self.__idle_timeout), flush=True)
+                break
+
+    def close_inherited(self):
+        """
+        关闭fork出的子进程从agent继承的socket与信号处理。子进程不应持有agent的socket，否则agent退出后socket仍能被连接，其他客户端也收不到连接的关闭。
+        """
+        import signal
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        self.__selector.close()
+        self.__listener.close()
+        for conn in self.__children.values():
+            conn.close()
+        for fd in self.__wakeup:
+            os.close(fd)
+
+    def __is_idle(self):
+        if self.__idle_timeout is None:
+            return False
+        return len(self.__children) == 0 and time.monotonic() - self.__last_active_time >= self.__idle_timeout
+
+    def __process_events(self, timeout: float):
+        for (key, _) in self.__selector.select(timeout):
+            if key.fileobj is self.__listener:
+                self.__accept_one()
+            elif key.fileobj == self.__wakeup[0]:
+                try:
+                    while os.read(self.__wakeup[0], 512):
+                        pass
+                except BlockingIOError:
+                    pass
+            else:
+                self.__relay_signals(key.fileobj, key.data)
+        self.__reap_children()
+
+    def __accept_one(self):
+        try:
+            conn, _ = self.__listener.accept()
+        except BlockingIOError:
+            return
+        try:
+            self.__accept(conn)
+        except Exception as e:
+            print("[%s] 处理请求失败: %s" % (time.strftime("%H:%M:%S"), e), flush=True)
+            conn.close()
+
+    def __accept(self, conn):
+        import selectors
+        conn.settimeout(5.0)
+        if not is_same_user(conn):
+            conn.close()
+            return
+        request, fds = recv_message(conn, maxfds=3)
+        if "control" in request:
+            try:
+                send_message(conn, self.__control(request["control"]))
+            finally:
+                conn.close()
+            return
+        if request.get("source", None) != self.__source or len(fds) != 3:
+            for fd in fds:
+                os.close(fd)
+            try:
+                send_message(conn, {"stale": True})
+            finally:
+                conn.close()
+            if get_source_signature() != self.__source:
+                # 本地代码已更新，agent加载的是旧版本的代码。客户端这次在它自己的进程中执行，agent在正在执行的命令结束后以新代码重启
+                self.restart_requested = True
+                self.stop()
+            return
+        conn.settimeout(None)
+        self.request_count += 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.__run_child(request, fds)
+        for fd in fds:
+            os.close(fd)
+        self.__children[pid] = conn
+        self.__selector.register(conn, selectors.EVENT_READ, pid)
+
+    def __control(self, command: str):
+        if command == "status":
+            return {"pid": os.getpid(), "startTime": self.__start_time, "requests": self.request_count, "running": len(self.__children)}
+        if command == "stop":
+            self.stop()
+            return {"pid": os.getpid()}
+        return {"error": "Unknown control command %s." % (command,)}
+
+    def __run_child(self, request, fds):
+        """
+        在fork出的子进程中执行命令。此方法不会返回。
+        """
+        import signal
+        import traceback
+        code = 1
+        try:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self.close_inherited()
+            for (target, fd) in enumerate(fds):
+                os.dup2(fd, target)
+                os.close(fd)
+            os.chdir(request["cwd"])
+            os.environ.clear()
+            os.environ.update(request["env"])
+            time.tzset()
+            encoding = request["encoding"]
+            sys.stdin = open(0, "r", encoding=encoding, closefd=False)
+            sys.stdout = open(1, "w", encoding=encoding, closefd=False)
+            sys.stderr = open(2, "w", encoding=encoding, errors="backslashreplace", buffering=1, closefd=False)
+            sys.argv = request["argv"]
+            try:
+                self.__execute(sys.argv[1:])
+                code = 0
+            except SystemExit as e:
+                if e.code is None:
+                    code = 0
+                elif isinstance(e.code, int):
+                    code = e.code
+                else:
+                    print(e.code, file=sys.stderr)
+                    code = 1
+            except KeyboardInterrupt:
+                code = 130
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            except OSError:
+                pass
+        finally:
+            os._exit(code)
+
+    def __relay_signals(self, conn, pid: int):
+        """
+        将客户端转交的信号发给子进程。客户端断开时终止子进程。
+        子进程只在同一个线程的__reap_children()中被回收，因此这里的pid总是仍属于它，不会因为pid被复用而发给其他进程。
+        """
+        import signal
+        try:
+            data = conn.recv(16)
+        except OSError:
+            data = b""
+        if len(data) == 0:
+            self.__selector.unregister(conn)
+            os.kill(pid, signal.SIGTERM)
+            return
+        for signum in data:
+            os.kill(pid, signum)
+
+    def __reap_children(self):
+        for (pid, conn) in list(self.__children.items()):
+            finished, status = os.waitpid(pid, os.WNOHANG)
+            if finished == 0:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            del self.__children[pid]
+            self.__last_active_time = time.monotonic()
+            if self.__selector.get_map().get(conn.fileno(), None) is not None:
+                self.__selector.unregister(conn)
+                try:
+                    send_message(conn, {"exitCode": code if code >= 0 else 128 - code})
+                except OSError:
+                    pass
+            conn.close()
+
+
+class ChannelKeeper:
+    """
+    使当前所用频道的server保持运行，并持续续期生命周期信号，使转发来的命令总能连接到已就绪的server。
+    切换频道后，改为保持新频道的server；旧频道的信号不再续期，server会在其过期后按自己的规则关闭。
+    续期信号需要线程，因此keeper运行在从agent fork出的单独进程中，agent进程自身不运行任何线程。
+    keeper通过一个管道感知agent的存活：agent关闭管道或异常退出时，keeper释放信号并退出。
+    """
+    def __init__(self, local_config: LocalConfig, check_interval: float = 1.0, after_fork=None):
+        """
+        :param after_fork: 在keeper进程中首先调用的函数，用于关闭从agent继承的资源
+        """
+        self.__local_config = local_config
+        self.__check_interval = check_interval
+        self.__after_fork = after_fork
+        self.__stop_event = threading.Event()
+        self.__pid = None
+        self.__pipe = None
+        self.__channel_name = None
+        self.__heartbeat = None
+
+    def __enter__(self):
+        (read_fd, write_fd) = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.close(write_fd)
+            self.__run_process(read_fd)
+        os.close(read_fd)
+        self.__pid = pid
+        self.__pipe = write_fd
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        os.close(self.__pipe)
+        os.waitpid(self.__pid, 0)
+
+    def __run_process(self, pipe: int):
+        """
+        keeper进程的入口。此方法不会返回。
+        """
+        import signal
+        import traceback
+        code = 0
+        try:
+            # 终端的Ctrl-C由agent处理，keeper在agent关闭管道后自行退出
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if self.__after_fork is not None:
+                self.__after_fork()
+            threading.Thread(target=self.__watch_agent, args=(pipe,), name="hedge-agent-keeper-watch", daemon=True).start()
+            self.__run()
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(code)
+
+    def __watch_agent(self, pipe: int):
+        # agent从不向管道写入，读到EOF说明agent已关闭管道或已退出
+        os.read(pipe, 1)
+        self.__stop_event.set()
+
+    def __run(self):
+        from module.cli_data import CliData
+        from module.channel import ChannelManager
+        from module.server import Server
+        retry_time = 0.0
+        try:
+            while not self.__stop_event.is_set():
+                try:
+                    channel_manager = ChannelManager(self.__local_config.appdata_path, CliData(self.__local_config.appdata_path))
+                except ValueError:
+                    # cli.json正在被其他命令写入
+                    self.__stop_event.wait(self.__check_interval)
+                    continue
+                channel_name = channel_manager.current()
+                if channel_name != self.__channel_name and time.monotonic() >= retry_time:
+                    self.__release()
+                    try:
+                        server = Server(self.__local_config, channel_manager, channel_name)
+                        server.check_then_start()
+                        self.__heartbeat = server.heartbeat()
+                        self.__heartbeat.__enter__()
+                        self.__channel_name = channel_name
+                        print("[%s] 正在保持频道%s的server。" % (time.strftime("%H:%M:%S"), channel_name), flush=True)
+                    except Exception as e:
+                        # server启动失败时不反复重试，间隔一个心跳周期
+                        self.__heartbeat = None
+                        retry_time = time.monotonic() + self.__local_config.heartbeat_interval
+                        print("[%s] 无法启动频道%s的server: %s" % (time.strftime("%H:%M:%S"), channel_name, e), flush=True)
+                self.__stop_event.wait(self.__check_interval)
+        finally:
+            self.__release()
+
+    def __release(self):
+        if self.__heartbeat is not None:
+            self.__heartbeat.__exit__(None, None, None)
+            self.__heartbeat = None
+        self.__channel_name = None
+
+
+def is_same_user(conn):
+    """
+    在支持SO_PEERCRED的平台上确认对端进程属于当前用户。
+    """
+    import socket
+    if not hasattr(socket, "SO_PEERCRED"):
+        return True
+    _, uid, _ = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    return uid == os.getuid()
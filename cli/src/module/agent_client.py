@@ -0,0 +1,166 @@
+import marshal
+import os
+import struct
+import sys
+
+
+AGENT_SOCKET = "cli-agent.sock"
+
+# 不转发给agent执行的命令。agent自身的控制命令总是在本进程执行
+LOCAL_COMMANDS = ("agent",)
+
+# CLI的根目录，即conf.local.json所在的目录
+CLI_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+
+def get_socket_path():
+    """
+    agent的socket与conf.local.json位于同一目录。每个CLI目录只对应一份配置，因此客户端不需要读取配置就能找到agent。
+    """
+    return os.path.join(CLI_PATH, AGENT_SOCKET)
+
+
+def forward(argv):
+    """
+    agent正在运行时，将命令交给它执行，并以命令的退出码结束本进程。
+    本进程的stdin/stdout/stderr会随请求一起传给agent，因此命令的输入输出与在本进程执行时完全相同。
+    agent未运行、命令不应转发，或者agent的代码与本地代码不一致时直接返回，由调用者在本进程执行命令。
+    此函数在加载click等依赖之前被调用，因此这个模块只使用加载开销很小的标准库模块。
+    """
+    if os.environ.get("HEDGE_NO_AGENT") or get_command(argv) in LOCAL_COMMANDS:
+        return
+    socket_path = get_socket_path()
+    if not os.path.exists(socket_path):
+        return
+    # socket与signal模块加载时都会导入enum，这在转发的全部耗时中占了相当的比例，因此这里直接使用它们的底层模块
+    import _signal
+    import _socket
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        encoding = sys.stdout.encoding if sys.stdout is not None else "utf-8"
+        send_message(sock, {"argv": sys.argv[:1] + argv, "cwd": os.getcwd(), "env": dict(os.environ), "encoding": encoding,
+                            "source": get_source_signature()}, get_stdio_fds())
+    except OSError:
+        # 遗留的socket文件，或者agent正在退出
+        sock.close()
+        return
+
+    def relay(signum, frame):
+        # 命令在agent的子进程中执行，它收不到终端发给本进程的信号，因此将信号转交给它
+        try:
+            sock.sendall(bytes([signum]))
+        except OSError:
+            pass
+    _signal.signal(_signal.SIGINT, relay)
+    _signal.signal(_signal.SIGTERM, relay)
+    try:
+        response = recv_message(sock)[0]
+    except (OSError, ValueError):
+        response = None
+    finally:
+        sock.close()
+    if response is None:
+        print("与agent的连接意外中断。", file=sys.stderr)
+        sys.exit(1)
+    if response.get("stale", False):
+        # agent加载的是旧版本的代码
+        _signal.signal(_signal.SIGINT, _signal.default_int_handler)
+        _signal.signal(_signal.SIGTERM, _signal.SIG_DFL)
+        return
+    sys.exit(response["exitCode"])
+
+
+def request_control(command: str):
+    """
+    向agent发送控制命令。
+    :return: agent的回复。agent未运行时返回None
+    """
+    import socket
+    socket_path = get_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+            send_message(sock, {"control": command})
+            return recv_message(sock)[0]
+        except (OSError, ValueError):
+            return None
+
+
+def get_command(argv):
+    """
+    :return: 命令行参数中的第一级子命令
+    """
+    i = 0
+    while i < len(argv) and argv[i].startswith("-"):
+        # --trace是顶层唯一带参数值的选项
+        i += 2 if argv[i] == "--trace" else 1
+    return argv[i] if i < len(argv) else None
+
+
+def get_source_signature():
+    """
+    CLI代码与解释器的标识，包括解释器版本与所有源文件的最大修改时间。代码更新后，旧的agent不再接受命令。
+    """
+    src_path = os.path.join(CLI_PATH, "src")
+    latest = 0
+    for directory in (src_path, os.path.join(src_path, "module"), os.path.join(src_path, "utils")):
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".py"):
+                latest = max(latest, entry.stat().st_mtime_ns)
+    return [sys.hexversion, latest]
+
+
+def get_stdio_fds():
+    """
+    :return: 本进程的stdin/stdout/stderr。已关闭的用/dev/null代替
+    """
+    fds = []
+    for fd in (0, 1, 2):
+        try:
+            os.fstat(fd)
+            fds.append(fd)
+        except OSError:
+            fds.append(os.open(os.devnull, os.O_RDWR))
+    return fds
+
+
+def send_message(sock, message: dict, fds=()):
+    """
+    消息由4字节的长度与marshal序列化的内容组成，文件描述符随长度一起发送。
+    不使用json，因为加载json模块的耗时与转发命令的全部耗时相当。agent只执行解释器版本与自己相同的客户端的命令，因此marshal的格式总是一致的。
+    """
+    data = marshal.dumps(message)
+    header = struct.pack("!I", len(data))
+    if len(fds) > 0:
+        import array
+        import _socket
+        sock.sendmsg([header], [(_socket.SOL_SOCKET, _socket.SCM_RIGHTS, array.array("i", fds))])
+    else:
+        sock.sendall(header)
+    sock.sendall(data)
+
+
+def recv_message(sock, maxfds: int = 0):
+    """
+    :return: (message, fds)
+    """
+    if maxfds > 0:
+        import socket
+        header, fds, _, _ = socket.recv_fds(sock, 4, maxfds)
+    else:
+        header, fds = sock.recv(4), []
+    header += recv_exactly(sock, 4 - len(header))
+    return marshal.loads(recv_exactly(sock, struct.unpack("!I", header)[0])), fds
+
+
+def recv_exactly(sock, size: int):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if len(chunk) == 0:
+            raise ValueError("Connection closed before the message was complete.")
+        data += chunk
+    return data
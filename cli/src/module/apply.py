@@ -1,14 +1,59 @@
-import yaml
-from schema import Schema, Optional, And, Or
+import array
+import json
+import marshal
+import threading
+import time
+from collections import deque
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from module.server import Server
+from module.entity_cache import EntityCache
+from module.manifest import ApplyManifest
+from module.apply_journal import ApplyJournal
+from module.plan import RemoteState, PlannedId, same_value
+from utils.trace import tracer
+
+
+SOURCE_BATCH_SIZE = 1000
+SOURCE_BATCH_MIN_SIZE = 10
+SOURCE_BATCH_MAX_SIZE = 10000
+SOURCE_BATCH_MAX_BYTES = 4 * 1024 * 1024
+SOURCE_BATCH_TARGET_SECONDS = 2.0
+
+_end_of_docs = object()
 
 
 class Applier:
-    def __init__(self, server: Server):
+    def __init__(self, server: Server, stream: bool = False, concurrency: int = 1, entity_cache: EntityCache = None, manifest: ApplyManifest = None,
+                 diff: bool = False, dry_run: bool = False, journal: ApplyJournal = None):
+        """
+        :param concurrency: submit时并发请求的数量上限
+        :param entity_cache: 元数据项的id缓存。命中缓存的项会直接PATCH，省去POST失败后再查询id的请求
+        :param manifest: 已应用内容的hash记录。内容未变更的数据项会被跳过，不再提交
+        :param stream: 流式模式。此模式下，source数据每攒满一批就立刻在后台提交，与后续文档的解析同时进行，而不是全部留到submit()；
+                       setting也会在读到时立刻提交，因此setting文档需要位于依赖它的source文档之前。使用前必须确保server可用。
+        :param diff: 差异模式。submit时先拉取server上已有的setting与元数据，在本地比较后，对已有项只PATCH有变化的字段，无变化的项不发出任何写请求
+        :param dry_run: 只生成计划(见plan属性)而不做任何写入，source也不会被提交。需要同时开启diff，且不能与stream同时使用
+        :param journal: 断点日志。提交成功的source与元数据项会被记录；日志中已记录的项不再提交，元数据项直接使用记录的id
+        """
         self.__server = server
-        self.__doc = []
+        self.__stream = stream
+        self.__concurrency = concurrency
+        self.__entity_cache = entity_cache
+        self.__manifest = manifest
+        self.__journal = journal
+        self.__remote = RemoteState(server) if diff or dry_run else None
+        self.__dry_run = dry_run
+        self.__plan = []
+        self.__source_executor = None
+        self.__source_futures = []
+        self.__source_batch = SourceBatchSizer()
+        self.__statistic_lock = threading.Lock()
         self.__applied_setting = {}
         self.__applied_source = []
+        # 与applied_source一一对应，记录每一项在输入中的序号，供断点日志使用
+        self.__applied_source_ordinals = array.array("q")
+        self.__source_count = 0
         self.__applied_annotations = []
         self.__applied_authors = []
         self.__applied_topics = []
@@ -16,42 +61,88 @@ class Applier:
         self.__submit_errors = []
         self.__created = {}
         self.__updated = {}
+        self.__unchanged = {}
+        self.__resumed = {}
 
-    def apply(self, doc: str):
-        for doc in [i for i in yaml.safe_load_all(doc)]:
-            if not isinstance(doc, dict):
-                raise Exception("Yaml document must be a dict{}.")
-            doc_kind = doc.get('kind', None)
-            doc_version = doc.get('version', 'v1')
-            doc_content = doc.get('spec', None)
-            if doc_kind is None:
-                raise Exception("Yaml document must have field 'kind'.")
-            if doc_content is None:
-                raise Exception("Yaml document must have field 'spec'.")
-
-            if doc_kind == 'setting':
-                self.__apply_setting(doc_content, doc_version)
-            elif doc_kind == 'source':
-                self.__apply_source(doc_content, doc_version)
-            elif doc_kind == 'annotation':
-                self.__apply_annotation(doc_content, doc_version)
-            elif doc_kind == 'topic':
-                self.__apply_topic(doc_content, doc_version)
-            elif doc_kind == 'author':
-                self.__apply_author(doc_content, doc_version)
-            elif doc_kind == 'tag':
-                self.__apply_tag(doc_content, doc_version)
-            else:
-                raise Exception("Document kind '%s' is invalid." % (doc_kind,))
+    def apply(self, doc, name: str = None):
+        """
+        解析并应用yaml内容。
+        :param doc: yaml字符串或文本流。文档会被逐个解析，不需要预先读入全部内容
+        :param name: 内容的来源，例如文件名，用于错误信息
+        """
+        for (kind, version, spec) in iter_documents(doc, "yaml", name):
+            self.apply_validated(kind, version, spec)
+
+    def apply_ndjson(self, stream, name: str = None):
+        """
+        解析并应用ndjson内容，每行是一个与yaml文档结构相同的json对象。
+        :param stream: 文本流或行的迭代器
+        """
+        for (kind, version, spec) in iter_documents(stream, "ndjson", name):
+            self.apply_validated(kind, version, spec)
+
+    def apply_validated(self, kind: str, version: str, spec):
+        """
+        应用一个已通过校验的文档，例如parse_files()的结果。
+        """
+        with tracer.span("apply %s" % (kind,), "apply", items=len(spec)):
+            if kind == 'setting':
+                self.__apply_setting(spec, version)
+            elif kind == 'source':
+                self.__apply_source(spec, version)
+            elif kind == 'annotation':
+                self.__applied_annotations += spec
+            elif kind == 'topic':
+                self.__applied_topics += spec
+            elif kind == 'author':
+                self.__applied_authors += spec
+            elif kind == 'tag':
+                self.__applied_tags += spec
 
     def submit(self):
+        """
+        提交所有已应用的内容。按依赖关系分阶段并发执行：
+        1. setting，因为source依赖其中的site定义；
+        2. source与annotation，两者互不依赖；
+        3. author、topic、tag，它们通过名称引用annotation，且mapping source tag时会与source争用相同的source tag。
+        同一阶段中的项并发提交。topic与tag的子节点在父节点的id确定后才提交；tag的同级节点仍按顺序提交，以保持其ordinal。
+        """
         if len(self.__applied_setting) > 0:
-            self.__submit_setting()
-        self.__submit_source()
-        self.__submit_annotation()
-        self.__submit_author()
-        self.__submit_topic()
-        self.__submit_tag()
+            with tracer.span("submit setting", "apply"):
+                self.__submit_setting()
+        if self.__remote is not None:
+            with tracer.span("load remote state", "apply"):
+                for (kind, applied) in (('annotation', self.__applied_annotations), ('author', self.__applied_authors),
+                                        ('topic', self.__applied_topics), ('tag', self.__applied_tags)):
+                    if len(applied) > 0:
+                        self.__remote.load(kind)
+        self.__server.http_client.set_pool_size(self.__concurrency)
+        with ThreadPoolExecutor(max_workers=self.__concurrency) as executor:
+            with tracer.span("submit source & annotation", "apply"):
+                source_group = TaskGroup(executor)
+                if self.__dry_run:
+                    if len(self.__applied_source) > 0:
+                        self.__set_count_statistic('source', updated=True, count=len(self.__applied_source))
+                elif self.__stream:
+                    source_group.submit(self.__flush_source, True)
+                else:
+                    source_group.submit(self.__submit_source)
+                annotation_group = TaskGroup(executor)
+                self.__submit_annotation(annotation_group)
+                annotation_group.wait()
+                source_group.wait()
+            meta_group = TaskGroup(executor)
+            try:
+                with tracer.span("submit author & topic & tag", "apply"):
+                    self.__submit_author(meta_group)
+                    self.__submit_topic(meta_group)
+                    self.__submit_tag(meta_group)
+                    meta_group.wait()
+            finally:
+                if self.__entity_cache is not None:
+                    self.__entity_cache.save()
+                if self.__manifest is not None:
+                    self.__manifest.save()
 
     @property
     def submit_errors(self):
@@ -65,57 +156,84 @@ class Applier:
     def updated(self):
         return self.__updated
 
+    @property
+    def unchanged(self):
+        return self.__unchanged
+
+    @property
+    def resumed(self):
+        """
+        因断点日志中已记录完成而跳过的项的数量。
+        """
+        return self.__resumed
+
+    @property
+    def plan(self):
+        """
+        差异模式下需要新建或修改的项。
+        :return: [("create"|"update", kind, name, 有变化的字段名列表)]
+        """
+        return self.__plan
+
     def __apply_setting(self, doc, ver):
-        setting_schema.validate(doc)
         for (k, v) in doc.items():
             if k not in self.__applied_setting:
                 self.__applied_setting[k] = v
             else:
                 for (s_k, s_v) in v.items():
-                    self.__applied_setting[k][s_k] = v
+                    if k == 'source' and s_k == 'sites' and 'sites' in self.__applied_setting[k]:
+                        # 每个文件可以各自声明它所用的site
+                        self.__applied_setting[k][s_k] = self.__applied_setting[k][s_k] + s_v
+                    else:
+                        self.__applied_setting[k][s_k] = s_v
+        if self.__stream:
+            self.__submit_setting()
+            self.__applied_setting = {}
 
     def __apply_source(self, doc, ver):
-        source_schema.validate(doc)
-        self.__applied_source += doc
-
-    def __apply_annotation(self, doc, ver):
-        annotation_schema.validate(doc)
-        self.__applied_annotations += doc
-
-    def __apply_topic(self, doc, ver):
-        topic_schema.validate(doc)
-        self.__applied_topics += doc
-
-    def __apply_author(self, doc, ver):
-        author_schema.validate(doc)
-        self.__applied_authors += doc
-
-    def __apply_tag(self, doc, ver):
-        tag_schema.validate(doc)
-        self.__applied_tags += doc
+        # 序号在过滤之前分配，因此只与输入内容有关
+        ordinals = range(self.__source_count, self.__source_count + len(doc))
+        self.__source_count += len(doc)
+        if self.__journal is not None:
+            pending = [(o, i) for (o, i) in zip(ordinals, doc) if not self.__journal.is_source_done(o)]
+            if len(pending) < len(doc):
+                self.__set_count_statistic('source', resumed=True, count=len(doc) - len(pending))
+        else:
+            pending = list(zip(ordinals, doc))
+        if self.__manifest is not None:
+            changed = [(o, i) for (o, i) in pending if not self.__manifest.check_entity(self.__source_key(i), i)[0]]
+            if len(changed) < len(pending):
+                self.__set_count_statistic('source', unchanged=True, count=len(pending) - len(changed))
+            pending = changed
+        self.__applied_source += [i for (_, i) in pending]
+        self.__applied_source_ordinals.extend(o for (o, _) in pending)
+        if self.__stream:
+            self.__flush_source()
 
     def __submit_setting(self):
-        if 'meta' in self.__applied_setting:
-            ok, data = self.__server.http_client.req('PATCH', '/api/setting/meta', body=self.__applied_setting['meta'])
-            if not ok:
-                self.__submit_errors.append(('setting', None, data['message']))
-            else:
-                self.__set_count_statistic('setting', updated=True, count=len(self.__applied_setting['meta']))
-        if 'import' in self.__applied_setting:
-            ok, data = self.__server.http_client.req('PATCH', '/api/setting/import', body=self.__applied_setting['import'])
-            if not ok:
-                self.__submit_errors.append(('setting', None, data['message']))
-            else:
-                self.__set_count_statistic('setting', updated=True, count=len(self.__applied_setting['import']))
-        if 'query' in self.__applied_setting:
-            ok, data = self.__server.http_client.req('PATCH', '/api/setting/query', body=self.__applied_setting['query'])
-            if not ok:
-                self.__submit_errors.append(('setting', None, data['message']))
-            else:
-                self.__set_count_statistic('setting', updated=True, count=len(self.__applied_setting['query']))
+        if self.__remote is not None:
+            self.__submit_setting_diff()
+            return
+        for key in ('meta', 'import', 'query'):
+            if key in self.__applied_setting:
+                body = self.__applied_setting[key]
+                unchanged, digest = self.__check_unchanged('setting:%s' % (key,), body)
+                if unchanged:
+                    self.__set_count_statistic('setting', unchanged=True, count=len(body))
+                    continue
+                ok, data = self.__server.http_client.req('PATCH', '/api/setting/%s' % (key,), body=body)
+                if not ok:
+                    self.__submit_errors.append(('setting', None, data['message']))
+                else:
+                    self.__set_count_statistic('setting', updated=True, count=len(body))
+                    self.__record_digest('setting:%s' % (key,), digest)
         if 'source' in self.__applied_setting and 'sites' in self.__applied_setting['source']:
             sites = self.__applied_setting['source']['sites']
             for site in sites:
+                unchanged, digest = self.__check_unchanged('setting:site:%s' % (site['name'],), site)
+                if unchanged:
+                    self.__set_count_statistic('setting', unchanged=True, count=1)
+                    continue
                 ok, data = self.__server.http_client.req('POST', '/api/setting/source/sites', body=site)
                 if not ok:
                     if data['code'] == 'ALREADY_EXISTS':
@@ -124,48 +242,169 @@ class Applier:
                             self.__submit_errors.append(('setting', site['name'], data['message']))
                         else:
                             self.__set_count_statistic('setting', updated=True, count=1)
+                            self.__record_digest('setting:site:%s' % (site['name'],), digest)
                     else:
                         self.__submit_errors.append(('setting', site['name'], data['message']))
                 else:
                     self.__set_count_statistic('setting', updated=False, count=1)
+                    self.__record_digest('setting:site:%s' % (site['name'],), digest)
+
+    def __submit_setting_diff(self):
+        for key in ('meta', 'import', 'query'):
+            if key in self.__applied_setting:
+                body = self.__applied_setting[key]
+                remote = self.__remote.get_setting('/api/setting/%s' % (key,))
+                changed = {k: v for (k, v) in body.items() if not same_value(v, remote.get(k, None))}
+                if len(changed) < len(body):
+                    self.__set_count_statistic('setting', unchanged=True, count=len(body) - len(changed))
+                if len(changed) == 0:
+                    self.__record_digest('setting:%s' % (key,), self.__check_unchanged('setting:%s' % (key,), body)[1])
+                    continue
+                self.__plan.append(('update', 'setting', key, list(changed.keys())))
+                if self.__dry_run:
+                    self.__set_count_statistic('setting', updated=True, count=len(changed))
+                    continue
+                ok, data = self.__server.http_client.req('PATCH', '/api/setting/%s' % (key,), body=changed)
+                if not ok:
+                    self.__submit_errors.append(('setting', None, data['message']))
+                else:
+                    self.__set_count_statistic('setting', updated=True, count=len(changed))
+                    self.__record_digest('setting:%s' % (key,), self.__check_unchanged('setting:%s' % (key,), body)[1])
+        if 'source' in self.__applied_setting and 'sites' in self.__applied_setting['source']:
+            remote_sites = {i['name']: i for i in self.__remote.get_setting('/api/setting/source/sites')}
+            for site in self.__applied_setting['source']['sites']:
+                digest = self.__check_unchanged('setting:site:%s' % (site['name'],), site)[1]
+                remote = remote_sites.get(site['name'], None)
+                if remote is None:
+                    self.__plan.append(('create', 'setting', 'site:%s' % (site['name'],), []))
+                    if self.__dry_run:
+                        self.__set_count_statistic('setting', count=1)
+                        continue
+                    ok, data = self.__server.http_client.req('POST', '/api/setting/source/sites', body=site)
+                    updated = False
+                else:
+                    changed = {k: v for (k, v) in site.items() if k != 'name' and not same_value(v, remote.get(k, None))}
+                    if len(changed) == 0:
+                        self.__set_count_statistic('setting', unchanged=True, count=1)
+                        self.__record_digest('setting:site:%s' % (site['name'],), digest)
+                        continue
+                    self.__plan.append(('update', 'setting', 'site:%s' % (site['name'],), list(changed.keys())))
+                    if self.__dry_run:
+                        self.__set_count_statistic('setting', updated=True, count=1)
+                        continue
+                    ok, data = self.__server.http_client.req('PUT', '/api/setting/source/sites/%s' % (site['name']), body=changed)
+                    updated = True
+                if not ok:
+                    self.__submit_errors.append(('setting', site['name'], data['message']))
+                else:
+                    self.__set_count_statistic('setting', updated=updated, count=1)
+                    self.__record_digest('setting:site:%s' % (site['name'],), digest)
 
     def __submit_source(self):
-        length = len(self.__applied_source)
-        for i in range(0, length, 1000):
-            data = self.__applied_source[i:i + 1000]
-            ok, data = self.__server.http_client.req('POST', '/api/source-images/bulk', body={"items": data})
-            if not ok:
-                self.submit_errors.append(('source', None, data['message']))
-            else:
-                self.__set_count_statistic('source', updated=True, count=len(data))
+        i = 0
+        while i < len(self.__applied_source):
+            size = self.__source_batch.size(self.__applied_source, i)
+            self.__submit_source_chunk(self.__applied_source[i:i + size], self.__applied_source_ordinals[i:i + size])
+            i += size
+
+    def __flush_source(self, final=False):
+        """
+        流式模式下，将已攒满的source批次交给后台线程提交。后台最多积压2个批次，超出时阻塞解析以限制内存占用。
+        :param final: 提交剩余的不满一批的数据，并等待全部批次完成
+        """
+        if self.__source_executor is None:
+            self.__source_executor = ThreadPoolExecutor(max_workers=1)
+        while len(self.__applied_source) > 0:
+            size = self.__source_batch.size(self.__applied_source)
+            if len(self.__applied_source) < size and not final:
+                break
+            chunk = self.__applied_source[:size]
+            chunk_ordinals = self.__applied_source_ordinals[:size]
+            self.__applied_source = self.__applied_source[size:]
+            self.__applied_source_ordinals = self.__applied_source_ordinals[size:]
+            self.__source_futures.append(self.__source_executor.submit(self.__submit_source_chunk, chunk, chunk_ordinals))
+            if len(self.__source_futures) > 2:
+                self.__source_futures.pop(0).result()
+        if final:
+            for future in self.__source_futures:
+                future.result()
+            self.__source_futures = []
+            self.__source_executor.shutdown()
+            self.__source_executor = None
 
-    def __submit_annotation(self):
+    def __submit_source_chunk(self, items, ordinals, retry: bool = True):
+        """
+        提交一批source。server拒绝了批次中的数据项时二分重试，最终只有确实出错的单项会被记录为错误，其余项仍会被提交。
+        连接失败或超时与数据项无关，二分只会对不可用的server发出成倍的请求，且每个都可能等到超时。
+        因此这种批次只拆为两半各重试一次，仍然失败时整批记录为一个错误。
+        bulk API对source是upsert语义，因此重试已部分生效的批次是安全的。
+        :param retry: 连接失败或超时时是否还可以重试
+        """
+        import requests
+        start = time.perf_counter()
+        try:
+            ok, data = self.__server.http_client.req('POST', '/api/source-images/bulk', body={"items": items})
+            transport_failed = not ok and data is None
+            message = None if ok else data['message'] if data is not None else 'Unknown error.'
+        except requests.RequestException as e:
+            ok, message, transport_failed = False, str(e), True
+        self.__source_batch.feedback(len(items), time.perf_counter() - start, ok, transport_failed)
+        if ok:
+            self.__set_count_statistic('source', updated=True, count=len(items))
+            if self.__journal is not None:
+                self.__journal.add_sources(ordinals)
+            if self.__manifest is not None:
+                for item in items:
+                    self.__record_digest(self.__source_key(item), self.__manifest.check_entity(self.__source_key(item), item)[1])
+        elif transport_failed and retry:
+            mid = max(1, len(items) // 2)
+            self.__submit_source_chunk(items[:mid], ordinals[:mid], retry=False)
+            if mid < len(items):
+                self.__submit_source_chunk(items[mid:], ordinals[mid:], retry=False)
+        elif transport_failed or len(items) == 1:
+            self.__submit_errors.append(('source', self.__source_range_name(items), message))
+        else:
+            mid = len(items) // 2
+            self.__submit_source_chunk(items[:mid], ordinals[:mid], retry)
+            self.__submit_source_chunk(items[mid:], ordinals[mid:], retry)
+
+    @staticmethod
+    def __source_range_name(items):
+        first = '%s:%s' % (items[0]['source'], items[0]['sourceId'])
+        if len(items) == 1:
+            return first
+        return '%s ~ %s:%s (%s items)' % (first, items[-1]['source'], items[-1]['sourceId'], len(items))
+
+    def __submit_annotation(self, group):
         for annotation in self.__applied_annotations:
-            self.__submit_rest_object(annotation, '/api/annotations', 'annotation', annotation['name'], detail_id=lambda a: {'name': annotation['name']})
+            group.submit(self.__submit_rest_object, annotation, '/api/annotations', 'annotation', annotation['name'],
+                         lambda a: {'name': a['name']})
 
-    def __submit_author(self):
+    def __submit_author(self, group):
         for author in self.__applied_authors:
-            self.__submit_rest_object(author, '/api/authors', 'author', author['name'],
-                                      detail_id=lambda a: {'query': "`%s`" % (author['name'],)})
+            group.submit(self.__submit_rest_object, author, '/api/authors', 'author', author['name'],
+                         lambda a: {'query': "`%s`" % (a['name'],)})
 
-    def __submit_topic(self):
-        def recursive(items, parent_id=None):
-            for topic in items:
-                body = {}
-                for k, v in topic.items():
-                    if k != 'children':
-                        body[k] = v
-                if parent_id is not None:
-                    body['parentId'] = parent_id
-                this_id = self.__submit_rest_object(body, '/api/topics', 'topic', topic['name'],
-                                                    detail_id=lambda a: {'query': "`%s`" % (topic['name'],), 'parentId': parent_id})
-                if 'children' in topic:
-                    recursive(topic['children'], this_id)
+    def __submit_topic(self, group):
+        def submit_node(topic, parent_id):
+            body = {}
+            for k, v in topic.items():
+                if k != 'children':
+                    body[k] = v
+            if parent_id is not None:
+                body['parentId'] = parent_id
+            this_id = self.__submit_rest_object(body, '/api/topics', 'topic', topic['name'],
+                                                detail_id=lambda a: {'query': "`%s`" % (a['name'],), 'parentId': parent_id},
+                                                need_id='children' in topic)
+            if 'children' in topic:
+                for child in topic['children']:
+                    group.submit(submit_node, child, this_id)
 
-        recursive(self.__applied_topics)
+        for root in self.__applied_topics:
+            group.submit(submit_node, root, None)
 
-    def __submit_tag(self):
-        def recursive(items, parent_id=None):
+    def __submit_tag(self, group):
+        def submit_siblings(items, parent_id):
             for tag in items:
                 body = {}
                 for k, v in tag.items():
@@ -177,12 +416,52 @@ class Applier:
                     elif k != 'children':
                         body[k] = v
                 body['parentId'] = parent_id
-                this_id = self.__submit_rest_object(body, '/api/tags', 'tag', tag['name'], detail_id=lambda a: {'search': tag['name'], 'parent': parent_id})
+                this_id = self.__submit_rest_object(body, '/api/tags', 'tag', tag['name'], detail_id=lambda a: {'search': a['name'], 'parent': parent_id},
+                                                    need_id='children' in tag)
                 if 'children' in tag:
-                    recursive(tag['children'], this_id)
-        recursive(self.__applied_tags)
+                    group.submit(submit_siblings, tag['children'], this_id)
+
+        if len(self.__applied_tags) > 0:
+            group.submit(submit_siblings, self.__applied_tags, None)
+
+    def __submit_rest_object(self, item, api_path, kind, item_key, detail_id=None, need_id=False):
+        """
+        :param need_id: 调用方需要此项的id。此时内容未变更的项也只有在id已被缓存时才能跳过
+        """
+        parent_id = item.get('parentId', None)
+        if self.__journal is not None:
+            journal_id = self.__journal.get_entity(kind, item_key, parent_id)
+            if journal_id is not None:
+                self.__set_count_statistic(kind, resumed=True, count=1)
+                return journal_id
+        if self.__remote is not None:
+            remote = self.__remote.find(kind, item_key, parent_id)
+            if remote is not None:
+                return self.__submit_rest_object_diff(item, api_path, kind, item_key, remote)
+            if self.__dry_run:
+                self.__plan.append(('create', kind, item_key, []))
+                self.__set_count_statistic(kind, count=1)
+                return PlannedId()
+        cached_id = self.__entity_cache.get(kind, item_key, parent_id) if self.__entity_cache is not None else None
+        manifest_key = '%s:%s:%s' % (kind, parent_id if parent_id is not None else '', item_key)
+        unchanged, digest = self.__check_unchanged(manifest_key, item)
+        if unchanged and (cached_id is not None or not need_id):
+            self.__set_count_statistic(kind, unchanged=True, count=1)
+            return cached_id
+
+        if cached_id is not None:
+            ok, data = self.__server.http_client.req('PATCH', '%s/%s' % (api_path, cached_id), body=item)
+            if ok:
+                self.__set_count_statistic(kind, updated=True, count=1)
+                self.__record_digest(manifest_key, digest)
+                return cached_id
+            elif data is not None and data.get('code') == 'NOT_FOUND':
+                # 缓存的项已不存在，使缓存失效，并按未缓存的流程重新提交
+                self.__entity_cache.remove(kind, item_key, parent_id)
+            else:
+                self.__submit_errors.append((kind, item_key, data['message']))
+                return None
 
-    def __submit_rest_object(self, item, api_path, kind, item_key, detail_id=None):
         ok, data = self.__server.http_client.req('POST', api_path, body=item)
         if not ok:
             if data['code'] == 'ALREADY_EXISTS':
@@ -206,149 +485,407 @@ class Applier:
                     return None
                 else:
                     self.__set_count_statistic(kind, updated=True, count=1)
+                    self.__cache_entity(kind, item_key, parent_id, detail_id)
+                    self.__record_digest(manifest_key, digest)
                     return detail_id
             else:
                 self.__submit_errors.append((kind, item_key, data['message']))
                 return None
         else:
             self.__set_count_statistic(kind, updated=False, count=1)
-            return data['id'] if data is not None else None
+            this_id = data['id'] if data is not None else None
+            self.__cache_entity(kind, item_key, parent_id, this_id)
+            self.__record_digest(manifest_key, digest)
+            return this_id
 
-    def __set_count_statistic(self, key, updated, count):
-        if updated:
-            if key in self.__updated:
-                self.__updated[key] = self.__updated[key] + count
-            else:
-                self.__updated[key] = count
+    def __submit_rest_object_diff(self, item, api_path, kind, item_key, remote):
+        """
+        差异模式下提交server上已存在的项。只PATCH有变化的字段。
+        """
+        parent_id = item.get('parentId', None)
+        manifest_key = '%s:%s:%s' % (kind, parent_id if parent_id is not None else '', item_key)
+        digest = self.__check_unchanged(manifest_key, item)[1]
+        try:
+            changed = self.__remote.diff(kind, item, remote)
+        except Exception as e:
+            self.__submit_errors.append((kind, item_key, str(e)))
+            return None
+        if len(changed) == 0:
+            self.__set_count_statistic(kind, unchanged=True, count=1)
         else:
-            if key in self.__created:
-                self.__created[key] = self.__created[key] + count
+            self.__plan.append(('update', kind, item_key, list(changed.keys())))
+            if self.__dry_run:
+                self.__set_count_statistic(kind, updated=True, count=1)
+                return remote['id']
+            ok, data = self.__server.http_client.req('PATCH', '%s/%s' % (api_path, remote['id']), body=changed)
+            if not ok:
+                self.__submit_errors.append((kind, item_key, data['message']))
+                return None
+            self.__set_count_statistic(kind, updated=True, count=1)
+        self.__cache_entity(kind, item_key, parent_id, remote['id'])
+        self.__record_digest(manifest_key, digest)
+        return remote['id']
+
+    def __check_unchanged(self, key, item):
+        if self.__manifest is None:
+            return False, None
+        return self.__manifest.check_entity(key, item)
+
+    def __record_digest(self, key, digest):
+        if self.__manifest is not None:
+            self.__manifest.set_entity(key, digest)
+
+    @staticmethod
+    def __source_key(item):
+        return 'source:%s:%s' % (item['source'], item['sourceId'])
+
+    def __cache_entity(self, kind, item_key, parent_id, entity_id):
+        if isinstance(entity_id, int):
+            if self.__entity_cache is not None:
+                self.__entity_cache.set(kind, item_key, parent_id, entity_id)
+            if self.__journal is not None:
+                self.__journal.add_entity(kind, item_key, parent_id, entity_id)
+
+    def __set_count_statistic(self, key, count, updated=False, unchanged=False, resumed=False):
+        with self.__statistic_lock:
+            if resumed:
+                self.__resumed[key] = self.__resumed.get(key, 0) + count
+            elif unchanged:
+                self.__unchanged[key] = self.__unchanged.get(key, 0) + count
+            elif updated:
+                if key in self.__updated:
+                    self.__updated[key] = self.__updated[key] + count
+                else:
+                    self.__updated[key] = count
             else:
-                self.__created[key] = count
+                if key in self.__created:
+                    self.__created[key] = self.__created[key] + count
+                else:
+                    self.__created[key] = count
 
 
-setting_schema = Schema({
-    Optional('meta'): {
-        Optional('scoreDescriptions'): [{
-            'word': str,
-            'content': str
-        }],
-        Optional('autoCleanTagme'): bool,
-        Optional('topicColors'): {
-            Optional('UNKNOWN'): str,
-            Optional('COPYRIGHT'): str,
-            Optional('WORK'): str,
-            Optional('CHARACTER'): str,
+class TaskGroup:
+    """
+    在共享的线程池中追踪一组任务。任务可以在执行中继续向同一组提交子任务，wait()会等待包括子任务在内的全部任务完成。
+    任务之间不会互相阻塞等待，因此即使线程池只有1个线程也不会死锁。
+    """
+    def __init__(self, executor: ThreadPoolExecutor):
+        self.__executor = executor
+        self.__pending = 0
+        self.__exceptions = []
+        self.__condition = threading.Condition()
+
+    def submit(self, fn, *args):
+        with self.__condition:
+            self.__pending += 1
+        self.__executor.submit(self.__run, fn, args)
+
+    def wait(self):
+        """
+        等待全部任务完成。如果有任务抛出了异常，重新抛出第一个异常。
+        """
+        with self.__condition:
+            while self.__pending > 0:
+                self.__condition.wait()
+            if len(self.__exceptions) > 0:
+                raise self.__exceptions[0]
+
+    def __run(self, fn, args):
+        try:
+            fn(*args)
+        except BaseException as e:
+            with self.__condition:
+                self.__exceptions.append(e)
+        finally:
+            with self.__condition:
+                self.__pending -= 1
+                if self.__pending == 0:
+                    self.__condition.notify_all()
+
+
+class SourceBatchSizer:
+    """
+    根据payload字节数和server的响应耗时，调整source bulk提交的批次大小。
+    批次的字节数被限制在SOURCE_BATCH_MAX_BYTES以内；耗时超过目标时按比例缩小批次，远低于目标时逐步放大。
+    """
+    def __init__(self):
+        self.__size = SOURCE_BATCH_SIZE
+        self.__item_bytes = None
+
+    def size(self, items, offset=0):
+        """
+        计算从offset开始的下一个批次的大小。会抽样估计每一项的字节数。
+        """
+        sample = items[offset:offset + 20]
+        if len(sample) > 0:
+            item_bytes = len(json.dumps(sample)) / len(sample)
+            self.__item_bytes = item_bytes if self.__item_bytes is None else (self.__item_bytes + item_bytes) / 2
+        size = self.__size
+        if self.__item_bytes is not None:
+            size = min(size, int(SOURCE_BATCH_MAX_BYTES / self.__item_bytes))
+        return max(SOURCE_BATCH_MIN_SIZE, size)
+
+    def feedback(self, count: int, seconds: float, ok: bool, transport_failed: bool):
+        """
+        记录一次提交的结果。因数据项本身错误而失败的批次不影响批次大小；连接失败或超时会使批次减半。
+        """
+        if transport_failed:
+            self.__size = max(SOURCE_BATCH_MIN_SIZE, count // 2)
+        elif ok and seconds > SOURCE_BATCH_TARGET_SECONDS:
+            self.__size = max(SOURCE_BATCH_MIN_SIZE, int(count * SOURCE_BATCH_TARGET_SECONDS / seconds))
+        elif ok and seconds < SOURCE_BATCH_TARGET_SECONDS / 2 and count >= self.__size:
+            self.__size = min(SOURCE_BATCH_MAX_SIZE, int(self.__size * 1.5))
+
+
+def iter_documents(stream, fmt: str = "yaml", name: str = None):
+    """
+    逐个解析并校验文档。
+    :param stream: 字符串或文本流
+    :param fmt: yaml或ndjson。ndjson的每一行是一个文档
+    :param name: 内容的来源，例如文件名。出错时与文档的序号一起写入错误信息
+    :return: 产出(kind, version, spec)的迭代器
+    """
+    if fmt == "ndjson":
+        # 空行不是文档，但序号仍按行计算，使错误信息中的序号就是行号
+        docs = (json.loads(line) if len(line.strip()) > 0 else None for line in (stream.splitlines() if isinstance(stream, str) else stream))
+    else:
+        import yaml
+        try:
+            from yaml import CSafeLoader as SafeLoader
+        except ImportError:
+            from yaml import SafeLoader
+        docs = yaml.load_all(stream, Loader=SafeLoader)
+    index = 0
+    while True:
+        index += 1
+        try:
+            with tracer.span("parse", "apply"):
+                doc = next(docs, _end_of_docs)
+            if doc is _end_of_docs:
+                return
+            if doc is None and fmt == "ndjson":
+                continue
+            result = validate_document(doc)
+        except Exception as e:
+            raise Exception("%s, %s %s: %s" % (name or "<input>", "line" if fmt == "ndjson" else "document", index, e))
+        yield result
+
+
+def validate_document(doc):
+    """
+    :return: (kind, version, spec)
+    """
+    if not isinstance(doc, dict):
+        raise Exception("Yaml document must be a dict{}.")
+    doc_kind = doc.get('kind', None)
+    doc_version = doc.get('version', 'v1')
+    doc_content = doc.get('spec', None)
+    if doc_kind is None:
+        raise Exception("Yaml document must have field 'kind'.")
+    if doc_content is None:
+        raise Exception("Yaml document must have field 'spec'.")
+    if doc_kind not in DOCUMENT_SCHEMAS:
+        raise Exception("Document kind '%s' is invalid." % (doc_kind,))
+    with tracer.span("validate %s" % (doc_kind,), "apply", items=len(doc_content)):
+        DOCUMENT_SCHEMAS[doc_kind]().validate(doc_content)
+    return doc_kind, doc_version, doc_content
+
+
+def parse_files(filepaths, jobs: int):
+    """
+    在进程池中并发地解析并校验多个文件，按filepaths的顺序产出每个文件的文档列表[(kind, version, spec)]。
+    子进程只传回校验通过的文档，以marshal编码，比pickle更紧凑，解码也更快。合并与提交仍在调用方按文件顺序进行，因此结果与逐个解析时完全相同。
+    同时在处理中的文件不超过进程数的两倍，已解析而未被取走的结果不会无限堆积。
+    子进程以fork创建，调用时本进程中不能有其他线程在运行，否则子进程可能继承其他线程持有的锁而卡死。
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    # 使用fork，子进程直接继承已加载的模块，不需要重新import
+    executor = ProcessPoolExecutor(max_workers=min(jobs, len(filepaths)), mp_context=multiprocessing.get_context("fork"))
+    try:
+        window = deque()
+        for filepath in filepaths:
+            window.append(executor.submit(parse_file, filepath))
+            if len(window) >= jobs * 2:
+                yield receive_parsed(window.popleft())
+        while len(window) > 0:
+            yield receive_parsed(window.popleft())
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def parse_file(filepath: str):
+    """
+    解析并校验一个文件。在parse_files()的子进程中执行。
+    :return: marshal编码的文档列表
+    """
+    with open(filepath) as f:
+        return marshal.dumps(list(iter_documents(f, "ndjson" if filepath.endswith(".ndjson") else "yaml", filepath)))
+
+
+def receive_parsed(future):
+    with tracer.span("wait parse", "apply"):
+        data = future.result()
+    with tracer.span("decode", "apply", bytes=len(data)):
+        return marshal.loads(data)
+
+
+@functools.cache
+def get_setting_schema():
+    from schema import Schema, Optional, And
+    from utils.fast_schema import CompiledSchema
+    return CompiledSchema(Schema({
+        Optional('meta'): {
+            Optional('scoreDescriptions'): [{
+                'word': str,
+                'content': str
+            }],
+            Optional('autoCleanTagme'): bool,
+            Optional('topicColors'): {
+                Optional('UNKNOWN'): str,
+                Optional('COPYRIGHT'): str,
+                Optional('WORK'): str,
+                Optional('CHARACTER'): str,
+            },
+            Optional('authorColors'): {
+                Optional('UNKNOWN'): str,
+                Optional('ARTIST'): str,
+                Optional('STUDIO'): str,
+                Optional('PUBLISH'): str,
+            },
+        },
+        Optional('import'): {
+            Optional('autoAnalyseMeta'): bool,
+            Optional('setTagmeOfTag'): bool,
+            Optional('setTagmeOfSource'): bool,
+            Optional('setTimeBy'): And(str, lambda s: s in ('UPDATE_TIME', 'CREATE_TIME', 'IMPORT_TIME')),
+            Optional('setPartitionTimeDelay'): int,
+            Optional('sourceAnalyseRules'): [{
+                'type': And(str, lambda s: s in ('name', 'from-meta')),
+                'site': And(str, lambda s: len(s) > 0),
+                'regex': And(str, lambda s: len(s) > 0),
+                'idIndex': And(int, lambda i: i >= 0),
+                Optional('secondaryIdIndex'): And(int, lambda i: i >= 0)
+            }],
         },
-        Optional('authorColors'): {
-            Optional('UNKNOWN'): str,
-            Optional('ARTIST'): str,
-            Optional('STUDIO'): str,
-            Optional('PUBLISH'): str,
+        Optional('query'): {
+            Optional('chineseSymbolReflect'): bool,
+            Optional('translateUnderscoreToSpace'): bool,
+            Optional('queryLimitOfQueryItems'): int,
+            Optional('warningLimitOfUnionItems'): int,
+            Optional('warningLimitOfIntersectItems'): int
         },
-    },
-    Optional('import'): {
-        Optional('autoAnalyseMeta'): bool,
-        Optional('setTagmeOfTag'): bool,
-        Optional('setTagmeOfSource'): bool,
-        Optional('setTimeBy'): And(str, lambda s: s in ('UPDATE_TIME', 'CREATE_TIME', 'IMPORT_TIME')),
-        Optional('setPartitionTimeDelay'): int,
-        Optional('sourceAnalyseRules'): [{
-            'type': And(str, lambda s: s in ('name', 'from-meta')),
-            'site': And(str, lambda s: len(s) > 0),
-            'regex': And(str, lambda s: len(s) > 0),
-            'idIndex': And(int, lambda i: i >= 0),
-            Optional('secondaryIdIndex'): And(int, lambda i: i >= 0)
+        Optional('source'): {
+            Optional('sites'): [{
+                'name': And(str, lambda s: len(s) > 0),
+                Optional('title'): And(str, lambda s: len(s) > 0),
+                Optional('hasSecondaryId'): bool
+            }]
+        }
+    }))
+
+
+@functools.cache
+def get_source_schema():
+    from schema import Schema, Optional, And, Or
+    from utils.fast_schema import CompiledSchema
+    return CompiledSchema(Schema([{
+        'source': And(str, lambda s: len(s) > 0),
+        'sourceId': int,
+        Optional('title'): Or(str, None),
+        Optional('description'): Or(str, None),
+        Optional('tags'): [{
+            'name': And(str, lambda s: len(s) > 0),
+            Optional('displayName'): Or(None, And(str, lambda s: len(s) > 0)),
+            Optional('type'): Or(None, And(str, lambda s: len(s) > 0)),
+        }],
+        Optional('pools'): [{
+            'key': And(str, lambda s: len(s) > 0),
+            'title': str
         }],
-    },
-    Optional('query'): {
-        Optional('chineseSymbolReflect'): bool,
-        Optional('translateUnderscoreToSpace'): bool,
-        Optional('queryLimitOfQueryItems'): int,
-        Optional('warningLimitOfUnionItems'): int,
-        Optional('warningLimitOfIntersectItems'): int
-    },
-    Optional('source'): {
-        Optional('sites'): [{
+        Optional('relations'): [int]
+    }]))
+
+
+@functools.cache
+def get_annotation_schema():
+    from schema import Schema, Optional, And
+    from utils.fast_schema import CompiledSchema
+    return CompiledSchema(Schema([{
+        'name': And(str, lambda s: len(s) > 0),
+        'canBeExported': bool,
+        Optional('target'): [And(str, lambda s: s in ('TAG', 'ARTIST', 'STUDIO', 'PUBLISH', 'COPYRIGHT', 'WORK', 'CHARACTER', 'AUTHOR', 'TOPIC'))]
+    }]))
+
+
+@functools.cache
+def get_author_schema():
+    from schema import Schema, Optional, And, Or
+    from utils.fast_schema import CompiledSchema
+    return CompiledSchema(Schema([{
+        'name': And(str, lambda s: len(s) > 0),
+        Optional('otherNames'): [And(str, lambda s: len(s) > 0)],
+        Optional('type'): And(str, lambda s: s in ('UNKNOWN', 'ARTIST', 'STUDIO', 'PUBLISH')),
+        Optional('description'): str,
+        Optional('keywords'): [str],
+        Optional('links'): [{'title': str, 'link': str}],
+        Optional('favorite'): bool,
+        Optional('score'): And(int, lambda s: 1 <= s <= 10),
+        Optional('annotations'): [Or(str, int)],
+        Optional('mappingSourceTags'): [{
+            'source': str,
             'name': And(str, lambda s: len(s) > 0),
-            Optional('title'): And(str, lambda s: len(s) > 0),
-            Optional('hasSecondaryId'): bool
+            Optional('displayName'): And(str, lambda s: len(s) > 0),
+            Optional('type'): And(str, lambda s: len(s) > 0),
         }]
-    }
-})
-
-source_schema = Schema([{
-    'source': And(str, lambda s: len(s) > 0),
-    'sourceId': int,
-    Optional('title'): Or(str, None),
-    Optional('description'): Or(str, None),
-    Optional('tags'): [{
-        'name': And(str, lambda s: len(s) > 0),
-        Optional('displayName'): Or(None, And(str, lambda s: len(s) > 0)),
-        Optional('type'): Or(None, And(str, lambda s: len(s) > 0)),
-    }],
-    Optional('pools'): [{
-        'key': And(str, lambda s: len(s) > 0),
-        'title': str
-    }],
-    Optional('relations'): [int]
-}])
-
-annotation_schema = Schema([{
-    'name': And(str, lambda s: len(s) > 0),
-    'canBeExported': bool,
-    Optional('target'): [And(str, lambda s: s in ('TAG', 'ARTIST', 'STUDIO', 'PUBLISH', 'COPYRIGHT', 'WORK', 'CHARACTER', 'AUTHOR', 'TOPIC'))]
-}])
-
-author_schema = Schema([{
-    'name': And(str, lambda s: len(s) > 0),
-    Optional('otherNames'): [And(str, lambda s: len(s) > 0)],
-    Optional('type'): And(str, lambda s: s in ('UNKNOWN', 'ARTIST', 'STUDIO', 'PUBLISH')),
-    Optional('description'): str,
-    Optional('keywords'): [str],
-    Optional('links'): [{'title': str, 'link': str}],
-    Optional('favorite'): bool,
-    Optional('score'): And(int, lambda s: 1 <= s <= 10),
-    Optional('annotations'): [Or(str, int)],
-    Optional('mappingSourceTags'): [{
-        'source': str,
+    }]))
+
+
+@functools.cache
+def get_topic_schema():
+    from schema import Schema, Optional, And, Or
+    from utils.fast_schema import CompiledSchema
+    return CompiledSchema(Schema([{
         'name': And(str, lambda s: len(s) > 0),
-        Optional('displayName'): And(str, lambda s: len(s) > 0),
-        Optional('type'): And(str, lambda s: len(s) > 0),
-    }]
-}])
-
-topic_schema = Schema([{
-    'name': And(str, lambda s: len(s) > 0),
-    Optional('otherNames'): [And(str, lambda s: len(s) > 0)],
-    Optional('type'): And(str, lambda s: s in ('UNKNOWN', 'COPYRIGHT', 'WORK', 'CHARACTER')),
-    Optional('description'): str,
-    Optional('keywords'): [str],
-    Optional('links'): [{'title': str, 'link': str}],
-    Optional('favorite'): bool,
-    Optional('score'): And(int, lambda s: 1 <= s <= 10),
-    Optional('annotations'): [Or(str, int)],
-    Optional('mappingSourceTags'): [{
-        'source': str,
+        Optional('otherNames'): [And(str, lambda s: len(s) > 0)],
+        Optional('type'): And(str, lambda s: s in ('UNKNOWN', 'COPYRIGHT', 'WORK', 'CHARACTER')),
+        Optional('description'): str,
+        Optional('keywords'): [str],
+        Optional('links'): [{'title': str, 'link': str}],
+        Optional('favorite'): bool,
+        Optional('score'): And(int, lambda s: 1 <= s <= 10),
+        Optional('annotations'): [Or(str, int)],
+        Optional('mappingSourceTags'): [{
+            'source': str,
+            'name': And(str, lambda s: len(s) > 0),
+            Optional('displayName'): And(str, lambda s: len(s) > 0),
+            Optional('type'): And(str, lambda s: len(s) > 0),
+        }],
+        Optional('children'): lambda child: get_topic_schema().validate(child)
+    }]))
+
+
+@functools.cache
+def get_tag_schema():
+    from schema import Schema, Optional, And, Or
+    from utils.fast_schema import CompiledSchema
+    return CompiledSchema(Schema([{
         'name': And(str, lambda s: len(s) > 0),
-        Optional('displayName'): And(str, lambda s: len(s) > 0),
-        Optional('type'): And(str, lambda s: len(s) > 0),
-    }],
-    Optional('children'): lambda child: topic_schema.validate(child)
-}])
-
-tag_schema = Schema([{
-    'name': And(str, lambda s: len(s) > 0),
-    'type': And(str, lambda s: s in ('TAG', 'ADDR', 'VIRTUAL_ADDR')),
-    Optional('otherNames'): [And(str, lambda s: len(s) > 0)],
-    Optional('group'): Or(bool, {
-        Optional('force'): bool,
-        Optional('sequence'): bool,
-    }),
-    Optional('links'): [Or(int, [str], str)],
-    Optional('annotations'): [Or(str, int)],
-    Optional('description'): str,
-    Optional('color'): str,
-    Optional('examples'): [int],
-    Optional('children'): lambda child: tag_schema.validate(child)
-}])
+        'type': And(str, lambda s: s in ('TAG', 'ADDR', 'VIRTUAL_ADDR')),
+        Optional('otherNames'): [And(str, lambda s: len(s) > 0)],
+        Optional('group'): Or(bool, {
+            Optional('force'): bool,
+            Optional('sequence'): bool,
+        }),
+        Optional('links'): [Or(int, [str], str)],
+        Optional('annotations'): [Or(str, int)],
+        Optional('description'): str,
+        Optional('color'): str,
+        Optional('examples'): [int],
+        Optional('children'): lambda child: get_tag_schema().validate(child)
+    }]))
+
+
+# 各类文档的schema在第一次校验该类文档时才构建，导入本模块时不加载schema库
+DOCUMENT_SCHEMAS = {'setting': get_setting_schema, 'source': get_source_schema, 'annotation': get_annotation_schema,
+                    'author': get_author_schema, 'topic': get_topic_schema, 'tag': get_tag_schema}
@@ -0,0 +1,155 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+
+JOURNAL_SYNC_INTERVAL = 0.5
+
+
+class ApplyJournal:
+    """
+    apply的断点日志，位于频道目录下的cli-apply-journal.ndjson。
+    记录已提交成功的source(以其在输入中的序号区间表示)，以及已提交的元数据项的id，使中断的apply能够以--resume继续，而不重复提交已完成的部分。
+    source的批次大小是动态调整的，每次运行的分批并不相同，因此以序号而不是批次来记录。
+    日志只追加写入。记录先缓存在内存中，距上次写入超过JOURNAL_SYNC_INTERVAL秒时才一并写入并fsync，因此几乎不影响正常的提交速度。
+    进程崩溃时最多丢失最后一个间隔内的记录，这些项会在继续时被重新提交；source的bulk提交与元数据项的提交都可以安全地重复。
+    """
+    def __init__(self, channel_path: str):
+        self.__journal_path = os.path.join(channel_path, "cli-apply-journal.ndjson")
+        self.__lock = threading.Lock()
+        self.__file = None
+        self.__buffer = []
+        self.__last_sync = 0.0
+        self.__source_ranges = []
+        self.__entities = {}
+
+    def begin(self, signature):
+        """
+        开始一次新的apply，丢弃之前的日志。
+        :param signature: 输入内容的标识，继续时用于确认输入没有变化
+        """
+        self.__source_ranges = []
+        self.__entities = {}
+        self.__open("wb")
+        self.__append({"t": "begin", "signature": signature})
+        self.sync()
+
+    def resume(self, signature):
+        """
+        读取上次中断的apply的日志，并在其后继续追加。
+        :return: 是否可以继续。日志不存在，或者输入内容的标识与上次不同时返回False
+        """
+        try:
+            with open(self.__journal_path, "rb") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return False
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # 写入中途崩溃时最后一行可能不完整
+                break
+        if len(records) == 0 or records[0].get("t") != "begin" or records[0].get("signature") != signature:
+            return False
+        ranges = []
+        for record in records[1:]:
+            if record["t"] == "source":
+                ranges += record["r"]
+            elif record["t"] == "entity":
+                self.__entities[(record["k"], record["p"], record["n"])] = record["id"]
+        self.__source_ranges = merge_ranges(ranges)
+        self.__open("ab")
+        return True
+
+    @property
+    def resumed_sources(self):
+        """
+        日志中已完成的source数量。
+        """
+        return sum(end - start for (start, end) in self.__source_ranges)
+
+    def is_source_done(self, ordinal: int):
+        index = bisect.bisect_right(self.__source_ranges, [ordinal, float("inf")]) - 1
+        return index >= 0 and self.__source_ranges[index][0] <= ordinal < self.__source_ranges[index][1]
+
+    def add_sources(self, ordinals):
+        """
+        记录一批已提交成功的source。
+        :param ordinals: 这些source在输入中的序号，升序排列
+        """
+        ranges = []
+        for ordinal in ordinals:
+            if len(ranges) > 0 and ranges[-1][1] == ordinal:
+                ranges[-1][1] = ordinal + 1
+            else:
+                ranges.append([ordinal, ordinal + 1])
+        self.__append({"t": "source", "r": ranges})
+
+    def get_entity(self, kind: str, name: str, parent_id):
+        return self.__entities.get((kind, parent_id, name), None)
+
+    def add_entity(self, kind: str, name: str, parent_id, entity_id: int):
+        self.__append({"t": "entity", "k": kind, "p": parent_id, "n": name, "id": entity_id})
+
+    def sync(self):
+        """
+        将缓存的记录写入日志文件并fsync。
+        """
+        with self.__lock:
+            self.__sync()
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__sync()
+                self.__file.close()
+                self.__file = None
+
+    def discard(self):
+        """
+        apply已全部完成，删除日志。
+        """
+        self.close()
+        try:
+            os.remove(self.__journal_path)
+        except FileNotFoundError:
+            pass
+
+    def __open(self, mode: str):
+        os.makedirs(os.path.dirname(self.__journal_path), exist_ok=True)
+        self.__file = open(self.__journal_path, mode)
+        self.__last_sync = time.monotonic()
+
+    def __append(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+        with self.__lock:
+            self.__buffer.append(line)
+            if time.monotonic() - self.__last_sync >= JOURNAL_SYNC_INTERVAL:
+                self.__sync()
+
+    def __sync(self):
+        if self.__file is None or len(self.__buffer) == 0:
+            return
+        self.__file.write(b"".join(self.__buffer))
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__buffer = []
+        self.__last_sync = time.monotonic()
+
+
+def merge_ranges(ranges):
+    """
+    合并重叠或相邻的[start, end)区间。
+    :return: 按start升序排列、互不相交的区间列表
+    """
+    merged = []
+    for (start, end) in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
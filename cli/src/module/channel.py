@@ -1,3 +1,4 @@
+import json
 import os.path
 from module.cli_data import CliData
 
@@ -23,8 +24,25 @@ class ChannelManager:
         """
         return self.__cli_data.data["use_channel"] or "default"
 
+    def path(self, channel_name: str = None):
+        """
+        查看频道的目录。不指定频道时，返回当前所用频道的目录。
+        """
+        return os.path.join(self.__channel_dir, channel_name or self.current())
+
     def list(self):
         """
         查看频道列表。
         """
         return [i.name for i in os.scandir(self.__channel_dir) if i.is_dir()]
+
+
+def get_folders_path(channel_path: str):
+    """
+    读取频道的public.dat，得到server存储导入文件的目录。
+    """
+    with open(os.path.join(channel_path, "public.dat")) as f:
+        db_path = json.load(f)["dbPath"]
+    if db_path.startswith("@/"):
+        db_path = os.path.join(channel_path, "database", db_path[2:])
+    return os.path.join(db_path, "folders")
@@ -0,0 +1,52 @@
+import json
+import os
+import threading
+
+
+class EntityCache:
+    """
+    提供对频道目录下cli-entity-cache.json的读写。
+    缓存annotation、author、topic、tag等元数据项的name(及parentId)到server中的id的映射，使apply能够直接PATCH已知的项。
+    """
+    def __init__(self, channel_path: str):
+        self.__cache_path = os.path.join(channel_path, "cli-entity-cache.json")
+        self.__lock = threading.Lock()
+        self.__changed = False
+        try:
+            with open(self.__cache_path) as f:
+                self.__data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.__data = {}
+
+    def get(self, kind: str, name: str, parent_id: int or None = None):
+        return self.__data.get(kind, {}).get(self.__key(name, parent_id), None)
+
+    def set(self, kind: str, name: str, parent_id: int or None, entity_id: int):
+        with self.__lock:
+            self.__data.setdefault(kind, {})[self.__key(name, parent_id)] = entity_id
+            self.__changed = True
+
+    def remove(self, kind: str, name: str, parent_id: int or None = None):
+        with self.__lock:
+            if self.__data.get(kind, {}).pop(self.__key(name, parent_id), None) is not None:
+                self.__changed = True
+
+    def clear(self):
+        with self.__lock:
+            self.__data = {}
+            self.__changed = True
+
+    def save(self):
+        with self.__lock:
+            if not self.__changed:
+                return
+            os.makedirs(os.path.dirname(self.__cache_path), exist_ok=True)
+            tmp_path = self.__cache_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.__data, f)
+            os.replace(tmp_path, self.__cache_path)
+            self.__changed = False
+
+    @staticmethod
+    def __key(name: str, parent_id: int or None):
+        return "%s:%s" % (parent_id if parent_id is not None else "", name)
@@ -0,0 +1,297 @@
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import yaml
+from module.server import Server
+from module.plan import KIND_API_PATHS
+from utils.trace import tracer
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+
+EXPORT_LIST_PAGE_SIZE = 1000
+# 每个文档最多包含的数据项数。数据项攒满一个文档就立刻写出，因此内存占用只与这个数量和并发数有关，与数据总量无关
+EXPORT_DOCUMENT_SIZE = 1000
+
+EXPORT_KINDS = ("setting", "annotation", "author", "topic", "tag", "source")
+
+# apply的setting文档中可以出现的字段。server返回的设置项多于这些，其余的不能通过apply写回
+SETTING_FIELDS = {
+    "meta": ("scoreDescriptions", "autoCleanTagme", "topicColors", "authorColors"),
+    "import": ("autoAnalyseMeta", "setTagmeOfTag", "setTagmeOfSource", "setTimeBy", "setPartitionTimeDelay", "sourceAnalyseRules"),
+    "query": ("chineseSymbolReflect", "translateUnderscoreToSpace", "queryLimitOfQueryItems", "warningLimitOfUnionItems", "warningLimitOfIntersectItems"),
+}
+SITE_FIELDS = ("name", "title", "hasSecondaryId")
+
+# tag的group在apply中的写法，与Applier提交时的转换相反
+TAG_GROUP_VALUES = {
+    "YES": True,
+    "FORCE": {"force": True, "sequence": False},
+    "SEQUENCE": {"force": False, "sequence": True},
+    "FORCE_AND_SEQUENCE": {"force": True, "sequence": True},
+}
+
+
+class Exporter:
+    """
+    将server上的元数据导出为apply可读取的文档，用于备份或迁移到其他频道。
+    列表分页与数据项详情都以有限的并发窗口请求，结果按原顺序逐个文档写出，不会在内存中攒下全部数据。
+    topic与tag先通过列表建立parentId的索引，再按树的先序遍历请求详情，边接收边组装成嵌套的children。
+    """
+    def __init__(self, server: Server, writer, concurrency: int = 8):
+        """
+        :param writer: DocumentWriter
+        :param concurrency: 并发请求的数量上限
+        """
+        self.__server = server
+        self.__writer = writer
+        self.__concurrency = concurrency
+        self.__executor = None
+        self.__exported = {}
+
+    @property
+    def exported(self):
+        """
+        :return: {kind: 已导出的数据项数}
+        """
+        return self.__exported
+
+    def export(self, kinds):
+        self.__server.http_client.set_pool_size(self.__concurrency)
+        with ThreadPoolExecutor(max_workers=self.__concurrency) as executor:
+            self.__executor = executor
+            for kind in EXPORT_KINDS:
+                if kind not in kinds:
+                    continue
+                with tracer.span("export %s" % (kind,), "export"):
+                    if kind == "setting":
+                        self.__export_setting()
+                    elif kind == "annotation":
+                        self.__export_list(kind, self.__list_all(KIND_API_PATHS[kind]), export_annotation)
+                    elif kind == "author":
+                        self.__export_list(kind, self.__map(self.__get_author_detail, self.__list_all(KIND_API_PATHS[kind])), export_author)
+                    elif kind == "source":
+                        self.__export_list(kind, self.__map(self.__get_source_detail, self.__list_all("/api/source-images")), export_source)
+                    else:
+                        self.__export_tree(kind)
+            self.__executor = None
+
+    def __export_setting(self):
+        spec = {}
+        for (key, fields) in SETTING_FIELDS.items():
+            data = self.__get("/api/setting/%s" % (key,))
+            setting = {k: data[k] for k in fields if data.get(k, None) is not None}
+            if key == "meta" and "scoreDescriptions" in setting:
+                # 未描述的分数在server中是null，apply中没有对应的写法，以空的描述占位，使其余描述对应的分数不变
+                setting["scoreDescriptions"] = [i if i is not None else {"word": "", "content": ""} for i in setting["scoreDescriptions"]]
+            if key == "import" and "sourceAnalyseRules" in setting:
+                setting["sourceAnalyseRules"] = [{k: v for (k, v) in i.items() if v is not None} for i in setting["sourceAnalyseRules"]]
+            if len(setting) > 0:
+                spec[key] = setting
+        sites = [{k: i[k] for k in SITE_FIELDS if i.get(k, None) is not None} for i in self.__get("/api/setting/source/sites")]
+        if len(sites) > 0:
+            spec["source"] = {"sites": sites}
+        self.__writer.write("setting", spec)
+        self.__exported["setting"] = 1
+
+    def __export_list(self, kind: str, items, convert):
+        batch = []
+        for item in items:
+            batch.append(convert(item))
+            if len(batch) >= EXPORT_DOCUMENT_SIZE:
+                self.__write(kind, batch)
+                batch = []
+        if len(batch) > 0:
+            self.__write(kind, batch)
+
+    def __export_tree(self, kind: str):
+        """
+        列表中只取id、parentId与ordinal建立索引。详情按先序遍历的顺序返回，因此每个节点到达时它的所有祖先都已在栈中。
+        一个文档包含若干棵完整的树，攒满EXPORT_DOCUMENT_SIZE个节点后在下一个根节点处写出。
+        """
+        children = {}
+        for item in self.__list_all(KIND_API_PATHS[kind]):
+            children.setdefault(item.get("parentId", None), []).append((item.get("ordinal", item["id"]), item["id"]))
+        for siblings in children.values():
+            # tag的同级顺序由ordinal决定，Applier按文档中的顺序提交同级节点，由此恢复原有的ordinal
+            siblings.sort()
+        convert = export_tag if kind == "tag" else export_topic
+        api_path = KIND_API_PATHS[kind]
+        batch = []
+        batch_nodes = 0
+        stack = []
+        for (depth, detail) in self.__map(lambda n: (n[0], self.__get("%s/%s" % (api_path, n[1]))), walk_tree(children)):
+            node = convert(detail)
+            if depth == 0:
+                if batch_nodes >= EXPORT_DOCUMENT_SIZE:
+                    self.__write(kind, batch, count=batch_nodes)
+                    batch = []
+                    batch_nodes = 0
+                batch.append(node)
+            else:
+                stack[depth - 1].setdefault("children", []).append(node)
+            batch_nodes += 1
+            del stack[depth:]
+            stack.append(node)
+        if len(batch) > 0:
+            self.__write(kind, batch, count=batch_nodes)
+
+    def __write(self, kind: str, spec: list, count: int = None):
+        self.__writer.write(kind, spec)
+        self.__exported[kind] = self.__exported.get(kind, 0) + (count if count is not None else len(spec))
+
+    def __list_all(self, api_path: str):
+        """
+        分页拉取列表的全部项。第一页确定总数后，其余的页在并发窗口内同时请求，并按顺序产出其中的项。
+        """
+        def fetch(offset: int):
+            return self.__get(api_path, query={"limit": EXPORT_LIST_PAGE_SIZE, "offset": offset})
+
+        data = fetch(0)
+        yield from data["result"]
+        if len(data["result"]) == 0:
+            return
+        yield from (i for page in self.__map(fetch, range(len(data["result"]), data["total"], EXPORT_LIST_PAGE_SIZE)) for i in page["result"])
+
+    def __map(self, fn, iterable):
+        """
+        并发地对iterable的每一项执行fn，按输入顺序产出结果。同时进行中的任务不超过并发数的两倍，输入只在需要时才继续读取。
+        """
+        window = deque()
+        for item in iterable:
+            window.append(self.__executor.submit(fn, item))
+            if len(window) >= self.__concurrency * 2:
+                yield window.popleft().result()
+        while len(window) > 0:
+            yield window.popleft().result()
+
+    def __get_author_detail(self, item):
+        return self.__get("%s/%s" % (KIND_API_PATHS["author"], item["id"]))
+
+    def __get_source_detail(self, item):
+        if item.get("empty", False):
+            # 标题、描述、标签、pool与关联都为空的来源数据，列表中的信息已经足够，不需要再请求详情
+            return {"source": item["source"], "sourceId": item["sourceId"]}
+        return dict(self.__get("/api/source-images/%s/%s" % (item["source"], item["sourceId"])), source=item["source"], sourceId=item["sourceId"])
+
+    def __get(self, path: str, query: dict = None):
+        ok, data = self.__server.http_client.req("GET", path, query=query)
+        if not ok:
+            raise Exception(data["message"])
+        return data
+
+
+class DocumentWriter:
+    """
+    将文档逐个写入文本流。yaml格式的每个文档以---开始；ndjson格式每行一个文档。两种格式都可以直接被apply读取。
+    """
+    def __init__(self, out, fmt: str = "yaml"):
+        self.__out = out
+        self.__fmt = fmt
+
+    def write(self, kind: str, spec):
+        doc = {"kind": kind, "version": "v1", "spec": spec}
+        if self.__fmt == "ndjson":
+            self.__out.write(json.dumps(doc, ensure_ascii=False) + "\n")
+        else:
+            self.__out.write(yaml.dump(doc, Dumper=SafeDumper, allow_unicode=True, explicit_start=True, sort_keys=False))
+
+
+def walk_tree(children: dict):
+    """
+    :param children: {parentId: [(ordinal, id)]}，根节点的parentId为None
+    :return: 按先序遍历产出(depth, id)的迭代器
+    """
+    stack = [(0, i) for (_, i) in reversed(children.get(None, ()))]
+    while len(stack) > 0:
+        depth, node_id = stack.pop()
+        yield depth, node_id
+        stack.extend((depth + 1, i) for (_, i) in reversed(children.get(node_id, ())))
+
+
+def export_annotation(item):
+    return compact({"name": item["name"], "canBeExported": item.get("canBeExported", False), "target": item.get("target", None)}, keep=("canBeExported",))
+
+
+def export_author(detail):
+    return compact({
+        "name": detail["name"],
+        "otherNames": detail.get("otherNames", None),
+        "type": detail.get("type", None),
+        "description": detail.get("description", None),
+        "keywords": detail.get("keywords", None),
+        "links": export_links(detail.get("links", None)),
+        "favorite": detail.get("favorite", None),
+        "score": detail.get("score", None),
+        "annotations": export_annotation_refs(detail.get("annotations", None)),
+        "mappingSourceTags": export_mapping_source_tags(detail.get("mappingSourceTags", None)),
+    })
+
+
+def export_topic(detail):
+    return export_author(detail)
+
+
+def export_tag(detail):
+    """
+    tag的links与examples在server中只能以id引用，因此导出的是id，只能应用到同一个频道或id一致的数据上。
+    """
+    return compact({
+        "name": detail["name"],
+        "type": detail["type"],
+        "otherNames": detail.get("otherNames", None),
+        "group": dict_copy(TAG_GROUP_VALUES.get(detail.get("group", None), None)),
+        "links": [i["id"] if isinstance(i, dict) else i for i in detail.get("links", None) or ()],
+        "annotations": export_annotation_refs(detail.get("annotations", None)),
+        "description": detail.get("description", None),
+        "color": detail.get("color", None),
+        "examples": [i["id"] if isinstance(i, dict) else i for i in detail.get("examples", None) or ()],
+    })
+
+
+def export_source(detail):
+    return compact({
+        "source": detail["source"],
+        "sourceId": detail["sourceId"],
+        "title": detail.get("title", None),
+        "description": detail.get("description", None),
+        "tags": [{k: v for (k, v) in i.items() if k in ("name", "displayName", "type") and v is not None} for i in detail.get("tags", None) or ()],
+        "pools": [{"key": i["key"], "title": i.get("title", None) or ""} for i in detail.get("pools", None) or ()],
+        "relations": detail.get("relations", None),
+    })
+
+
+def export_links(links):
+    if not links:
+        return None
+    return [{"title": i.get("title", None) or "", "link": i.get("link", None) or ""} for i in links]
+
+
+def export_annotation_refs(annotations):
+    """
+    注解以名称引用，使导出的内容不依赖于频道中的id。
+    """
+    if not annotations:
+        return None
+    return [i["name"] if isinstance(i, dict) else i for i in annotations]
+
+
+def export_mapping_source_tags(items):
+    if not items:
+        return None
+    return [{k: v for (k, v) in i.items() if k in ("source", "name", "displayName", "type") and v is not None} for i in items]
+
+
+def dict_copy(value):
+    # 共享的dict会被yaml写成锚点与别名，因此每次使用时复制一份
+    return dict(value) if isinstance(value, dict) else value
+
+
+def compact(item: dict, keep=()):
+    """
+    去掉空值与false的字段。它们与apply中省略这些字段的效果相同。
+    """
+    return {k: v for (k, v) in item.items() if k in keep or (v is not None and v is not False and v != "" and v != [] and v != {})}
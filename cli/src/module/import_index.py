@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import threading
+from module.channel import get_folders_path
+
+
+class ImportIndex:
+    """
+    提供对频道目录下cli-import-index.json的读写。
+    记录已导入到server的每个文件的内容hash，使导入前能够在本地判断文件是否重复，而不必让server再做一次复制和缩略图生成。
+    同时记录每个导入项在server存储中的文件。导入项在确认保存后会从导入列表中消失，但文件仍在存储中；只有被删除的项的文件才会消失，
+    因此以存储中的文件是否还存在来判断索引中的项是否仍然有效。
+    本地文件的hash按(size, mtime)缓存，文件未变动时不会重复读取内容。
+    """
+    def __init__(self, channel_path: str):
+        self.__channel_path = channel_path
+        self.__index_path = os.path.join(channel_path, "cli-import-index.json")
+        self.__folders_path = None
+        self.__lock = threading.Lock()
+        self.__changed = False
+        try:
+            with open(self.__index_path) as f:
+                data = json.load(f)
+            self.__hashes = data.get("hashes", {})
+            self.__stored = data.get("stored", {})
+            self.__files = data.get("files", {})
+            self.__synced_id = data.get("syncedId", 0)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.__hashes = {}
+            self.__stored = {}
+            self.__files = {}
+            self.__synced_id = 0
+        self.__digests = {i: d for (d, i) in self.__hashes.items() if i is not None}
+        # 本次运行中正在导入的hash。用于识别同一批次中内容相同的多个文件
+        self.__claimed = set()
+
+    @property
+    def synced_id(self):
+        """
+        已从server导入列表同步到的最大导入项id。
+        """
+        return self.__synced_id
+
+    def is_known(self, import_id: int):
+        return import_id in self.__digests
+
+    def is_stored(self, import_id: int):
+        """
+        导入项在server存储中的文件是否已被记录。
+        """
+        digest = self.__digests.get(import_id, None)
+        return digest is not None and digest in self.__stored
+
+    def digest(self, filepath: str, cache: bool = True):
+        """
+        计算文件内容的hash。文件的size和mtime与上次记录相同时直接返回记录的hash。
+        :param cache: 是否记录此文件的hash。只会被读取一次的文件(例如server存储中的文件)不需要记录
+        """
+        real_path = os.path.realpath(filepath)
+        stat = os.stat(real_path)
+        record = self.__files.get(real_path, None)
+        if record is not None and record[0] == stat.st_size and record[1] == stat.st_mtime_ns:
+            return record[2]
+        h = hashlib.blake2b(digest_size=16)
+        with open(real_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        if cache:
+            with self.__lock:
+                self.__files[real_path] = [stat.st_size, stat.st_mtime_ns, digest]
+                self.__changed = True
+        return digest
+
+    def claim(self, digest: str):
+        """
+        在导入之前占用一个hash。已记录的导入项在server存储中的文件已被删除时，移除此项，文件不再被视为重复。
+        :return: hash已被记录或已被占用(即文件重复)时返回False
+        """
+        with self.__lock:
+            if digest in self.__claimed:
+                return False
+            if digest in self.__hashes:
+                if not self.__is_removed(digest):
+                    return False
+                self.__remove(digest)
+            self.__claimed.add(digest)
+            return True
+
+    def release(self, digest: str, import_id: int or None = None, imported: bool = False, stored_file: str = None):
+        """
+        释放占用的hash。导入成功时将其记录到索引中。
+        :param stored_file: 导入项在server存储中的文件，相对于存储目录
+        """
+        with self.__lock:
+            self.__claimed.discard(digest)
+            if imported:
+                self.__set(digest, import_id, stored_file)
+
+    def add(self, digest: str, import_id: int, stored_file: str = None):
+        """
+        记录一个从server导入列表同步而来的导入项。
+        """
+        with self.__lock:
+            self.__set(digest, import_id, stored_file)
+
+    def set_stored(self, import_id: int, stored_file: str):
+        """
+        补充已记录的导入项在server存储中的文件。
+        """
+        with self.__lock:
+            digest = self.__digests.get(import_id, None)
+            if digest is not None:
+                self.__stored[digest] = stored_file
+                self.__changed = True
+
+    def set_synced_id(self, import_id: int):
+        with self.__lock:
+            if import_id > self.__synced_id:
+                self.__synced_id = import_id
+                self.__changed = True
+
+    def forget(self, filepath: str):
+        """
+        移除本地文件的缓存记录。用于导入时原文件被移除的情况。
+        """
+        with self.__lock:
+            if self.__files.pop(os.path.realpath(filepath), None) is not None:
+                self.__changed = True
+
+    def prune(self):
+        """
+        移除server存储中的文件已被删除的导入项，以及已不存在的本地文件的缓存记录，使索引不会无限增长。
+        :return: 被移除的导入项数量
+        """
+        with self.__lock:
+            removed = [d for d in self.__hashes.keys() if self.__is_removed(d)]
+            for digest in removed:
+                self.__remove(digest)
+            missing = [p for p in self.__files.keys() if not os.path.exists(p)]
+            for path in missing:
+                del self.__files[path]
+            if len(missing) > 0:
+                self.__changed = True
+            return len(removed)
+
+    def __is_removed(self, digest: str):
+        stored_file = self.__stored.get(digest, None)
+        if stored_file is None:
+            # 没有记录存储中的文件时无法确认，保守地认为它仍然存在
+            return False
+        if self.__folders_path is None:
+            try:
+                self.__folders_path = get_folders_path(self.__channel_path)
+            except (OSError, ValueError, KeyError):
+                return False
+        return not os.path.exists(os.path.join(self.__folders_path, stored_file))
+
+    def __set(self, digest: str, import_id: int or None, stored_file: str or None):
+        self.__hashes[digest] = import_id
+        if import_id is not None:
+            self.__digests[import_id] = digest
+        if stored_file is not None:
+            self.__stored[digest] = stored_file
+        self.__changed = True
+
+    def __remove(self, digest: str):
+        import_id = self.__hashes.pop(digest)
+        self.__stored.pop(digest, None)
+        if import_id is not None:
+            self.__digests.pop(import_id, None)
+        self.__changed = True
+
+    def save(self):
+        with self.__lock:
+            if not self.__changed:
+                return
+            os.makedirs(os.path.dirname(self.__index_path), exist_ok=True)
+            tmp_path = self.__index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"hashes": self.__hashes, "stored": self.__stored, "files": self.__files, "syncedId": self.__synced_id}, f)
+            os.replace(tmp_path, self.__index_path)
+            self.__changed = False
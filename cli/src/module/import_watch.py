@@ -0,0 +1,166 @@
+import os
+import time
+from utils.watcher import DirectoryWatcher, IN_CLOSE_WRITE, IN_MOVED_TO, IN_MOVED_FROM, IN_DELETE
+
+
+IN_Q_OVERFLOW = 0x00004000
+
+# 下载工具写入过程中使用的临时文件后缀，这些文件完成后会被重命名
+TEMPORARY_SUFFIXES = (".part", ".crdownload", ".download", ".tmp", ".partial")
+
+
+class ImportWatcher:
+    """
+    监视一个目录(不含子目录)，将其中写入完成的文件合并为批次。
+    在Linux上使用inotify，以写入关闭(IN_CLOSE_WRITE)或移入(IN_MOVED_TO)作为文件完成的标志；其他平台退化为轮询，文件的大小与修改时间在两次轮询之间不再变化时视为完成。
+    文件完成后进入等待队列，直到目录安静了debounce秒、队列达到max_batch个文件，或最早的文件已等待了debounce的5倍时间，才作为一个批次产出。
+    每个文件以文件名与(大小, 修改时间)记录为已处理，同一版本的文件不会被重复产出；文件被删除或移出后移除其记录。
+    """
+    def __init__(self, path: str, debounce: float = 2.0, max_batch: int = 200, poll_interval: float = 1.0):
+        """
+        :param debounce: 合批的等待窗口，单位为秒
+        :param max_batch: 单个批次的最大文件数
+        :param poll_interval: 轮询模式下的扫描间隔，单位为秒
+        """
+        self.__path = os.path.abspath(path)
+        self.__debounce = debounce
+        self.__max_batch = max_batch
+        self.__poll_interval = poll_interval
+        self.__pending = {}
+        self.__last_event_time = None
+        self.__polled = {}
+        self.__handled = {}
+        self.__watcher = None
+
+    @property
+    def native(self):
+        """
+        是否使用了inotify。
+        """
+        return self.__watcher is not None and self.__watcher.native
+
+    def __enter__(self):
+        # 先建立监视再扫描已有文件，使扫描期间写入完成的文件不会被遗漏
+        self.__watcher = DirectoryWatcher(self.__path, mask=IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM)
+        self.__scan_existing()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__watcher.close()
+
+    def batches(self):
+        """
+        :return: 持续产出批次(文件路径列表)的迭代器。目录中已有的文件作为第一批产出
+        """
+        while True:
+            timeout = self.__next_timeout()
+            if self.__watcher.native:
+                events = self.__watcher.wait(timeout)
+                now = time.monotonic()
+                for (mask, name) in events:
+                    if mask & IN_Q_OVERFLOW:
+                        # 事件队列溢出，丢失的事件只能通过重新扫描目录找回
+                        self.__scan_existing()
+                    elif not name:
+                        continue
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        self.__remove(name)
+                    else:
+                        self.__add_written(name, now)
+            else:
+                self.__watcher.wait(timeout)
+                self.__poll()
+            batch = self.__take_batch()
+            if batch is not None:
+                yield batch
+
+    def __next_timeout(self):
+        if len(self.__pending) == 0:
+            # 空闲时inotify模式本可以无限等待，这里定时醒来只是为了检查中断。等待时间不短于轮询间隔，debounce很小时也不会空转
+            return self.__poll_interval if not self.__watcher.native else max(self.__debounce * 5, self.__poll_interval)
+        now = time.monotonic()
+        deadline = min(self.__last_event_time + self.__debounce, min(self.__pending.values()) + self.__debounce * 5)
+        timeout = max(deadline - now, 0)
+        return timeout if self.__watcher.native else min(timeout, self.__poll_interval)
+
+    def __take_batch(self):
+        if len(self.__pending) == 0:
+            return None
+        now = time.monotonic()
+        quiet = now - self.__last_event_time >= self.__debounce
+        overdue = now - min(self.__pending.values()) >= self.__debounce * 5
+        if not quiet and not overdue and len(self.__pending) < self.__max_batch:
+            return None
+        names = sorted(self.__pending.keys(), key=lambda n: self.__pending[n])[:self.__max_batch]
+        for name in names:
+            del self.__pending[name]
+        return [os.path.join(self.__path, name) for name in names if os.path.isfile(os.path.join(self.__path, name))]
+
+    def __add(self, name: str, now: float):
+        if not is_importable_name(name):
+            return
+        self.__pending.setdefault(name, now)
+        self.__last_event_time = now
+
+    def __add_written(self, name: str, now: float):
+        """
+        inotify模式下处理写入完成的文件。记录其当前版本，使溢出后的重新扫描不会再次产出它。
+        """
+        if not is_importable_name(name):
+            return
+        try:
+            stat = os.stat(os.path.join(self.__path, name))
+        except FileNotFoundError:
+            return
+        self.__handled[name] = (stat.st_size, stat.st_mtime_ns)
+        self.__add(name, now)
+
+    def __remove(self, name: str):
+        self.__handled.pop(name, None)
+        self.__polled.pop(name, None)
+        self.__pending.pop(name, None)
+
+    def __scan_existing(self):
+        """
+        将目录中已有的文件加入等待队列。最近debounce秒内修改过的文件可能仍在写入，这里不做处理：
+        inotify模式下它们会在写入完成时产生事件，轮询模式下它们会在大小不再变化后被发现。
+        已有的文件不需要等待合批窗口，因此将它们的时间记为一个窗口之前，使其立刻作为批次产出。
+        inotify事件队列溢出后也通过这里重新扫描，此时已处理过的同一版本的文件会被跳过，已不存在的文件的记录会被移除。
+        """
+        now = time.monotonic() - self.__debounce
+        wall_now = time.time()
+        current = {}
+        for (name, state, mtime) in self.__scan():
+            current[name] = state
+            if wall_now - mtime >= self.__debounce and self.__handled.get(name, None) != state:
+                self.__handled[name] = state
+                self.__add(name, now)
+        self.__polled = current
+        self.__handled = {name: state for (name, state) in self.__handled.items() if name in current}
+
+    def __poll(self):
+        """
+        轮询模式下扫描目录，找出大小与修改时间相比上次扫描不再变化、且这一版本尚未处理过的文件。
+        """
+        now = time.monotonic()
+        current = {}
+        for (name, state, _) in self.__scan():
+            current[name] = state
+            if self.__polled.get(name, None) == state and self.__handled.get(name, None) != state:
+                self.__handled[name] = state
+                self.__add(name, now)
+        self.__polled = current
+        self.__handled = {name: state for (name, state) in self.__handled.items() if name in current}
+
+    def __scan(self):
+        for entry in os.scandir(self.__path):
+            if entry.is_file() and is_importable_name(entry.name):
+                stat = entry.stat()
+                yield entry.name, (stat.st_size, stat.st_mtime_ns), stat.st_mtime
+
+
+def is_importable_name(name: str):
+    """
+    排除隐藏文件与下载中的临时文件。
+    """
+    return not name.startswith(".") and not name.lower().endswith(TEMPORARY_SUFFIXES)
@@ -1,26 +1,183 @@
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from module.channel import get_folders_path
 from module.server import Server
+from module.import_index import ImportIndex
+from utils.trace import tracer
 
 
 class Importation:
-    def __init__(self, server: Server):
+    def __init__(self, server: Server, index: ImportIndex = None):
+        """
+        :param index: 导入去重索引。指定时，导入前会检查文件内容是否已导入过，重复的文件将被跳过
+        """
         self.__server = server
+        self.__index = index
 
-    def list(self):
-        ok, data = self.__server.http_client.req("GET", "/api/imports")
-        if not ok:
-            raise Exception(data["message"])
-        return [(i["id"], i["fileName"], i["fileImportTime"]) for i in data["result"]]
+    def list_pages(self, limit: int = None, offset: int = 0, order: str = None):
+        """
+        分页拉取导入列表。拉取当前页时，下一页已在后台请求，因此调用方处理数据与网络请求是重叠进行的。
+        :param limit: 最多拉取的项数。为None时拉取全部
+        :param order: 排序字段，例如"-id"。为None时使用server的默认排序
+        :return: 逐页产出导入项列表的迭代器
+        """
+        def fetch(page_offset: int, page_limit: int):
+            query = {"limit": page_limit, "offset": page_offset}
+            if order is not None:
+                query["order"] = order
+            ok, data = self.__server.http_client.req("GET", "/api/imports", query=query)
+            if not ok:
+                raise Exception(data["message"])
+            return data
+
+        def page_limit(remaining):
+            return IMPORT_LIST_PAGE_SIZE if remaining is None else min(IMPORT_LIST_PAGE_SIZE, remaining)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(fetch, offset, page_limit(limit)) if limit != 0 else None
+            while future is not None:
+                data = future.result()
+                page = data["result"]
+                offset += len(page)
+                if limit is not None:
+                    limit -= len(page)
+                if len(page) > 0 and offset < data["total"] and (limit is None or limit > 0):
+                    future = executor.submit(fetch, offset, page_limit(limit))
+                else:
+                    future = None
+                yield page
 
     def add(self, filepath: str, remove: bool):
+        """
+        导入一个文件。指定了去重索引时，内容重复的文件不会被导入。
+        :return: (error message或None, 是否因重复而跳过)
+        """
+        e, skipped, _ = self.add_with_id(filepath, remove)
+        return e, skipped
+
+    def add_with_id(self, filepath: str, remove: bool):
+        """
+        与add相同，额外返回新建的导入项id。
+        :return: (error message或None, 是否因重复而跳过, 导入项id或None)
+        """
+        if self.__index is None:
+            e, import_id = self.__add(filepath, remove)
+            return e, False, import_id
+        try:
+            with tracer.span("hash", "import"):
+                digest = self.__index.digest(filepath)
+        except OSError as e:
+            return str(e), False, None
+        if not self.__index.claim(digest):
+            return None, True, None
+        import_id = None
+        stored_file = None
+        try:
+            e, import_id = self.__add(filepath, remove)
+            if import_id is not None:
+                stored_file = self.__get_stored_file(import_id)
+            return e, False, import_id
+        finally:
+            self.__index.release(digest, import_id, imported=import_id is not None, stored_file=stored_file)
+            if remove and import_id is not None:
+                self.__index.forget(filepath)
+
+    def __add(self, filepath: str, remove: bool):
         ok, data = self.__server.http_client.req("POST", "/api/imports/import", body={"filepath": filepath, "removeOriginFile": remove})
         if ok:
-            return None
+            return None, data["id"]
         else:
-            return data["message"]
+            return data["message"], None
+
+    def __get_stored_file(self, import_id: int):
+        """
+        查询导入项在server存储中的文件，供去重索引判断此项之后是否被删除。查询失败时返回None，不影响导入本身。
+        """
+        try:
+            ok, data = self.__server.http_client.req("GET", "/api/imports/%s" % (import_id,))
+        except requests.RequestException:
+            return None
+        return data["file"] if ok else None
 
-    def batch_update(self, tagme: str or None, partition_time: str or None, create_time: str or None, order_time: str or None, analyse_source: bool):
+    def add_all(self, filepaths, remove: bool, jobs: int = 1, with_id: bool = False):
+        """
+        使用有界的线程池并发导入多个文件。同时在途的请求数不超过jobs的2倍，因此filepaths可以是惰性的迭代器。
+        :param with_id: 在产出的每一项末尾附加新建的导入项id
+        :return: 按完成顺序产出(filepath, error message或None, 是否因重复而跳过)的迭代器
+        """
+        self.__server.http_client.set_pool_size(jobs)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            pending = {}
+            for filepath in filepaths:
+                pending[executor.submit(self.__add_safely, filepath, remove)] = filepath
+                if len(pending) >= jobs * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        result = future.result()
+                        yield (pending.pop(future), *(result if with_id else result[:2]))
+            for future in list(pending):
+                result = future.result()
+                yield (pending.pop(future), *(result if with_id else result[:2]))
+
+    def __add_safely(self, filepath: str, remove: bool):
+        try:
+            return self.add_with_id(filepath, remove)
+        except requests.RequestException as e:
+            return str(e), False, None
+
+    def sync_index(self, channel_path: str, jobs: int = 1):
+        """
+        从server的导入列表增量同步去重索引。按id倒序分页拉取，遇到已同步过的id即停止，然后计算新导入项在server存储中的文件的hash。
+        最后移除存储中的文件已被删除的项。导入列表中不再出现的项不一定被删除了，确认保存的项也会从导入列表中消失。
+        :return: 新加入索引的导入项数量
+        """
+        with tracer.span("sync index", "import"):
+            return self.__sync_index(channel_path, jobs)
+
+    def __sync_index(self, channel_path: str, jobs: int):
+        folders_path = get_folders_path(channel_path)
+        records = []
+        max_id = None
+        for page in self.list_pages(order="-id"):
+            if max_id is None and len(page) > 0:
+                max_id = page[0]["id"]
+            reached = False
+            for i in page:
+                if i["id"] <= self.__index.synced_id:
+                    reached = True
+                    break
+                if not self.__index.is_known(i["id"]):
+                    records.append((i["id"], i["file"]))
+                elif not self.__index.is_stored(i["id"]):
+                    self.__index.set_stored(i["id"], i["file"])
+            if reached:
+                break
+
+        def index_stored_file(record):
+            import_id, file = record
+            try:
+                self.__index.add(self.__index.digest(os.path.join(folders_path, file), cache=False), import_id, file)
+                return True
+            except OSError:
+                # server存储中的文件不在本地可读时无法计算hash，跳过此项
+                return False
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            cnt = sum(executor.map(index_stored_file, records))
+        if max_id is not None:
+            self.__index.set_synced_id(max_id)
+        self.__index.prune()
+        return cnt
+
+    def batch_update(self, tagme: str or None, partition_time: str or None, create_time: str or None, order_time: str or None, analyse_source: bool,
+                     target: list = None):
+        """
+        :param target: 要修改的导入项id。为None时修改全部导入项
+        """
         ok, data = self.__server.http_client.req("POST", "/api/imports/batch-update", body={
+            "target": target,
             "analyseSource": analyse_source,
             "partitionTime": partition_time,
             "setOrderTimeBy": order_time,
@@ -35,3 +192,7 @@ class Importation:
         if not ok:
             raise Exception(data["message"])
         return data["total"]
+
+
+IMPORT_LIST_PAGE_SIZE = 500
+
@@ -22,6 +22,14 @@ class LocalConfig:
             self.frontend_path = conf.get("frontendPath", None) or os.path.join(self.userdata_path, "server/frontend")
             self.appdata_path = conf.get("appdataPath", None) or os.path.join(self.userdata_path, "appdata")
             self.app_path = conf.get("appPath", None)
+            self.http_pool_size = conf.get("httpPoolSize", 8)
+            self.http_connect_timeout = conf.get("httpConnectTimeout", 3)
+            self.http_read_timeout = conf.get("httpReadTimeout", 300)
+            self.http_retries = conf.get("httpRetries", 2)
+            self.http_gzip_threshold = conf.get("httpGzipThreshold", 1024 * 1024)
+            self.http_unix_socket = conf.get("httpUnixSocket", True)
+            self.server_start_timeout = conf.get("serverStartTimeout", 30)
+            self.heartbeat_interval = conf.get("heartbeatInterval", 10)
         except FileNotFoundError:
             raise FileNotFoundError("'conf.local.json' configuration is not found.")
 
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+import threading
+
+
+class ApplyManifest:
+    """
+    提供对频道目录下cli-apply-manifest.json的读写。
+    记录已成功应用的每个文件和每个数据项的内容hash，使再次apply时能够跳过未变更的文件和数据项。
+    """
+    def __init__(self, channel_path: str, full: bool = False):
+        """
+        :param full: 完全应用模式。不跳过任何内容，但仍然记录hash以供之后的增量apply使用
+        """
+        self.__manifest_path = os.path.join(channel_path, "cli-apply-manifest.json")
+        self.__full = full
+        self.__lock = threading.Lock()
+        self.__changed = False
+        try:
+            with open(self.__manifest_path) as f:
+                data = json.load(f)
+            self.__files = data.get("files", {})
+            self.__entities = data.get("entities", {})
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.__files = {}
+            self.__entities = {}
+
+    def check_file(self, filepath: str):
+        """
+        计算文件内容的hash。
+        :return: 文件已变更时返回新的hash；未变更时返回None
+        """
+        h = hashlib.blake2b(digest_size=16)
+        with open(filepath, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        if not self.__full and self.__files.get(os.path.realpath(filepath), None) == digest:
+            return None
+        return digest
+
+    def set_file(self, filepath: str, digest: str):
+        with self.__lock:
+            self.__files[os.path.realpath(filepath)] = digest
+            self.__changed = True
+
+    def check_entity(self, key: str, entity):
+        """
+        计算数据项内容的hash。
+        :return: (是否未变更, 新的hash)
+        """
+        digest = hashlib.blake2b(json.dumps(entity, sort_keys=True).encode(), digest_size=8).hexdigest()
+        return not self.__full and self.__entities.get(key, None) == digest, digest
+
+    def set_entity(self, key: str, digest: str):
+        with self.__lock:
+            self.__entities[key] = digest
+            self.__changed = True
+
+    def save(self):
+        with self.__lock:
+            if not self.__changed:
+                return
+            os.makedirs(os.path.dirname(self.__manifest_path), exist_ok=True)
+            tmp_path = self.__manifest_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"files": self.__files, "entities": self.__entities}, f)
+            os.replace(tmp_path, self.__manifest_path)
+            self.__changed = False
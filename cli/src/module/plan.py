@@ -0,0 +1,148 @@
+import threading
+from module.server import Server
+
+
+PLAN_LIST_PAGE_SIZE = 1000
+
+# 各类元数据项的api路径，以及只在详情API中返回、列表API中没有的字段
+KIND_API_PATHS = {"annotation": "/api/annotations", "author": "/api/authors", "topic": "/api/topics", "tag": "/api/tags"}
+DETAIL_ONLY_FIELDS = {
+    "annotation": (),
+    "author": ("description", "links", "mappingSourceTags"),
+    "topic": ("description", "links", "mappingSourceTags"),
+    "tag": ("description", "links", "annotations", "examples", "mappingSourceTags"),
+}
+
+ANNOTATION_TARGET_GROUPS = {"AUTHOR": ("ARTIST", "STUDIO", "PUBLISH"), "TOPIC": ("COPYRIGHT", "WORK", "CHARACTER")}
+
+
+class PlannedId:
+    """
+    plan模式下，尚未创建的数据项的占位id。以它为parent的子项必然也是新建项。
+    """
+    pass
+
+
+class RemoteState:
+    """
+    server上已有元数据的快照，用于在本地与apply的内容做比较。
+    每类数据通过列表API一次性分页拉取；只有当apply的内容包含详情字段时，才会再请求单个数据项的详情。
+    """
+    def __init__(self, server: Server):
+        self.__server = server
+        self.__indexes = {}
+        self.__details = {}
+        self.__lock = threading.Lock()
+
+    def load(self, kind: str):
+        """
+        拉取一类数据项的全部列表，建立(name, parentId)的索引。
+        """
+        index = {}
+        offset = 0
+        while True:
+            ok, data = self.__server.http_client.req("GET", KIND_API_PATHS[kind], query={"limit": PLAN_LIST_PAGE_SIZE, "offset": offset})
+            if not ok:
+                raise Exception(data["message"])
+            for item in data["result"]:
+                index.setdefault((item["name"], item.get("parentId", None)), item)
+            offset += len(data["result"])
+            if len(data["result"]) == 0 or offset >= data["total"]:
+                break
+        with self.__lock:
+            self.__indexes[kind] = index
+
+    def find(self, kind: str, name: str, parent_id):
+        """
+        :return: server上已有的数据项，不存在时返回None
+        """
+        if isinstance(parent_id, PlannedId):
+            return None
+        return self.__indexes[kind].get((name, parent_id), None)
+
+    def diff(self, kind: str, item: dict, remote: dict):
+        """
+        比较apply的数据项与server上已有的数据项。
+        :return: 有变化的字段组成的dict。无变化时返回空dict
+        """
+        if any(k in DETAIL_ONLY_FIELDS[kind] for k in item.keys()):
+            remote = self.__get_detail(kind, remote["id"])
+        changed = {}
+        for (k, v) in item.items():
+            if k == "parentId":
+                continue
+            if not same_field(k, v, remote.get(k, None)):
+                changed[k] = v
+        return changed
+
+    def __get_detail(self, kind: str, entity_id: int):
+        with self.__lock:
+            detail = self.__details.get((kind, entity_id), None)
+        if detail is None:
+            ok, data = self.__server.http_client.req("GET", "%s/%s" % (KIND_API_PATHS[kind], entity_id))
+            if not ok:
+                raise Exception(data["message"])
+            detail = data
+            with self.__lock:
+                self.__details[(kind, entity_id)] = detail
+        return detail
+
+    def get_setting(self, path: str):
+        ok, data = self.__server.http_client.req("GET", path)
+        if not ok:
+            raise Exception(data["message"])
+        return data
+
+
+def same_field(key: str, local, remote):
+    """
+    比较一个字段在apply内容中的值与server返回的值是否等价。server对部分字段返回的结构与提交时不同，这里按字段做转换后再比较。
+    """
+    if key == "target":
+        return expand_annotation_target(local) == expand_annotation_target(remote or [])
+    if key in ("annotations", "links", "examples") and isinstance(remote, list) and all(isinstance(i, dict) and "id" in i for i in remote):
+        # server返回的是引用项的详情，提交时可以是id或名称。tag的link还可以是地址(名称列表)，以最后一段作为名称
+        if len(local) != len(remote):
+            return False
+        ids = {i["id"] for i in remote}
+        names = {i.get("name", None) for i in remote}
+        for i in local:
+            ref = i[-1] if isinstance(i, list) else i
+            if not (ref in ids if isinstance(ref, int) else ref in names):
+                return False
+        return True
+    if key == "mappingSourceTags" and isinstance(remote, list):
+        if len(local) != len(remote):
+            return False
+        remote_items = {(i["source"], i["name"]): i for i in remote}
+        for i in local:
+            r = remote_items.get((i["source"], i["name"]), None)
+            # 未指定的displayName与type在提交时不会被修改，因此不参与比较
+            if r is None or any(r.get(k, None) != v for (k, v) in i.items()):
+                return False
+        return True
+    return same_value(local, remote)
+
+
+def same_value(local, remote):
+    """
+    通用的比较。dict只比较apply内容中出现的键，且server多出的键必须是空值，因为提交时缺省的键会被置为空。
+    """
+    if isinstance(local, dict):
+        if not isinstance(remote, dict):
+            return False
+        if any(not same_value(v, remote.get(k, None)) for (k, v) in local.items()):
+            return False
+        return all(not v for (k, v) in remote.items() if k not in local)
+    if isinstance(local, list):
+        return isinstance(remote, list) and len(local) == len(remote) and all(same_value(a, b) for (a, b) in zip(local, remote))
+    if isinstance(local, bool) or isinstance(remote, bool):
+        return local is remote
+    return local == remote
+
+
+def expand_annotation_target(target):
+    result = set()
+    for i in target:
+        result.update(ANNOTATION_TARGET_GROUPS.get(i, (i,)))
+    return result
@@ -1,20 +1,40 @@
 import os.path
+import fcntl
+import functools
 import json
+import re
+import socket
 import subprocess
+import threading
 import time
 
-import requests
 from module.channel import ChannelManager
 from module.local_config import LocalConfig
+from utils.trace import tracer
+from utils.watcher import DirectoryWatcher
 
 
 class Server:
-    def __init__(self, local_config: LocalConfig, channel: ChannelManager):
+    def __init__(self, local_config: LocalConfig, channel: ChannelManager, channel_name: str = None):
+        """
+        :param channel_name: 此实例所操作的频道。不指定时使用当前所用的频道
+        """
         self.__server_path = local_config.server_path
-        self.__appdata_path = local_config.appdata_path
         self.__frontend_path = local_config.frontend_path
         self.__channel = channel
-        self.http_client = ServerHttpClient()
+        self.__channel_name = channel_name
+        self.__start_timeout = local_config.server_start_timeout
+        self.__heartbeat_interval = local_config.heartbeat_interval
+        self.__wait_time = 0.0
+        self.__process = None
+        self.__spawned_pid = None
+        # 心跳线程可能在主线程使用server的同时重新启动server，启动与等待就绪的过程需要互斥
+        self.__start_lock = threading.Lock()
+        self.http_client = ServerHttpClient(pool_size=local_config.http_pool_size,
+                                            timeout=(local_config.http_connect_timeout, local_config.http_read_timeout),
+                                            retries=local_config.http_retries,
+                                            gzip_threshold=local_config.http_gzip_threshold,
+                                            unix_socket=local_config.http_unix_socket)
 
     def status(self):
         """
@@ -27,12 +47,13 @@ class Server:
         }
         """
         pid_file = self.__read_pid_path()
-        if pid_file is None:
+        if pid_file is None or not is_process_alive(pid_file["pid"]):
             return {"status": "STOP"}
         elif pid_file.get("port", None) is None or pid_file.get("token", None) is None:
             return {"status": "STARTING", "pid": pid_file["pid"], "port": pid_file["port"], "start_time": pid_file["startTime"]}
-        self.http_client.set_access(pid_file["port"], pid_file["token"])
+        self.http_client.set_access(pid_file["port"], pid_file["token"], pid_file.get("socket", None))
 
+        import requests
         try:
             ok, data = self.http_client.req("GET", "/app/health")
         except requests.RequestException:
@@ -40,22 +61,25 @@ class Server:
 
         if not ok:
             return {"status": "STARTING", "pid": pid_file["pid"], "port": pid_file["port"], "start_time": pid_file["startTime"]}
-        elif data["status"] == "LOADING":
+        self.http_client.set_request_encodings(data.get("requestEncodings", None))
+        if data["status"] == "LOADING":
             return {"status": "LOADING", "pid": pid_file["pid"], "port": pid_file["port"], "start_time": pid_file["startTime"]}
         else:
             return {"status": "RUNNING", "pid": pid_file["pid"], "port": pid_file["port"], "start_time": pid_file["startTime"]}
 
-    def check_then_start(self):
+    def check_then_start(self, timeout: float = None):
         """
         检查server的状态，然后将其启动，并阻塞线程直到server可用。
         此方法会记录调用信息，在利用server执行任何方法之前都应该首先调用它以确保server可用。
         如果启动遇到阻碍，则会抛出异常。
+        :param timeout: 等待server可用的超时秒数。不指定时使用配置中的serverStartTimeout
         """
-        # 首先判断server是否处于关闭状态。如果是，触发server启动。
-        self.__check_for_process()
-        # 然后判断connection info是否可连通。如果不能连通，持续重试直到超时。
-        self.__check_for_connection_info()
-        # ok!
+        with self.__start_lock:
+            # 首先判断server是否处于关闭状态。如果是，触发server启动。
+            self.__check_for_process()
+            # 然后判断connection info是否可连通。如果不能连通，持续重试直到超时。
+            self.__check_for_connection_info(timeout if timeout is not None else self.__start_timeout)
+            # ok!
 
     def set_permanent_flag(self, value):
         """
@@ -64,14 +88,32 @@ class Server:
         """
         self.http_client.req("POST", "/app/lifetime/permanent", body={"type": "CLI Background Running", "value": value})
 
-    def register_signal(self):
+    def register_signal(self, interval: int = 1000 * 30):
         """
         注册一次生命周期信号，用于暂时维持server不关闭。
+        :param interval: 信号的有效时长，单位为毫秒
         """
-        self.http_client.req("PUT", "/app/lifetime/signal/cli-lifetime-access", {"interval": 1000 * 30})
+        self.http_client.req("PUT", "/app/lifetime/signal/cli-lifetime-access", {"interval": interval})
+
+    def heartbeat(self):
+        """
+        创建一个生命周期心跳，在with块的执行期间持续续期生命周期信号，使server在长时间的任务中不会关闭。
+        用法: with server.heartbeat(): ...
+        """
+        return Heartbeat(self, self.__heartbeat_interval)
+
+    @property
+    def wait_time(self):
+        """
+        累计等待server启动或重启就绪所花费的秒数。server已经可用时的检查不计入。
+        """
+        return self.__wait_time
+
+    def __get_channel_path(self):
+        return self.__channel.path(self.__channel_name)
 
     def __get_pid_path(self):
-        return os.path.join(self.__appdata_path, "channel", self.__channel.current(), "server.pid")
+        return os.path.join(self.__get_channel_path(), "server.pid")
 
     def __read_pid_path(self):
         try:
@@ -79,41 +121,288 @@ class Server:
                 return json.load(f)
         except FileNotFoundError:
             return None
+        except json.JSONDecodeError:
+            # server正在写入pid文件
+            return None
+
+    def __get_spawn_lock_path(self):
+        return os.path.join(self.__get_channel_path(), "server.spawn.lock")
 
     def __check_for_process(self):
-        pid_file = self.__read_pid_path()
-        if pid_file is None:
-            bin_path = os.path.join(self.__server_path, "bin/hedge-v2-server")
-            channel_path = os.path.join(self.__appdata_path, "channel", self.__channel.current())
-            log_path = os.path.join(channel_path, "server.log")
-            args = [bin_path, "--channel-path", channel_path, "--frontend-path", self.__frontend_path]
-            log = open(log_path, "w")
-            subprocess.Popen(args, stdout=log, stderr=log)
-
-    def __check_for_connection_info(self):
-        for _ in range(100):
-            time.sleep(0.1)
-            pid_file = self.__read_pid_path()
-            if pid_file is None:
-                continue
-            self.http_client.set_access(pid_file["port"], pid_file["token"])
+        """
+        检查server进程，必要时启动它。
+        多个CLI进程可能同时调用此方法，因此使用channel目录下的server.spawn.lock文件锁保证同一时刻只有一个进程在做判断。
+        启动server的进程会将新进程的启动记录写入锁文件；在server写出server.pid之前，其他进程据此得知server正在启动，不会再次启动，
+        而是与启动者一样等待server就绪。server.pid出现后，启动记录即被清除。
+        """
+        channel_path = self.__get_channel_path()
+        os.makedirs(channel_path, exist_ok=True)
+        with open(self.__get_spawn_lock_path(), "a+") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
             try:
-                ok, data = self.http_client.req("GET", "/app/health")
+                pid_file = self.__read_pid_path()
+                if pid_file is None and os.path.exists(self.__get_pid_path()):
+                    # pid文件存在但尚未写完，说明已有server正在启动
+                    return
+                if pid_file is not None and is_process_alive(pid_file["pid"]):
+                    if os.fstat(lock.fileno()).st_size > 0:
+                        lock.truncate(0)
+                    return
+                lock.seek(0)
+                spawning = self.__read_spawn_record(lock.read())
+                if spawning is not None:
+                    # 其他CLI进程已启动了server，但它尚未写出pid文件
+                    self.__spawned_pid = spawning
+                    return
+                # pid文件不存在，或者是上次异常退出遗留的文件
+                bin_path = os.path.join(self.__server_path, "bin/hedge-v2-server")
+                log_path = os.path.join(channel_path, "server.log")
+                args = [bin_path, "--channel-path", channel_path, "--frontend-path", self.__frontend_path]
+                log = open(log_path, "w")
+                self.__process = subprocess.Popen(args, stdout=log, stderr=log)
+                self.__spawned_pid = self.__process.pid
+                lock.truncate(0)
+                json.dump({"pid": self.__process.pid, "processStartTime": get_process_start_time(self.__process.pid), "spawnTime": time.time()}, lock)
+                lock.flush()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __read_spawn_record(self, content: str):
+        """
+        解析锁文件中的启动记录。pid可能在被记录的进程退出后被新的进程复用，因此只有进程的启动时间也与记录相符，
+        并且记录写入后尚未超过启动超时时间时，才认为记录的进程就是正在启动的server。
+        :return: 正在启动的server进程的pid。没有有效的记录时返回None
+        """
+        try:
+            record = json.loads(content)
+            pid, process_start_time, spawn_time = record["pid"], record["processStartTime"], record["spawnTime"]
+        except (json.JSONDecodeError, TypeError, KeyError):
+            return None
+        if not 0 <= time.time() - spawn_time < self.__start_timeout:
+            return None
+        if not is_process_alive(pid) or get_process_start_time(pid) != process_start_time:
+            return None
+        return pid
+
+    def __clear_spawn_record(self):
+        """
+        本进程启动的server已就绪或已退出时，清除锁文件中它的启动记录。
+        """
+        with open(self.__get_spawn_lock_path(), "a+") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                lock.seek(0)
+                try:
+                    pid = json.loads(lock.read())["pid"]
+                except (json.JSONDecodeError, TypeError, KeyError):
+                    pid = None
+                if pid == self.__spawned_pid:
+                    lock.truncate(0)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __check_for_connection_info(self, timeout: float):
+        """
+        等待server可用。首先立即检查一次，因此server已经运行时几乎没有额外延迟。
+        server.pid尚未就绪时，监视channel目录，在pid文件被写入时立刻重新检查；server.pid就绪后，以指数退避的间隔检查health。
+        目录监视只在第一次检查失败后才建立，因为关闭inotify实例需要十几毫秒，server已经运行时不应付出这一开销。
+        """
+        import requests
+        start = time.monotonic()
+        deadline = start + timeout
+        delay = 0.005
+        attempts = 0
+        watcher = None
+        try:
+            while True:
+                attempts += 1
+                pid_file = self.__read_pid_path()
+                if pid_file is not None and pid_file.get("port", None) is not None and pid_file.get("token", None) is not None:
+                    self.http_client.set_access(pid_file["port"], pid_file["token"], pid_file.get("socket", None))
+                    try:
+                        ok, data = self.http_client.req("GET", "/app/health")
+                        if ok and data["status"] == "LOADED":
+                            self.http_client.set_request_encodings(data.get("requestEncodings", None))
+                            if attempts > 1:
+                                self.__wait_time += time.monotonic() - start
+                            if self.__spawned_pid is not None:
+                                self.__clear_spawn_record()
+                                self.__spawned_pid = None
+                            return
+                    except requests.RequestException:
+                        pass
+                    pid_ready = True
+                else:
+                    pid_ready = False
+
+                if self.__process is not None:
+                    # 回收已退出的子进程，使其不会作为僵尸进程被当作存活
+                    self.__process.poll()
+                spawning_alive = self.__spawned_pid is not None and is_process_alive(self.__spawned_pid)
+                if pid_file is not None and not is_process_alive(pid_file["pid"]) and not spawning_alive:
+                    raise Exception("Server process %s is not running. See server.log for details." % (pid_file["pid"],))
+                if pid_file is None and self.__spawned_pid is not None and not spawning_alive:
+                    self.__clear_spawn_record()
+                    raise Exception("Server process %s exited before it was ready. See server.log for details." % (self.__spawned_pid,))
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Exception("Cannot establish connection to server. Connection timed out.")
+                if pid_ready:
+                    time.sleep(min(delay, remaining))
+                elif watcher is None:
+                    # 建立监视之前写入的pid文件不会产生事件，因此建立后立即重新检查一次
+                    watcher = DirectoryWatcher(self.__get_channel_path())
+                    continue
+                else:
+                    watcher.wait(min(delay, remaining))
+                delay = min(delay * 2, 0.5)
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+
+class Heartbeat:
+    """
+    在后台线程中以固定间隔续期生命周期信号。每次续期的信号有效时长为间隔的3倍，因此偶尔的续期延迟不会导致server关闭。
+    如果续期时发现server已不可用(例如被意外关闭)，会重新启动server并等待其就绪，所耗时间计入Server.wait_time。
+    重启与其他线程中的check_then_start()互斥，并且不会打断其他线程中正在进行的请求。
+    退出with块(包括因Ctrl-C中断)时停止续期。不会主动注销信号，因为同一信号可能被其他CLI进程共用，它会在有效期后自然过期。
+    """
+    def __init__(self, server: Server, interval: float):
+        self.__server = server
+        self.__interval = interval
+        self.__stop_event = threading.Event()
+        self.__thread = None
+
+    def __enter__(self):
+        self.__server.register_signal(self.__signal_interval())
+        self.__thread = threading.Thread(target=self.__run, name="hedge-heartbeat", daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__stop_event.set()
+        self.__thread.join(timeout=self.__interval)
+
+    def __signal_interval(self):
+        return int(self.__interval * 3 * 1000)
+
+    def __run(self):
+        import requests
+        while not self.__stop_event.wait(self.__interval):
+            try:
+                self.__server.register_signal(self.__signal_interval())
             except requests.RequestException:
-                continue
-            if ok and data["status"] == "LOADED":
-                return
-        raise Exception("Cannot establish connection to server. Connection timed out.")
+                if self.__stop_event.is_set():
+                    break
+                try:
+                    self.__server.check_then_start()
+                    self.__server.register_signal(self.__signal_interval())
+                except Exception:
+                    # 重启失败时保持心跳，在下一个周期重试
+                    pass
+
+
+def get_process_start_time(pid: int):
+    """
+    :return: 进程的启动时间，单位为系统启动后的时钟滴答数。只在Linux上可用，其他平台或进程不存在时返回None
+    """
+    try:
+        with open("/proc/%d/stat" % (pid,)) as f:
+            # 进程名可能包含空格与括号，因此从最后一个")"之后开始计数，starttime是第22个字段
+            return int(f.read().rsplit(")", 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def is_process_alive(pid: int):
+    """
+    通过发送信号0检查进程是否存在。在Linux上额外排除已退出但尚未被回收的僵尸进程。
+    """
+    try:
+        with open("/proc/%d/stat" % (pid,)) as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        if os.path.isdir("/proc/self"):
+            return False
+    except (OSError, IndexError):
+        pass
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
 
 
 class ServerHttpClient:
-    def __init__(self):
+    """
+    与server通信的HTTP客户端。
+    内部持有一个可复用的session，通过连接池保持keep-alive，避免每个请求都重新建立TCP连接。
+    session在第一次请求时才创建，使不访问server的命令不需要加载requests。
+    server在server.pid中声明了unix domain socket时优先通过它通信，连接失败或请求经由socket被拒绝认证时回退到TCP端口。
+    """
+    def __init__(self, pool_size=8, timeout=(3, 300), retries=2, gzip_threshold=1024 * 1024, unix_socket=True):
+        """
+        :param pool_size: 连接池的最大连接数
+        :param timeout: (connect timeout, read timeout)，单位为秒
+        :param retries: 建立连接失败时的重试次数。已发出的请求不会被重试
+        :param gzip_threshold: request body达到此字节数时使用gzip压缩。只在server声明支持时生效；为None时不压缩
+        :param unix_socket: 是否允许使用unix domain socket
+        """
         self.__address = None
+        self.__socket_path = None
+        self.__rejected_socket_path = None
+        self.__unix_socket = unix_socket and hasattr(socket, "AF_UNIX")
         self.__headers = {}
+        self.__gzip_threshold = gzip_threshold
+        self.__gzip_enabled = False
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__pool_size = pool_size
+        self.__session = None
+        # 保护session的创建以及连接目标与adapter的切换。心跳线程重启server时会在其他线程请求的同时调用set_access()
+        self.__session_lock = threading.Lock()
+        self.stats = RequestStats()
+
+    def set_access(self, port, token, socket_path=None):
+        """
+        :param socket_path: server的unix domain socket路径。旧版本的server或不支持unix socket的平台上为None
+        """
+        address = "http://%s:%s" % ("localhost", port)
+        with self.__session_lock:
+            socket_path = socket_path if self.__unix_socket and socket_path != self.__rejected_socket_path else None
+            changed = address != self.__address or socket_path != self.__socket_path
+            self.__address = address
+            self.__socket_path = socket_path
+            self.__headers = {"Authorization": "Bearer %s" % (token,)}
+            if changed and self.__session is not None:
+                self.__mount_adapter(self.__session)
+
+    @property
+    def transport(self):
+        """
+        当前使用的传输方式，"unix"或"tcp"。
+        """
+        return "unix" if self.__socket_path is not None else "tcp"
 
-    def set_access(self, port, token):
-        self.__address = "http://%s:%s" % ("localhost", port)
-        self.__headers = {"Authorization": "Bearer %s" % (token,)}
+    def set_request_encodings(self, encodings):
+        """
+        设置server所支持的request body编码。由health API告知，旧版本的server不支持压缩的body。
+        """
+        self.__gzip_enabled = self.__gzip_threshold is not None and encodings is not None and "gzip" in encodings
+
+    def set_pool_size(self, pool_size):
+        """
+        调整连接池的大小。在多线程并发请求时，应保证连接池不小于线程数，否则多出的连接会在用后被丢弃。
+        """
+        with self.__session_lock:
+            if pool_size > self.__pool_size:
+                self.__pool_size = pool_size
+                if self.__session is not None:
+                    self.__mount_adapter(self.__session)
 
     def req(self, method, path, body=None, query=None):
         """
@@ -121,11 +410,235 @@ class ServerHttpClient:
         """
         if self.__address is None:
             raise Exception("Port & token is not set.")
-        res = requests.request(method=method, url="%s%s" % (self.__address, path),
-                               headers=self.__headers, params=query,
-                               data=json.dumps(body) if body is not None else None)
+        if self.__session is None:
+            self.__create_session()
+        headers = self.__headers
+        data = None
+        if body is not None:
+            data = dumps_json(body)
+            if self.__gzip_enabled and len(data) >= self.__gzip_threshold:
+                # 本机通信时带宽不是瓶颈，使用最快的压缩级别，以免压缩本身的耗时超过节省的传输时间
+                import gzip
+                data = gzip.compress(data, compresslevel=1)
+                headers = dict(headers, **{"Content-Type": "application/json; charset=utf-8", "Content-Encoding": "gzip"})
+            else:
+                headers = dict(headers, **{"Content-Type": "application/json; charset=utf-8"})
+        start = time.perf_counter()
+        res = None
         try:
-            content = res.json()
+            try:
+                res = self.__send(method, path, headers, query, data)
+            except OSError as e:
+                # socket文件失效(例如server异常退出后遗留)时回退到TCP端口。只处理建立连接的失败，此时请求尚未发出，重新发送是安全的
+                if self.__socket_path is None or not is_connect_error(e):
+                    raise
+                self.__disable_socket(rejected=False)
+                res = self.__send(method, path, headers, query, data)
+            if res.status_code in (401, 403) and self.__socket_path is not None:
+                # 只信任loopback地址的server会以REMOTE_DISABLED拒绝经由socket的请求。认证在处理请求之前进行，被拒绝的请求没有产生任何效果，
+                # 因此改用TCP重新发送是安全的。记住被拒绝的socket，此后set_access()不会再启用它
+                self.__disable_socket(rejected=True)
+                res = self.__send(method, path, headers, query, data)
+        finally:
+            end = time.perf_counter()
+            self.stats.record(method, path, end - start)
+            if tracer.enabled:
+                tracer.complete("%s %s" % (method, path), "http", start, end, {
+                    "status": res.status_code if res is not None else None,
+                    "transport": self.transport,
+                    "sentBytes": len(data) if data is not None else 0,
+                    "contentEncoding": headers.get("Content-Encoding", None),
+                    "receivedBytes": len(res.content) if res is not None else 0
+                })
+        try:
+            content = loads_json(res.content)
         except json.JSONDecodeError:
             content = None
         return res.ok, content
+
+    def __send(self, method, path, headers, query, data):
+        return self.__session.request(method=method, url="%s%s" % (self.__address, path),
+                                      headers=headers, params=query, data=data,
+                                      timeout=self.__timeout)
+
+    def __disable_socket(self, rejected: bool):
+        with self.__session_lock:
+            if self.__socket_path is not None:
+                if rejected:
+                    self.__rejected_socket_path = self.__socket_path
+                self.__socket_path = None
+                self.__mount_adapter(self.__session)
+
+    def close(self):
+        if self.__session is not None:
+            self.__session.close()
+            self.__session = None
+
+    def __create_session(self):
+        import requests
+        with self.__session_lock:
+            if self.__session is None:
+                session = requests.Session()
+                # server总在本机。不需要环境变量中的代理设置与.netrc，requests在每个请求中查找它们时都要遍历全部环境变量
+                session.trust_env = False
+                self.__mount_adapter(session)
+                self.__session = session
+
+    def __mount_adapter(self, session):
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        retry = Retry(total=self.__retries, connect=self.__retries, read=0, redirect=0, status=0, backoff_factor=0.05)
+        session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=self.__pool_size, max_retries=retry))
+        if self.__socket_path is not None:
+            # 前缀更长的adapter优先匹配，因此只有发往server的请求会经过unix socket
+            session.mount(self.__address, create_unix_adapter(self.__socket_path, self.__pool_size, retry))
+        elif self.__address is not None:
+            session.adapters.pop(self.__address, None)
+
+
+def create_unix_adapter(socket_path: str, pool_size: int, retry):
+    """
+    创建经由unix domain socket发送请求的requests adapter。URL中的host与端口只用于构成Host头，实际连接总是指向socket_path。
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection
+    from urllib3.connectionpool import HTTPConnectionPool
+    from urllib3.exceptions import NewConnectionError
+
+    class UnixHTTPConnection(HTTPConnection):
+        def _new_conn(self):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(socket_path)
+            except OSError as e:
+                sock.close()
+                raise NewConnectionError(self, "Failed to connect to unix socket %s: %s" % (socket_path, e))
+            return sock
+
+    class UnixHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = UnixHTTPConnection
+
+    class UnixHTTPAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {"http": UnixHTTPConnectionPool}
+
+    return UnixHTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+
+def is_connect_error(e: OSError):
+    """
+    判断requests抛出的异常是否是建立连接时的失败。
+    """
+    from urllib3.exceptions import MaxRetryError, NewConnectionError
+    reason = e.args[0] if len(e.args) > 0 else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, NewConnectionError)
+
+
+def dumps_json(body):
+    """
+    将request body序列化为UTF-8的JSON。安装了orjson时使用orjson，它比标准库快一个数量级；orjson无法处理的值(例如超出64位的整数)回退到标准库。
+    """
+    orjson = get_orjson()
+    if orjson is not None:
+        try:
+            return orjson.dumps(body)
+        except TypeError:
+            pass
+    return json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads_json(content: bytes):
+    orjson = get_orjson()
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+@functools.cache
+def get_orjson():
+    """
+    orjson是可选依赖。在第一次序列化时才加载，使不访问server的命令不需要加载它。
+    """
+    try:
+        import orjson
+        return orjson
+    except ImportError:
+        return None
+
+
+class RequestStats:
+    """
+    统计HTTP请求的耗时。按endpoint(method + 去除数字id后的path)分组聚合，默认不保存单个请求的记录。
+    """
+    def __init__(self, keep_samples: bool = False):
+        """
+        :param keep_samples: 保存每个请求的耗时，以便计算分位数。内存占用与请求数成正比，只在测量时开启
+        """
+        self.__endpoints = {}
+        self.__samples = [] if keep_samples else None
+        self.__lock = threading.Lock()
+
+    def record(self, method: str, path: str, duration: float):
+        key = "%s %s" % (method, re.sub(r"/\d+(?=/|$)", "/{id}", path))
+        with self.__lock:
+            if self.__samples is not None:
+                self.__samples.append(duration)
+            stat = self.__endpoints.get(key, None)
+            if stat is None:
+                self.__endpoints[key] = {"count": 1, "total": duration, "max": duration}
+            else:
+                stat["count"] += 1
+                stat["total"] += duration
+                if duration > stat["max"]:
+                    stat["max"] = duration
+
+    def export(self):
+        """
+        :return: 按endpoint分组的统计数据，可以传递到其他进程后以merge()合并
+        """
+        with self.__lock:
+            return {k: dict(v) for (k, v) in self.__endpoints.items()}
+
+    def merge(self, endpoints: dict):
+        """
+        合并export()导出的统计数据。单个请求的耗时不会被合并，因此不影响percentile()。
+        """
+        with self.__lock:
+            for (key, other) in endpoints.items():
+                stat = self.__endpoints.get(key, None)
+                if stat is None:
+                    self.__endpoints[key] = dict(other)
+                else:
+                    stat["count"] += other["count"]
+                    stat["total"] += other["total"]
+                    stat["max"] = max(stat["max"], other["max"])
+
+    @property
+    def count(self):
+        return sum(i["count"] for i in self.__endpoints.values())
+
+    @property
+    def total_time(self):
+        return sum(i["total"] for i in self.__endpoints.values())
+
+    def percentile(self, p: float):
+        """
+        :param p: 0~100之间的百分位
+        :return: 全部请求耗时的百分位数，单位为秒。未开启keep_samples或没有请求时返回None
+        """
+        with self.__lock:
+            if not self.__samples:
+                return None
+            samples = sorted(self.__samples)
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def summary(self):
+        """
+        :return: [(endpoint, count, total seconds, avg seconds, max seconds)]，按总耗时倒序
+        """
+        return sorted(((k, v["count"], v["total"], v["total"] / v["count"], v["max"]) for (k, v) in self.__endpoints.items()),
+                      key=lambda i: i[2], reverse=True)
@@ -0,0 +1,98 @@
+from schema import Schema, And, Or, Optional
+
+
+class CompiledSchema:
+    """
+    将schema库的Schema定义预先编译为嵌套的校验函数，作为校验的快速路径。
+    快速路径只判断是否通过；不通过时回退到原始的Schema.validate，因此抛出的SchemaError与原先完全一致。
+    编译推迟到第一次校验时进行，因此定义CompiledSchema本身几乎没有开销。
+    """
+    def __init__(self, schema: Schema):
+        self.__schema = schema
+        self.__check = None
+
+    @property
+    def schema(self):
+        return self.__schema.schema
+
+    def validate(self, data):
+        if self.__check is None:
+            self.__check = compile_check(self.__schema.schema)
+        if self.__check(data):
+            return data
+        return self.__schema.validate(data)
+
+
+def compile_check(s):
+    """
+    编译一个schema定义，返回一个判断数据是否符合定义的函数。判断规则与schema 0.7.x的Schema.validate保持一致。
+    """
+    if isinstance(s, (Schema, CompiledSchema)):
+        # Optional也是Schema的子类
+        return compile_check(s.schema)
+    if isinstance(s, Or):
+        checks = [compile_check(i) for i in s.args]
+        if len(checks) == 2:
+            first, second = checks
+            return lambda data: first(data) or second(data)
+        return lambda data: any(check(data) for check in checks)
+    if isinstance(s, And):
+        checks = [compile_check(i) for i in s.args]
+        if len(checks) == 2:
+            first, second = checks
+            return lambda data: first(data) and second(data)
+        return lambda data: all(check(data) for check in checks)
+    if isinstance(s, (list, tuple, set, frozenset)):
+        return _compile_iterable(s)
+    if isinstance(s, dict):
+        return _compile_dict(s)
+    if isinstance(s, type):
+        if s is int:
+            return lambda data: isinstance(data, int) and not isinstance(data, bool)
+        return lambda data: isinstance(data, s)
+    if callable(s):
+        return _compile_callable(s)
+    return lambda data: s == data
+
+
+def _compile_iterable(s):
+    container_type = type(s)
+    checks = [compile_check(i) for i in s]
+    if len(checks) == 1:
+        check = checks[0]
+        return lambda data: isinstance(data, container_type) and all(check(d) for d in data)
+    return lambda data: isinstance(data, container_type) and all(any(check(d) for check in checks) for d in data)
+
+
+def _compile_dict(s):
+    # 只支持以字面量(或Optional包装的字面量)为key的dict定义，这也是apply中全部schema的用法
+    fields = {}
+    required = set()
+    for (k, v) in s.items():
+        key = k.schema if isinstance(k, Optional) else k
+        if isinstance(key, (type, Schema, And, Or)) or callable(key):
+            raise TypeError("Dict key %r cannot be compiled." % (k,))
+        fields[key] = compile_check(v)
+        if not isinstance(k, Optional):
+            required.add(key)
+
+    def check(data):
+        if not isinstance(data, dict):
+            return False
+        for (key, value) in data.items():
+            field_check = fields.get(key, None)
+            if field_check is None or not field_check(value):
+                return False
+        return all(key in data for key in required)
+
+    return check
+
+
+def _compile_callable(s):
+    def check(data):
+        try:
+            return bool(s(data))
+        except Exception:
+            return False
+
+    return check
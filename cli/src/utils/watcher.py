@@ -0,0 +1,89 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+_event_header = struct.Struct("iIII")
+_libc = None
+
+
+class DirectoryWatcher:
+    """
+    监视一个目录中文件的变化。
+    在Linux上使用inotify，文件发生变化时wait()会立刻返回；在其他平台或inotify不可用时，退化为按超时时间轮询。
+    """
+    def __init__(self, path: str, mask: int = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE):
+        self.__fd = None
+        libc = _load_libc()
+        if libc is not None:
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                if libc.inotify_add_watch(fd, os.fsencode(path), mask) >= 0:
+                    self.__fd = fd
+                else:
+                    os.close(fd)
+
+    @property
+    def native(self):
+        """
+        是否使用了inotify。
+        """
+        return self.__fd is not None
+
+    def wait(self, timeout: float):
+        """
+        等待目录中发生变化，最多等待timeout秒。
+        :return: 发生变化的[(mask, filename)]，超时时返回空列表。轮询模式下无法得知变化，总是在超时后返回None，调用方需要自行检查
+        """
+        if self.__fd is None:
+            time.sleep(timeout)
+            return None
+        readable, _, _ = select.select([self.__fd], [], [], max(timeout, 0))
+        if not readable:
+            return []
+        try:
+            data = os.read(self.__fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _event_header.size <= len(data):
+            _, mask, _, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append((mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            _libc = libc
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc or None
@@ -8,5 +8,6 @@ if [ ! -d "$CLI_PATH/venv" ]; then
 fi
 
 source $CLI_PATH/venv/bin/activate
-python3 $CLI_PATH/src/hedge.py $@
+# 以模块方式运行，使hedge.py也能使用__pycache__中编译好的字节码
+PYTHONPATH="$CLI_PATH/src" python3 -m hedge "$@"
 deactivate
\ No newline at end of file
@@ -0,0 +1,178 @@
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+import types
+import pytest
+
+CLI_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+STUB_SERVER_PATH = os.path.join(CLI_PATH, "tests/stub-server")
+
+sys.path.insert(0, os.path.join(CLI_PATH, "src"))
+sys.path.insert(0, os.path.join(CLI_PATH, "bench"))
+
+from mock_server import MockServer
+from module.server import Server, ServerHttpClient
+
+
+class CliEnv:
+    """
+    复制到临时目录中的一份cli。LocalConfig从src的上一级读取conf.local.json，因此测试不会用到开发环境中的配置与数据。
+    """
+    def __init__(self, root: str, conf: dict):
+        self.cli_path = os.path.join(root, "cli")
+        self.userdata_path = os.path.join(root, "userdata")
+        self.appdata_path = os.path.join(self.userdata_path, "appdata")
+        shutil.copytree(os.path.join(CLI_PATH, "src"), os.path.join(self.cli_path, "src"), ignore=shutil.ignore_patterns("__pycache__"))
+        os.makedirs(self.appdata_path)
+        with open(os.path.join(self.cli_path, "conf.local.json"), "w") as f:
+            json.dump(dict({"userdataPath": self.userdata_path, "appdataPath": self.appdata_path, "serverPath": STUB_SERVER_PATH}, **conf), f)
+
+    def channel_path(self, channel: str = "default"):
+        return os.path.join(self.appdata_path, "channel", channel)
+
+    def create_channel(self, channel: str):
+        os.makedirs(self.channel_path(channel))
+        with open(os.path.join(self.channel_path(channel), "public.dat"), "w") as f:
+            json.dump({"dbPath": "@/default"}, f)
+
+    def spawned_servers(self, channel: str = "default"):
+        return spawned_servers(self.channel_path(channel))
+
+    def stop_servers(self):
+        channel_dir = os.path.join(self.appdata_path, "channel")
+        stop_servers([pid for channel in (os.listdir(channel_dir) if os.path.isdir(channel_dir) else ()) for pid in self.spawned_servers(channel)])
+
+    def command(self, *args, python_args=()):
+        return [sys.executable, *python_args, os.path.join(self.cli_path, "src/hedge.py"), *args]
+
+    def environ(self, **env):
+        environ = dict(dict(os.environ, HEDGE_NO_AGENT="1"), **env)
+        # 允许写入字节码缓存，否则每次启动都要重新编译，测得的不是实际的启动耗时
+        environ.pop("PYTHONDONTWRITEBYTECODE", None)
+        return environ
+
+    def run(self, *args, python_args=(), env: dict = None, timeout: float = 60):
+        return subprocess.run(self.command(*args, python_args=python_args), env=self.environ(**(env or {})),
+                              capture_output=True, text=True, timeout=timeout)
+
+    def popen(self, *args, env: dict = None):
+        return subprocess.Popen(self.command(*args), env=self.environ(**(env or {})),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+def spawned_servers(channel_path: str):
+    """
+    :return: 桩server在此频道被启动过的进程pid列表
+    """
+    try:
+        with open(os.path.join(channel_path, "stub-spawns.log")) as f:
+            return [int(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def stop_servers(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + 5
+    for pid in pids:
+        while time.monotonic() < deadline and is_alive(pid):
+            time.sleep(0.02)
+
+
+def is_alive(pid: int):
+    try:
+        # 由测试进程中的Server启动的桩server是测试进程的子进程，需要回收，否则会作为僵尸进程一直存在
+        os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        pass
+    try:
+        # 桩server是cli进程的子进程，cli退出后由init收养，这里只能通过kill探测
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+
+
+class SingleChannel:
+    """
+    只有一个频道的ChannelManager替身。
+    """
+    def __init__(self, channel_path: str):
+        self.__channel_path = channel_path
+
+    def path(self, channel_name: str = None):
+        return self.__channel_path
+
+
+def local_config(**conf):
+    """
+    以桩server为启动目标的LocalConfig替身。配置项与LocalConfig的属性同名，未指定的项使用LocalConfig的默认值。
+    """
+    config = dict(server_path=STUB_SERVER_PATH, frontend_path=os.path.join(STUB_SERVER_PATH, "frontend"), http_pool_size=8,
+                  http_connect_timeout=3, http_read_timeout=300, http_retries=2, http_gzip_threshold=1024 * 1024, http_unix_socket=True,
+                  server_start_timeout=30, heartbeat_interval=10)
+    return types.SimpleNamespace(**dict(config, **conf))
+
+
+def create_server(channel_path: str, **conf):
+    """
+    创建以桩server为启动目标的Server。
+    """
+    return Server(local_config(**conf), SingleChannel(channel_path))
+
+
+class ClientOnlyServer:
+    """
+    只提供http_client的Server替身，连接到MockServer。Applier、Importation等模块只通过http_client访问server，测试它们时不需要配置文件与启动流程。
+    """
+    def __init__(self, channel_path: str, **kwargs):
+        with open(os.path.join(channel_path, "server.pid")) as f:
+            pid_file = json.load(f)
+        self.http_client = ServerHttpClient(**kwargs)
+        self.http_client.set_access(pid_file["port"], pid_file["token"], pid_file["socket"])
+
+
+@pytest.fixture
+def channel_path(tmp_path):
+    path = os.path.join(str(tmp_path), "channel")
+    os.makedirs(path)
+    with open(os.path.join(path, "public.dat"), "w") as f:
+        json.dump({"dbPath": "@/default"}, f)
+    return path
+
+
+@pytest.fixture
+def mock(channel_path):
+    with MockServer(channel_path) as mock:
+        yield mock
+
+
+@pytest.fixture
+def server(mock, channel_path):
+    server = ClientOnlyServer(channel_path)
+    yield server
+    server.http_client.close()
+
+
+@pytest.fixture
+def cli_env(tmp_path):
+    env = CliEnv(str(tmp_path), {})
+    yield env
+    env.stop_servers()
+
+
+@pytest.fixture
+def spawning_channel(channel_path):
+    """
+    供create_server()使用的频道目录。结束时停止其中被启动的桩server。
+    """
+    yield channel_path
+    stop_servers(spawned_servers(channel_path))
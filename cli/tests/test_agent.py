@@ -0,0 +1,187 @@
+import os
+import socket
+import time
+import pytest
+from module.agent import is_same_user
+from module import agent_client
+from module.agent_client import AGENT_SOCKET, get_source_signature, send_message, recv_message
+
+# 测试环境默认以HEDGE_NO_AGENT禁用转发，这里将其置空，使命令交给agent执行
+AGENT_ENV = {"HEDGE_NO_AGENT": ""}
+
+
+def get_socket_path(cli_env):
+    return os.path.join(cli_env.cli_path, AGENT_SOCKET)
+
+
+def agent_request(cli_env, message: dict, fds=()):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(30)
+        sock.connect(get_socket_path(cli_env))
+        send_message(sock, message, fds)
+        return recv_message(sock)[0]
+
+
+def wait_agent(cli_env, timeout: float = 20, restarted_from: dict = None):
+    """
+    等待agent就绪。
+    :param restarted_from: agent重启之前的状态，等待以此之后启动的agent
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            status = agent_request(cli_env, {"control": "status"})
+            if restarted_from is None or status["startTime"] != restarted_from["startTime"]:
+                return status
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.05)
+    raise TimeoutError("Agent is not ready.")
+
+
+@pytest.fixture
+def agent(cli_env):
+    process = cli_env.popen("agent", "run", "--idle-timeout", "0")
+    try:
+        yield wait_agent(cli_env)
+    finally:
+        process.terminate()
+        process.communicate(timeout=30)
+
+
+def test_commands_run_concurrently_through_agent(cli_env, agent):
+    for i in range(3):
+        filepath = os.path.join(cli_env.userdata_path, "%s.jpg" % (i,))
+        with open(filepath, "wb") as f:
+            f.write(b"image %d" % (i,))
+        result = cli_env.run("import", "add", filepath, env=AGENT_ENV)
+        assert result.returncode == 0, result.stderr
+
+    processes = [cli_env.popen("import", "list", "--format", "ndjson", env=AGENT_ENV) for _ in range(6)]
+    outputs = [process.communicate(timeout=60) for process in processes]
+    for (process, (stdout, stderr)) in zip(processes, outputs):
+        assert process.returncode == 0, stderr
+        assert len(stdout.splitlines()) == 3
+    assert len(set(stdout for (stdout, _) in outputs)) == 1
+
+    status = agent_request(cli_env, {"control": "status"})
+    assert status["requests"] == 9
+    assert status["running"] == 0
+    # agent自身只有一个线程，fork出的命令不会继承其他线程持有的锁；保持server的线程在keeper进程中
+    assert os.listdir("/proc/%s/task" % (agent["pid"],)) == [str(agent["pid"])]
+
+
+def run_command(cli_env, argv, cwd: str, stdout: str, stderr: str):
+    """
+    像hedge.py一样向agent发送一个命令，命令的stdout/stderr写入指定的文件。
+    """
+    with open(os.devnull) as stdin_file, open(stdout, "w") as stdout_file, open(stderr, "w") as stderr_file:
+        return agent_request(cli_env, {"argv": ["hedge.py", *argv], "cwd": cwd, "env": dict(os.environ), "encoding": "utf-8",
+                                       "source": get_source_signature()},
+                             [stdin_file.fileno(), stdout_file.fileno(), stderr_file.fileno()])
+
+
+def read_file(filepath: str):
+    with open(filepath) as f:
+        return f.read()
+
+
+def test_stdio_is_passed_to_command(cli_env, agent, tmp_path, monkeypatch):
+    """
+    客户端的stdin/stdout/stderr以SCM_RIGHTS传给agent，命令的子进程直接读写它们。
+    """
+    monkeypatch.setattr(agent_client, "CLI_PATH", cli_env.cli_path)
+    stdout = str(tmp_path / "stdout")
+    stderr = str(tmp_path / "stderr")
+    assert run_command(cli_env, ["channel", "info"], str(tmp_path), stdout, stderr) == {"exitCode": 0}
+    assert "正在使用的频道: default" in read_file(stdout)
+    assert run_command(cli_env, ["no-such-command"], str(tmp_path), stdout, stderr) == {"exitCode": 2}
+    assert "no-such-command" in read_file(stderr)
+    assert read_file(stdout) == ""
+
+    # 没有随请求传来文件描述符的命令不会被执行
+    response = agent_request(cli_env, {"argv": ["hedge.py", "channel", "info"], "cwd": str(tmp_path), "env": dict(os.environ),
+                                       "encoding": "utf-8", "source": get_source_signature()})
+    assert response == {"stale": True}
+    assert agent_request(cli_env, {"control": "status"})["requests"] == 2
+
+
+def test_is_same_user(monkeypatch):
+    (a, b) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    with a, b:
+        assert is_same_user(a)
+        if hasattr(socket, "SO_PEERCRED"):
+            uid = os.getuid()
+            monkeypatch.setattr(os, "getuid", lambda: uid + 1)
+            assert not is_same_user(a)
+
+
+@pytest.mark.skipif(not hasattr(socket, "SO_PEERCRED") or os.getuid() != 0, reason="Requires SO_PEERCRED and root to switch users.")
+def test_agent_rejects_other_users(cli_env, agent):
+    # socket本身只对当前用户可访问，这里放开它的权限，以确认agent还会检查对端的uid
+    os.chmod(get_socket_path(cli_env), 0o777)
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            # 以相对路径连接，不需要上级的临时目录对其他用户可访问
+            os.chdir(cli_env.cli_path)
+            os.setgid(65534)
+            os.setuid(65534)
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(10)
+                sock.connect(AGENT_SOCKET)
+                try:
+                    send_message(sock, {"control": "status"})
+                    recv_message(sock)
+                    os.write(write_fd, b"replied")
+                except (OSError, ValueError):
+                    # agent不读取请求就关闭了连接
+                    os.write(write_fd, b"closed")
+        except BaseException as e:
+            os.write(write_fd, repr(e).encode())
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    os.waitpid(pid, 0)
+    with os.fdopen(read_fd, "rb") as f:
+        assert f.read() == b"closed"
+    assert agent_request(cli_env, {"control": "status"})["pid"] == agent["pid"]
+
+
+def test_agent_restarts_after_source_update(cli_env, agent):
+    # 使cli_env中的代码比agent加载的更新
+    mtime = time.time() + 10
+    os.utime(os.path.join(cli_env.cli_path, "src", "hedge.py"), (mtime, mtime))
+    result = cli_env.run("channel", "info", env=AGENT_ENV)
+    assert result.returncode == 0, result.stderr
+    assert "正在使用的频道: default" in result.stdout
+
+    # 旧agent拒绝了这个命令，命令在客户端进程中执行；agent随后以新代码重启
+    status = wait_agent(cli_env, restarted_from=agent)
+    assert status["pid"] == agent["pid"]
+    assert status["requests"] == 0
+    result = cli_env.run("channel", "info", env=AGENT_ENV)
+    assert result.returncode == 0, result.stderr
+    assert agent_request(cli_env, {"control": "status"})["requests"] == 1
+
+
+def test_no_agent_env_runs_in_process(cli_env, agent):
+    result = cli_env.run("channel", "info")
+    assert result.returncode == 0, result.stderr
+    assert "正在使用的频道: default" in result.stdout
+    assert agent_request(cli_env, {"control": "status"})["requests"] == 0
+    result = cli_env.run("channel", "info", env=AGENT_ENV)
+    assert result.returncode == 0, result.stderr
+    assert agent_request(cli_env, {"control": "status"})["requests"] == 1
+
+
+def test_leftover_socket_runs_in_process(cli_env):
+    cli_env.create_channel("default")
+    # 异常退出的agent遗留的socket文件
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(get_socket_path(cli_env))
+    result = cli_env.run("channel", "info", env=AGENT_ENV)
+    assert result.returncode == 0, result.stderr
+    assert "正在使用的频道: default" in result.stdout
@@ -0,0 +1,243 @@
+import json
+import threading
+import requests
+from module.apply import Applier, SourceBatchSizer, SOURCE_BATCH_SIZE, SOURCE_BATCH_MAX_SIZE, SOURCE_BATCH_MIN_SIZE, SOURCE_BATCH_MAX_BYTES, \
+    iter_documents, parse_files
+from mock_server import MockServer
+from conftest import ClientOnlyServer
+
+
+class BulkHttpClient:
+    """
+    只实现source bulk提交的HTTP客户端替身。
+    :param respond: 对每个bulk请求的items返回(ok, data)，或抛出requests的异常
+    """
+    def __init__(self, respond):
+        self.__respond = respond
+        self.__lock = threading.Lock()
+        self.bulk_requests = []
+
+    def set_pool_size(self, pool_size):
+        pass
+
+    def req(self, method, path, body=None, query=None):
+        assert (method, path) == ("POST", "/api/source-images/bulk")
+        with self.__lock:
+            self.bulk_requests.append(len(body["items"]))
+            count = len(self.bulk_requests)
+        return self.__respond(body["items"], count)
+
+
+class BulkServer:
+    def __init__(self, respond):
+        self.http_client = BulkHttpClient(respond)
+
+
+def apply_sources(respond, count: int = 100):
+    server = BulkServer(respond)
+    applier = Applier(server)
+    applier.apply_validated("source", "v1", [{"source": "s", "sourceId": i} for i in range(count)])
+    applier.submit()
+    return server.http_client.bulk_requests, applier.submit_errors
+
+
+def test_item_rejection_is_bisected_to_the_item():
+    def respond(items, _):
+        if any(i["sourceId"] == 13 for i in items):
+            return False, {"code": "PARAM_ERROR", "message": "Invalid item."}
+        return True, None
+
+    bulk_requests, errors = apply_sources(respond)
+    assert errors == [("source", "s:13", "Invalid item.")]
+    # 二分的每一层有两个请求，不会退化为逐项提交
+    assert len(bulk_requests) <= 2 * 7 + 1
+
+
+def test_transport_failure_is_not_bisected():
+    def respond(items, _):
+        raise requests.ConnectionError("Connection refused.")
+
+    bulk_requests, errors = apply_sources(respond)
+    assert bulk_requests == [100, 50, 50]
+    assert [(kind, name) for (kind, name, _) in errors] == [("source", "s:0 ~ s:49 (50 items)"), ("source", "s:50 ~ s:99 (50 items)")]
+
+
+def test_transport_failure_is_retried_once():
+    def respond(items, count):
+        if count == 1:
+            raise requests.ReadTimeout("Read timed out.")
+        return True, None
+
+    bulk_requests, errors = apply_sources(respond)
+    assert bulk_requests == [100, 50, 50]
+    assert errors == []
+
+
+def test_batch_size_is_limited_by_payload_bytes():
+    sizer = SourceBatchSizer()
+    small = [{"source": "s", "sourceId": i} for i in range(100)]
+    assert sizer.size(small) == SOURCE_BATCH_SIZE
+    sizer = SourceBatchSizer()
+    large = [{"source": "s", "sourceId": i, "description": "x" * 20000} for i in range(100)]
+    size = sizer.size(large)
+    assert SOURCE_BATCH_MIN_SIZE <= size < SOURCE_BATCH_SIZE
+    assert size * 20000 <= SOURCE_BATCH_MAX_BYTES
+
+
+def test_batch_size_follows_response_time():
+    sizer = SourceBatchSizer()
+    items = [{"source": "s", "sourceId": i} for i in range(100)]
+    # 耗时超过目标时按比例缩小
+    sizer.feedback(SOURCE_BATCH_SIZE, 8.0, ok=True, transport_failed=False)
+    assert sizer.size(items) == SOURCE_BATCH_SIZE // 4
+    # 远低于目标时逐步放大，但不超过上限
+    for _ in range(20):
+        sizer.feedback(sizer.size(items), 0.1, ok=True, transport_failed=False)
+    assert sizer.size(items) == SOURCE_BATCH_MAX_SIZE
+    # 不满一批的提交不能说明server能处理更大的批次
+    sizer = SourceBatchSizer()
+    sizer.feedback(10, 0.1, ok=True, transport_failed=False)
+    assert sizer.size(items) == SOURCE_BATCH_SIZE
+
+
+def test_batch_size_halves_on_transport_failure_only():
+    sizer = SourceBatchSizer()
+    items = [{"source": "s", "sourceId": i} for i in range(100)]
+    sizer.feedback(SOURCE_BATCH_SIZE, 30.0, ok=False, transport_failed=False)
+    assert sizer.size(items) == SOURCE_BATCH_SIZE
+    sizer.feedback(SOURCE_BATCH_SIZE, 30.0, ok=False, transport_failed=True)
+    assert sizer.size(items) == SOURCE_BATCH_SIZE // 2
+    for _ in range(20):
+        sizer.feedback(sizer.size(items), 30.0, ok=False, transport_failed=True)
+    assert sizer.size(items) == SOURCE_BATCH_MIN_SIZE
+
+
+def test_parse_files_matches_serial_parsing(tmp_path):
+    filepaths = []
+    for f in range(4):
+        filepath = str(tmp_path / ("%s.ndjson" % (f,)))
+        with open(filepath, "w") as out:
+            for d in range(3):
+                spec = [{"source": "s", "sourceId": f * 100 + d * 10 + i, "title": "t%s" % (i,)} for i in range(10)]
+                out.write(json.dumps({"kind": "source", "spec": spec}) + "\n")
+        filepaths.append(filepath)
+    serial = []
+    for filepath in filepaths:
+        with open(filepath) as f:
+            serial.append(list(iter_documents(f, "ndjson", filepath)))
+    assert list(parse_files(filepaths, 2)) == serial
+
+
+def test_cli_apply_with_jobs(cli_env, tmp_path):
+    directory = tmp_path / "docs"
+    directory.mkdir()
+    for f in range(3):
+        with open(str(directory / ("%s.ndjson" % (f,))), "w") as out:
+            out.write(json.dumps({"kind": "source", "spec": [{"source": "s", "sourceId": f * 10 + i} for i in range(4)]}) + "\n")
+    with open(str(directory / "3.yaml"), "w") as out:
+        out.write("kind: tag\nspec:\n- name: t\n  type: TAG\n")
+    result = cli_env.run("apply", "-d", str(directory), "--jobs", "2")
+    assert result.returncode == 0, result.stderr
+    assert "已更新12个来源数据项" in result.stdout
+    assert "已添加1个标签项" in result.stdout
+
+    # 子进程中的校验错误带着文件名与行号报告给调用方
+    with open(str(directory / "4.ndjson"), "w") as out:
+        out.write("\n" + json.dumps({"kind": "source", "spec": [{"source": "s"}]}) + "\n")
+    result = cli_env.run("apply", "-d", str(directory), "--jobs", "2", "--full")
+    assert result.returncode != 0
+    assert "4.ndjson, line 2" in result.stderr
+
+
+def test_stream_refuses_jobs(cli_env, tmp_path):
+    filepath = str(tmp_path / "a.yaml")
+    with open(filepath, "w") as f:
+        f.write("kind: source\nspec: []\n")
+    result = cli_env.run("apply", "--stream", "--jobs", "2", "-f", filepath)
+    assert result.returncode == 2
+    assert "--jobs" in result.stderr
+
+
+def test_stream_submits_sources_while_applying():
+    received = threading.Event()
+
+    def respond(items, _):
+        received.set()
+        return True, None
+
+    server = BulkServer(respond)
+    applier = Applier(server, stream=True)
+    applier.apply_validated("source", "v1", [{"source": "s", "sourceId": i} for i in range(1500)])
+    # 满一批的数据在submit()之前就已经提交，剩余的不满一批的数据留到submit()
+    assert received.wait(5)
+    assert server.http_client.bulk_requests == [1000]
+    applier.submit()
+    assert server.http_client.bulk_requests == [1000, 500]
+    assert applier.updated == {"source": 1500}
+    assert applier.submit_errors == []
+
+
+def test_stream_blocks_parsing_when_backlog_is_full():
+    gate = threading.Event()
+
+    def respond(items, _):
+        gate.wait(5)
+        return True, None
+
+    server = BulkServer(respond)
+    applier = Applier(server, stream=True)
+    thread = threading.Thread(target=applier.apply_validated, args=("source", "v1", [{"source": "s", "sourceId": i} for i in range(10000)]))
+    thread.start()
+    thread.join(0.5)
+    # 一个批次正在提交，后台最多再积压2个批次，解析因此被阻塞
+    assert thread.is_alive()
+    assert server.http_client.bulk_requests == [1000]
+    gate.set()
+    thread.join(5)
+    assert not thread.is_alive()
+    applier.submit()
+    assert sum(server.http_client.bulk_requests) == 10000
+
+
+def list_entities(server, api_path):
+    ok, data = server.http_client.req("GET", api_path, query={"limit": 1000})
+    assert ok
+    return {e["name"]: e for e in data["result"]}
+
+
+def test_entities_are_submitted_after_their_parents(channel_path):
+    # 延迟使并发的请求交错；部分新建的项返回ALREADY_EXISTS，走查询id再PATCH的路径
+    with MockServer(channel_path, latency=0.01, conflict_rate=0.3, seed=1):
+        server = ClientOnlyServer(channel_path)
+        try:
+            applier = Applier(server, concurrency=4)
+            applier.apply_validated("topic", "v1", [
+                {"name": "t%s" % (i,), "type": "COPYRIGHT", "children": [{"name": "t%s-%s" % (i, j), "type": "WORK"} for j in range(3)]}
+                for i in range(3)
+            ])
+            applier.apply_validated("tag", "v1", [
+                {"name": "g%s" % (i,), "children": [{"name": "g%s-%s" % (i, j), "children": [{"name": "g%s-%s-0" % (i, j)}]} for j in range(4)]}
+                for i in range(3)
+            ])
+            applier.submit()
+            assert applier.submit_errors == []
+
+            topics = list_entities(server, "/api/topics")
+            assert len(topics) == 12
+            for i in range(3):
+                for j in range(3):
+                    assert topics["t%s-%s" % (i, j)]["parentId"] == topics["t%s" % (i,)]["id"]
+
+            tags = list_entities(server, "/api/tags")
+            assert len(tags) == 27
+            for i in range(3):
+                assert tags["g%s" % (i,)]["parentId"] is None
+                for j in range(4):
+                    child = tags["g%s-%s" % (i, j)]
+                    assert child["parentId"] == tags["g%s" % (i,)]["id"]
+                    assert tags["g%s-%s-0" % (i, j)]["parentId"] == child["id"]
+            # 同级节点依次提交，server按提交顺序分配的ordinal与声明顺序一致
+            assert [tags["g%s" % (i,)]["ordinal"] for i in range(3)] == [0, 1, 2]
+            assert [tags["g1-%s" % (j,)]["ordinal"] for j in range(4)] == [0, 1, 2, 3]
+        finally:
+            server.http_client.close()
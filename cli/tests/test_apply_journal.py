@@ -0,0 +1,141 @@
+import json
+import os
+from module.apply import Applier
+from module.apply_journal import ApplyJournal, merge_ranges
+from conftest import ClientOnlyServer
+
+
+SIGNATURE = {"stdin": False, "files": [["/docs/a.ndjson", 10, 1]]}
+
+
+def test_merge_ranges():
+    assert merge_ranges([]) == []
+    assert merge_ranges([[5, 8], [0, 2], [2, 3], [7, 10]]) == [[0, 3], [5, 10]]
+
+
+def test_journal_round_trip(channel_path):
+    journal = ApplyJournal(channel_path)
+    journal.begin(SIGNATURE)
+    journal.add_sources([0, 1, 2, 5])
+    journal.add_sources([3, 9])
+    journal.add_entity("tag", "t", None, 7)
+    journal.add_entity("tag", "t", 7, 8)
+    journal.close()
+
+    journal = ApplyJournal(channel_path)
+    assert journal.resume(SIGNATURE)
+    assert journal.resumed_sources == 6
+    assert [o for o in range(11) if journal.is_source_done(o)] == [0, 1, 2, 3, 5, 9]
+    assert journal.get_entity("tag", "t", None) == 7
+    assert journal.get_entity("tag", "t", 7) == 8
+    assert journal.get_entity("tag", "x", None) is None
+    # 继续时在原有日志之后追加
+    journal.add_sources([4])
+    journal.close()
+    journal = ApplyJournal(channel_path)
+    assert journal.resume(SIGNATURE)
+    assert journal.resumed_sources == 7
+    journal.close()
+
+
+def test_journal_resume_rejects_missing_or_changed_input(channel_path):
+    assert not ApplyJournal(channel_path).resume(SIGNATURE)
+    journal = ApplyJournal(channel_path)
+    journal.begin(SIGNATURE)
+    journal.close()
+    assert not ApplyJournal(channel_path).resume(dict(SIGNATURE, files=[["/docs/a.ndjson", 11, 1]]))
+    journal = ApplyJournal(channel_path)
+    assert journal.resume(SIGNATURE)
+    journal.discard()
+    assert not os.path.exists(os.path.join(channel_path, "cli-apply-journal.ndjson"))
+    assert not ApplyJournal(channel_path).resume(SIGNATURE)
+
+
+def test_journal_ignores_truncated_last_record(channel_path):
+    journal = ApplyJournal(channel_path)
+    journal.begin(SIGNATURE)
+    journal.add_sources([0, 1])
+    journal.close()
+    # 模拟写入中途崩溃留下的不完整的最后一行
+    with open(os.path.join(channel_path, "cli-apply-journal.ndjson"), "ab") as f:
+        f.write(b'{"t":"source","r":[[2,')
+    journal = ApplyJournal(channel_path)
+    assert journal.resume(SIGNATURE)
+    assert journal.resumed_sources == 2
+    journal.close()
+
+
+def apply_with_journal(channel_path, journal, sources, tags):
+    server = ClientOnlyServer(channel_path)
+    try:
+        applier = Applier(server, journal=journal)
+        applier.apply_validated("source", "v1", sources)
+        applier.apply_validated("tag", "v1", tags)
+        applier.submit()
+        assert applier.submit_errors == []
+        return applier
+    finally:
+        server.http_client.close()
+
+
+def test_resumed_apply_skips_recorded_items(mock, channel_path):
+    sources = [{"source": "s", "sourceId": i, "title": "t"} for i in range(10)]
+    tags = [{"name": "t%s" % i, "children": [{"name": "c"}]} for i in range(3)]
+
+    # 第一次apply只提交了一部分就中断
+    journal = ApplyJournal(channel_path)
+    journal.begin(SIGNATURE)
+    apply_with_journal(channel_path, journal, sources[:6], tags[:2])
+    journal.close()
+    request_count = mock.request_count
+
+    journal = ApplyJournal(channel_path)
+    assert journal.resume(SIGNATURE)
+    applier = apply_with_journal(channel_path, journal, sources, tags)
+    journal.close()
+    assert applier.resumed == {"source": 6, "tag": 4}
+    assert applier.updated == {"source": 4}
+    assert applier.created == {"tag": 2}
+    # 已完成的标签直接使用日志中的id，不再查询或提交：只有一次source bulk提交与两个新标签的请求
+    assert mock.request_count - request_count == 3
+
+    with open(os.path.join(channel_path, "cli-apply-journal.ndjson")) as f:
+        records = [json.loads(line) for line in f]
+    assert merge_ranges([r for record in records if record["t"] == "source" for r in record["r"]]) == [[0, 10]]
+    assert len([record for record in records if record["t"] == "entity"]) == 6
+
+
+def write_source_file(filepath, ids):
+    with open(filepath, "w") as f:
+        for i in ids:
+            f.write(json.dumps({"kind": "source", "spec": [{"source": "s", "sourceId": i}]}) + "\n")
+
+
+def test_cli_resume(cli_env, tmp_path):
+    directory = str(tmp_path / "docs")
+    os.makedirs(directory)
+    filepath = os.path.join(directory, "a.ndjson")
+    write_source_file(filepath, range(5))
+
+    result = cli_env.run("apply", "-d", directory, "--resume")
+    assert result.returncode == 2
+    assert "没有可以继续的apply" in result.stderr
+    result = cli_env.run("apply", "-i", "--resume")
+    assert result.returncode == 2
+    assert "--resume" in result.stderr
+
+    # 以与cli相同的输入标识写入一份只完成了前3个source的日志，模拟被中断的apply
+    stat = os.stat(filepath)
+    journal = ApplyJournal(cli_env.channel_path())
+    journal.begin({"stdin": False, "files": [[os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns]]})
+    journal.add_sources([0, 1, 2])
+    journal.close()
+
+    result = cli_env.run("apply", "-d", directory, "--resume")
+    assert result.returncode == 0, result.stderr
+    assert "跳过3个上次已完成的来源数据项" in result.stdout
+    assert "已更新2个来源数据项" in result.stdout
+    # 全部完成后日志被删除，不能再次继续
+    assert not os.path.exists(os.path.join(cli_env.channel_path(), "cli-apply-journal.ndjson"))
+    result = cli_env.run("apply", "-d", directory, "--resume")
+    assert result.returncode == 2
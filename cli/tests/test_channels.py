@@ -0,0 +1,56 @@
+import os
+
+
+def write_file(tmp_path):
+    filepath = str(tmp_path / "a.jpg")
+    with open(filepath, "wb") as f:
+        f.write(b"image")
+    return filepath
+
+
+def output_lines(stdout: str):
+    """
+    :return: 输出的各行，不包括等待server启动的耗时
+    """
+    return [line for line in stdout.splitlines() if not line.startswith("* 等待server启动就绪耗时")]
+
+
+def test_all_channels_output_is_grouped_in_channel_order(cli_env, tmp_path):
+    for channel in ("c", "a", "b"):
+        cli_env.create_channel(channel)
+    filepath = write_file(tmp_path)
+    result = cli_env.run("import", "add", filepath, "--all-channels")
+    assert result.returncode == 0, result.stderr
+    assert output_lines(result.stdout) == ["[频道 a]", filepath, "[频道 b]", filepath, "[频道 c]", filepath, "", "已在3个频道上执行。"]
+    for channel in ("a", "b", "c"):
+        assert len(cli_env.spawned_servers(channel)) == 1
+
+
+def test_failed_channel_does_not_stop_others(cli_env, tmp_path):
+    for channel in ("a", "b", "c"):
+        cli_env.create_channel(channel)
+    with open(os.path.join(cli_env.channel_path("b"), "public.dat"), "w") as f:
+        f.write("{")
+    filepath = write_file(tmp_path)
+    result = cli_env.run("import", "add", filepath, "--all-channels")
+    assert result.returncode == 1
+    lines = output_lines(result.stdout)
+    assert lines[:2] == ["[频道 a]", filepath]
+    assert lines[2] == "[频道 b]" and lines[3].startswith("* 执行失败: ")
+    assert lines[4:] == ["[频道 c]", filepath, "", "已在3个频道上执行，1个频道失败。"]
+
+
+def test_channel_option_does_not_change_current_channel(cli_env, tmp_path):
+    for channel in ("a", "b"):
+        cli_env.create_channel(channel)
+    assert cli_env.run("channel", "use", "a").returncode == 0
+    filepath = write_file(tmp_path)
+    result = cli_env.run("import", "add", filepath, "--channel", "b")
+    assert result.returncode == 0, result.stderr
+    assert output_lines(result.stdout) == [filepath]
+    assert len(cli_env.spawned_servers("b")) == 1
+    assert cli_env.spawned_servers("a") == []
+    assert "正在使用的频道: a" in cli_env.run("channel", "info").stdout
+    result = cli_env.run("import", "add", filepath, "--channel", "missing")
+    assert result.returncode == 2
+    assert "missing" in result.stderr
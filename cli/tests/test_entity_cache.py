@@ -0,0 +1,53 @@
+from module.apply import Applier
+from module.entity_cache import EntityCache
+from conftest import ClientOnlyServer
+
+
+AUTHORS = [{"name": "a%s" % (i,), "type": "ARTIST"} for i in range(3)]
+
+
+def apply_authors(channel_path, authors):
+    server = ClientOnlyServer(channel_path)
+    try:
+        cache = EntityCache(channel_path)
+        applier = Applier(server, entity_cache=cache)
+        applier.apply_validated("author", "v1", authors)
+        applier.submit()
+        assert applier.submit_errors == []
+        return {endpoint: count for (endpoint, count, _, _, _) in server.http_client.stats.summary()}, EntityCache(channel_path)
+    finally:
+        server.http_client.close()
+
+
+def test_cached_entities_are_patched_directly(mock, channel_path):
+    requests, cache = apply_authors(channel_path, AUTHORS)
+    assert requests == {"POST /api/authors": 3}
+    ids = [cache.get("author", a["name"]) for a in AUTHORS]
+    assert None not in ids
+
+    requests, cache = apply_authors(channel_path, [dict(a, type="GROUP") for a in AUTHORS])
+    assert requests == {"PATCH /api/authors/{id}": 3}
+    assert [cache.get("author", a["name"]) for a in AUTHORS] == ids
+
+
+def test_stale_cache_entry_falls_back_to_create(mock, channel_path):
+    cache = EntityCache(channel_path)
+    cache.set("author", "a0", None, 9999)
+    cache.save()
+
+    requests, cache = apply_authors(channel_path, AUTHORS[:1])
+    assert requests == {"PATCH /api/authors/{id}": 1, "POST /api/authors": 1}
+    assert cache.get("author", "a0") not in (None, 9999)
+
+
+def test_existing_entity_found_by_query_is_cached(mock, channel_path):
+    # 缓存之外已存在的项：POST失败后查询id并PATCH，之后缓存命中
+    apply_authors(channel_path, AUTHORS[:1])
+    cache = EntityCache(channel_path)
+    cache.clear()
+    cache.save()
+
+    requests, cache = apply_authors(channel_path, AUTHORS[:1])
+    assert requests == {"POST /api/authors": 1, "GET /api/authors": 1, "PATCH /api/authors/{id}": 1}
+    requests, _ = apply_authors(channel_path, AUTHORS[:1])
+    assert requests == {"PATCH /api/authors/{id}": 1}
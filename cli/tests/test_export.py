@@ -0,0 +1,116 @@
+import io
+from module import export
+from module.apply import Applier, iter_documents
+from module.export import Exporter, DocumentWriter, walk_tree
+from mock_server import MockServer
+from conftest import ClientOnlyServer
+
+
+class ListWriter:
+    """
+    收集Exporter写出的文档。
+    """
+    def __init__(self):
+        self.docs = []
+
+    def write(self, kind: str, spec):
+        self.docs.append((kind, spec))
+
+
+TAG_TREE = [
+    {"name": "g%s" % (i,), "type": "TAG", "children": [
+        {"name": "g%s-%s" % (i, j), "type": "TAG", "children": [{"name": "g%s-%s-0" % (i, j), "type": "TAG"}] if j % 2 == 0 else []}
+        for j in range(3)
+    ]}
+    for i in range(4)
+]
+
+
+def strip_empty_children(nodes):
+    return [dict({k: v for (k, v) in node.items() if k != "children"},
+                 **({"children": strip_empty_children(node["children"])} if len(node.get("children", [])) > 0 else {})) for node in nodes]
+
+
+def test_walk_tree_is_preorder():
+    children = {None: [(0, 1), (1, 2)], 1: [(0, 3), (1, 4)], 3: [(0, 5)], 2: [(0, 6)]}
+    assert list(walk_tree(children)) == [(0, 1), (1, 3), (2, 5), (1, 4), (0, 2), (1, 6)]
+    assert list(walk_tree({})) == []
+
+
+def test_export_rebuilds_tree(channel_path, monkeypatch):
+    # 文档很小时，一个文档包含若干棵完整的树，不会把一棵树拆到两个文档中
+    monkeypatch.setattr(export, "EXPORT_DOCUMENT_SIZE", 5)
+    monkeypatch.setattr(export, "EXPORT_LIST_PAGE_SIZE", 4)
+    # 延迟使并发的详情请求乱序完成，导出结果仍按先序组装
+    with MockServer(channel_path, latency=0.005):
+        server = ClientOnlyServer(channel_path)
+        try:
+            applier = Applier(server, concurrency=4)
+            applier.apply_validated("tag", "v1", TAG_TREE)
+            applier.submit()
+            assert applier.submit_errors == []
+
+            writer = ListWriter()
+            exporter = Exporter(server, writer, concurrency=3)
+            exporter.export(["tag"])
+        finally:
+            server.http_client.close()
+    assert exporter.exported == {"tag": 4 + 12 + 8}
+    assert [kind for (kind, _) in writer.docs] == ["tag", "tag", "tag", "tag"]
+    # 每棵树有6个节点，已攒满5个节点，因此每个文档只有一棵树
+    assert [len(spec) for (_, spec) in writer.docs] == [1, 1, 1, 1]
+    assert [node for (_, spec) in writer.docs for node in spec] == strip_empty_children(TAG_TREE)
+
+
+def test_writer_round_trip():
+    docs = [
+        ("setting", {"meta": {"scoreDescriptions": [{"word": "好", "content": "不错"}]}}),
+        ("tag", [{"name": "标签", "type": "TAG", "group": export.dict_copy(export.TAG_GROUP_VALUES["FORCE"])},
+                 {"name": "b", "type": "TAG", "group": export.dict_copy(export.TAG_GROUP_VALUES["FORCE"])}]),
+        ("source", [{"source": "s", "sourceId": 2 ** 40, "title": "多行\n标题"}]),
+    ]
+    for fmt in ("yaml", "ndjson"):
+        out = io.StringIO()
+        writer = DocumentWriter(out, fmt)
+        for (kind, spec) in docs:
+            writer.write(kind, spec)
+        text = out.getvalue()
+        assert "标签" in text
+        if fmt == "yaml":
+            # 相同的值不会被写成锚点与别名
+            assert "&id" not in text and "*id" not in text
+        else:
+            assert len(text.splitlines()) == len(docs)
+        assert list(iter_documents(text, fmt)) == [(kind, "v1", spec) for (kind, spec) in docs]
+
+
+def test_export_can_be_applied_to_another_channel(tmp_path):
+    """
+    导出的内容应用到另一个频道后，从那里再次导出的内容与原来相同。
+    """
+    texts = []
+    for name in ("a", "b"):
+        path = str(tmp_path / name)
+        tmp_path.joinpath(name).mkdir()
+        with MockServer(path):
+            server = ClientOnlyServer(path)
+            try:
+                applier = Applier(server)
+                if len(texts) == 0:
+                    applier.apply_validated("annotation", "v1", [{"name": "ann", "canBeExported": True, "target": ["ARTIST"]}])
+                    applier.apply_validated("author", "v1", [{"name": "au", "type": "ARTIST", "annotations": ["ann"], "score": 3}])
+                    applier.apply_validated("topic", "v1", [{"name": "t", "type": "COPYRIGHT", "children": [{"name": "t-0", "type": "WORK"}]}])
+                    applier.apply_validated("tag", "v1", TAG_TREE[:2])
+                    applier.apply_validated("source", "v1", [{"source": "s", "sourceId": i, "title": "t%s" % (i,) if i % 2 else None} for i in range(5)])
+                else:
+                    for (kind, version, spec) in iter_documents(texts[0], "ndjson"):
+                        applier.apply_validated(kind, version, spec)
+                applier.submit()
+                assert applier.submit_errors == []
+                out = io.StringIO()
+                Exporter(server, DocumentWriter(out, "ndjson")).export(["annotation", "author", "topic", "tag", "source"])
+                texts.append(out.getvalue())
+            finally:
+                server.http_client.close()
+    assert texts[0] == texts[1]
+    assert len(texts[0].splitlines()) == 5
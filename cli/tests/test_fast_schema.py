@@ -0,0 +1,114 @@
+import copy
+import random
+import pytest
+from schema import Schema, SchemaError, And, Or, Optional
+from module.apply import DOCUMENT_SCHEMAS
+from utils.fast_schema import CompiledSchema, compile_check
+
+
+VALID_DOCUMENTS = {
+    "setting": {
+        "meta": {"scoreDescriptions": [{"word": "a", "content": "b"}], "autoCleanTagme": True, "topicColors": {"WORK": "red"}},
+        "import": {"setTimeBy": "UPDATE_TIME", "setPartitionTimeDelay": 3,
+                   "sourceAnalyseRules": [{"type": "name", "site": "s", "regex": "r", "idIndex": 1, "secondaryIdIndex": 2}]},
+        "query": {"chineseSymbolReflect": False, "queryLimitOfQueryItems": 10},
+        "source": {"sites": [{"name": "s", "title": "S", "hasSecondaryId": False}]},
+    },
+    "source": [
+        {"source": "s", "sourceId": 1, "title": None, "description": "d",
+         "tags": [{"name": "t", "displayName": None, "type": "x"}], "pools": [{"key": "k", "title": ""}], "relations": [2, 3]},
+        {"source": "s", "sourceId": 2},
+    ],
+    "annotation": [{"name": "a", "canBeExported": True, "target": ["TAG", "AUTHOR"]}],
+    "author": [{"name": "a", "otherNames": ["b"], "type": "ARTIST", "score": 3, "annotations": ["x", 1],
+                "links": [{"title": "t", "link": "l"}], "mappingSourceTags": [{"source": "s", "name": "n", "type": "t"}]}],
+    "topic": [{"name": "t", "type": "COPYRIGHT", "favorite": False, "children": [{"name": "c", "type": "WORK", "children": [{"name": "d"}]}]}],
+    "tag": [{"name": "t", "type": "TAG", "group": {"force": True}, "links": [1, ["a", "b"], "c"], "examples": [1],
+             "children": [{"name": "c", "type": "ADDR", "group": False}]}],
+}
+
+REPLACEMENTS = [True, False, 0, 1, -1, 11, 1.5, "", "x", "TAG", None, [], {}, [1], ["x"], [{}], {"name": "x"}]
+
+
+def is_valid(schema, data):
+    try:
+        schema.validate(data)
+        return True
+    except SchemaError:
+        return False
+
+
+def containers(data, path=()):
+    yield path, data
+    items = data.items() if isinstance(data, dict) else enumerate(data) if isinstance(data, list) else ()
+    for (k, v) in items:
+        if isinstance(v, (dict, list)):
+            yield from containers(v, path + (k,))
+
+
+def mutate(doc, rnd):
+    doc = copy.deepcopy(doc)
+    (_, target) = rnd.choice([c for c in containers(doc) if len(c[1]) > 0] or [((), doc)])
+    keys = list(target.keys()) if isinstance(target, dict) else list(range(len(target)))
+    action = rnd.random()
+    if action < 0.6 and len(keys) > 0:
+        target[rnd.choice(keys)] = copy.deepcopy(rnd.choice(REPLACEMENTS))
+    elif action < 0.8 and len(keys) > 0:
+        target.pop(rnd.choice(keys))
+    elif isinstance(target, dict):
+        target["unknown"] = 1
+    else:
+        target.append(copy.deepcopy(rnd.choice(REPLACEMENTS)))
+    return doc
+
+
+@pytest.mark.parametrize("kind", sorted(DOCUMENT_SCHEMAS.keys()))
+def test_compiled_schema_agrees_with_schema(kind):
+    compiled = DOCUMENT_SCHEMAS[kind]()
+    plain = Schema(compiled.schema)
+    check = compile_check(compiled.schema)
+    assert check(VALID_DOCUMENTS[kind]) and is_valid(plain, VALID_DOCUMENTS[kind])
+    rnd = random.Random(kind)
+    invalid = 0
+    for _ in range(500):
+        doc = mutate(VALID_DOCUMENTS[kind], rnd)
+        expected = is_valid(plain, doc)
+        assert check(doc) == expected, doc
+        invalid += not expected
+    # 变异需要同时覆盖通过与不通过的情况
+    assert 0 < invalid < 500
+
+
+@pytest.mark.parametrize("definition, data", [
+    (int, True),
+    (int, False),
+    (And(int, lambda i: i >= 0), True),
+    ([int], [1, True]),
+    ({"a": int}, {"a": False}),
+    (Or(str, None), 0),
+    ({Optional("a"): str}, {"b": "x"}),
+    ({"a": str, Optional("b"): int}, {"b": 1}),
+    ([{"a": And(str, len)}], [{"a": ""}]),
+    (And(str, lambda s: s.missing), "x"),
+])
+def test_invalid_data_raises_the_same_error(definition, data):
+    plain = Schema(definition)
+    with pytest.raises(SchemaError) as expected:
+        plain.validate(data)
+    assert not compile_check(definition)(data)
+    with pytest.raises(SchemaError) as actual:
+        CompiledSchema(Schema(definition)).validate(data)
+    assert str(actual.value) == str(expected.value)
+
+
+@pytest.mark.parametrize("definition, data", [
+    (bool, True),
+    (int, 0),
+    (Or(str, None), None),
+    ({Optional("a"): str}, {}),
+    ({"a": [Or(int, [str], str)]}, {"a": [1, ["x"], "y"]}),
+    (Or(bool, {Optional("force"): bool}), {"force": True}),
+])
+def test_valid_data_is_returned_unchanged(definition, data):
+    assert CompiledSchema(Schema(definition)).validate(data) is data
+    assert Schema(definition).validate(data) == data
@@ -0,0 +1,64 @@
+import os
+import signal
+import threading
+import time
+from conftest import create_server, spawned_servers
+
+SIGNAL_ENDPOINT = "PUT /app/lifetime/signal/cli-lifetime-access"
+
+
+def signal_count(server):
+    return {endpoint: count for (endpoint, count, _, _, _) in server.http_client.stats.summary()}.get(SIGNAL_ENDPOINT, 0)
+
+
+def test_heartbeat_renews_signal(spawning_channel):
+    server = create_server(spawning_channel, heartbeat_interval=0.1)
+    try:
+        server.check_then_start()
+        with server.heartbeat():
+            time.sleep(0.55)
+        count = signal_count(server)
+        # 进入时立即续期一次，之后每个间隔续期一次
+        assert 4 <= count <= 7
+        time.sleep(0.3)
+        assert signal_count(server) == count
+    finally:
+        server.http_client.close()
+
+
+def test_heartbeat_restarts_stopped_server(spawning_channel):
+    server = create_server(spawning_channel, heartbeat_interval=0.1)
+    stop = threading.Event()
+    succeeded = []
+
+    def request_loop():
+        # 其他线程在心跳重启server的同时持续请求
+        while not stop.is_set():
+            try:
+                ok, _ = server.http_client.req("GET", "/app/health")
+                succeeded.append(ok)
+            except Exception:
+                pass
+            time.sleep(0.01)
+
+    try:
+        server.check_then_start()
+        with server.heartbeat():
+            thread = threading.Thread(target=request_loop)
+            thread.start()
+            try:
+                os.kill(spawned_servers(spawning_channel)[0], signal.SIGTERM)
+                deadline = time.monotonic() + 20
+                while len(spawned_servers(spawning_channel)) < 2 and time.monotonic() < deadline:
+                    time.sleep(0.05)
+                assert len(spawned_servers(spawning_channel)) == 2
+                count = len(succeeded)
+                while len(succeeded) == count and time.monotonic() < deadline:
+                    time.sleep(0.05)
+                assert len(succeeded) > count
+            finally:
+                stop.set()
+                thread.join(5)
+        assert server.wait_time > 0
+    finally:
+        server.http_client.close()
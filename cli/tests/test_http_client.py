@@ -0,0 +1,109 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import requests
+from mock_server import MockServer
+from module.server import ServerHttpClient, dumps_json, loads_json
+
+
+def connect(mock_path: str, **kwargs):
+    with open(os.path.join(mock_path, "server.pid")) as f:
+        pid_file = json.load(f)
+    client = ServerHttpClient(**kwargs)
+    client.set_access(pid_file["port"], pid_file["token"], pid_file["socket"])
+    return client
+
+
+def test_sequential_requests_reuse_one_connection(tmp_path):
+    with MockServer(str(tmp_path)) as mock:
+        client = connect(str(tmp_path))
+        for _ in range(20):
+            ok, _ = client.req("GET", "/api/setting/import")
+            assert ok
+        client.close()
+        assert mock.connection_count == 1
+
+
+def test_concurrent_requests_stay_within_pool(tmp_path):
+    with MockServer(str(tmp_path), latency=0.005) as mock:
+        client = connect(str(tmp_path), pool_size=2)
+        client.set_pool_size(4)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: client.req("GET", "/api/setting/import")[0], range(40)))
+        client.close()
+        assert all(results)
+        # 连接池不小于线程数时，连接在请求之间复用，不会在用后被丢弃
+        assert mock.connection_count <= 4
+
+
+def test_read_timeout_is_not_retried(tmp_path):
+    """
+    读取超时时请求可能已被server处理，因此不会重试。
+    """
+    with MockServer(str(tmp_path), latency=0.3) as mock:
+        client = connect(str(tmp_path), timeout=(3, 0.1))
+        with pytest.raises(requests.RequestException):
+            client.req("POST", "/api/tags", body={"name": "a", "type": "TAG"})
+        client.close()
+        time.sleep(0.5)
+        assert mock.request_count == 1
+
+
+def test_stats_group_requests_by_endpoint(tmp_path):
+    with MockServer(str(tmp_path)):
+        client = connect(str(tmp_path))
+        ok, tag = client.req("POST", "/api/tags", body={"name": "a", "type": "TAG"})
+        assert ok
+        for _ in range(3):
+            client.req("GET", "/api/tags/%s" % (tag["id"],))
+        client.close()
+    summary = {endpoint: count for (endpoint, count, _, _, _) in client.stats.summary()}
+    assert summary == {"POST /api/tags": 1, "GET /api/tags/{id}": 3}
+    assert client.stats.count == 4
+
+
+def test_large_body_is_gzipped_only_when_supported(tmp_path):
+    with MockServer(str(tmp_path)) as mock:
+        client = connect(str(tmp_path), gzip_threshold=1000)
+        description = "描述" * 1000
+        ok, tag = client.req("POST", "/api/tags", body={"name": "a", "type": "TAG", "description": description})
+        assert ok
+        # server尚未声明支持gzip
+        assert mock.gzip_request_count == 0
+
+        client.set_request_encodings(["gzip"])
+        ok, _ = client.req("PATCH", "/api/tags/%s" % (tag["id"],), body={"description": description + "!"})
+        assert ok
+        assert mock.gzip_request_count == 1
+        ok, data = client.req("GET", "/api/tags/%s" % (tag["id"],))
+        assert data["description"] == description + "!"
+        # 小于阈值的body不压缩
+        client.req("PATCH", "/api/tags/%s" % (tag["id"],), body={"description": "short"})
+        assert mock.gzip_request_count == 1
+        client.close()
+
+        client = connect(str(tmp_path), gzip_threshold=None)
+        client.set_request_encodings(["gzip"])
+        client.req("PATCH", "/api/tags/%s" % (tag["id"],), body={"description": description})
+        assert mock.gzip_request_count == 1
+        client.close()
+
+
+@pytest.mark.parametrize("body", [
+    {"name": "名称", "items": [1, 2.5, None, True]},
+    # orjson只支持64位整数，超出的值回退到标准库
+    {"id": 2 ** 70},
+    {"id": -2 ** 64},
+])
+def test_json_encoding_round_trips(body):
+    data = dumps_json(body)
+    assert isinstance(data, bytes)
+    assert json.loads(data) == body
+
+
+def test_json_encoding_keeps_non_ascii():
+    assert "名称".encode() in dumps_json({"name": "名称"})
+    assert "名称".encode() in dumps_json({"name": "名称", "id": 2 ** 70})
+    assert loads_json("{\"name\": \"名称\"}".encode()) == {"name": "名称"}
@@ -0,0 +1,157 @@
+import os
+import queue
+import threading
+import time
+import pytest
+from module import import_watch
+from module.import_watch import ImportWatcher, IN_Q_OVERFLOW
+from utils import watcher as watcher_module
+from utils.watcher import DirectoryWatcher
+
+
+def test_debounce_must_be_positive(cli_env, tmp_path):
+    result = cli_env.run("import", "watch", str(tmp_path), "--debounce", "0")
+    assert result.returncode == 2
+    assert "--debounce" in result.stderr
+
+
+def test_zero_debounce_batches_without_spinning(tmp_path):
+    """
+    即使debounce为0，空闲的等待也不会退化为忙循环，写入完成的文件仍按批次产出。
+    """
+    batches = []
+    with ImportWatcher(str(tmp_path), debounce=0, poll_interval=0.2) as watcher:
+        def consume():
+            for batch in watcher.batches():
+                batches.append(batch)
+                return
+
+        thread = threading.Thread(target=consume, daemon=True)
+        cpu_start = time.process_time()
+        thread.start()
+        time.sleep(0.5)
+        idle_cpu = time.process_time() - cpu_start
+        with open(os.path.join(str(tmp_path), "a.jpg"), "wb") as f:
+            f.write(b"data")
+        thread.join(5)
+    assert idle_cpu < 0.2
+    assert batches == [[os.path.join(str(tmp_path), "a.jpg")]]
+
+
+class OverflowWatcher(DirectoryWatcher):
+    """
+    设置overflow后，将下一次收到的真实事件替换为一次事件队列溢出，模拟溢出时事件丢失的情况。
+    """
+    overflow = threading.Event()
+
+    def wait(self, timeout: float):
+        events = super().wait(timeout)
+        if events and OverflowWatcher.overflow.is_set():
+            OverflowWatcher.overflow.clear()
+            return [(IN_Q_OVERFLOW, "")]
+        return events
+
+
+def write_old_file(path: str, data: bytes = b"data", mtime: float = None):
+    """
+    写入一个修改时间在合批窗口之前的文件，使重新扫描时立刻处理它。
+    先写入隐藏的临时文件再移入，使监视器只看到修改时间已设置好的完整文件。
+    """
+    tmp_path = os.path.join(os.path.dirname(path), "." + os.path.basename(path))
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    mtime = mtime if mtime is not None else time.time() - 60
+    os.utime(tmp_path, (mtime, mtime))
+    os.rename(tmp_path, path)
+
+
+def consume(watcher: ImportWatcher):
+    """
+    在后台线程中持续读取批次，使监视器像在实际使用中一样不间断地处理事件。
+    """
+    batches = queue.Queue()
+
+    def run():
+        try:
+            for batch in watcher.batches():
+                batches.put(batch)
+        except (OSError, TypeError):
+            # 测试结束时监视器被关闭，等待中的读取失败，线程随之结束
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    return batches
+
+
+def take(batches: queue.Queue, timeout: float = 5):
+    try:
+        return batches.get(timeout=timeout)
+    except queue.Empty:
+        return None
+
+
+def take_files(batches: queue.Queue, count: int, timeout: float = 5):
+    """
+    读取批次直到收到count个文件。重新扫描与真实事件的先后不确定，文件可能分在多个批次中产出。
+    """
+    files = []
+    while len(files) < count:
+        batch = take(batches, timeout)
+        if batch is None:
+            break
+        files += batch
+    return sorted(files)
+
+
+def test_overflow_rescan_skips_handled_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(import_watch, "DirectoryWatcher", OverflowWatcher)
+    write_old_file(str(tmp_path / "a.jpg"))
+    with ImportWatcher(str(tmp_path), debounce=0.1, poll_interval=0.1) as watcher:
+        if not watcher.native:
+            pytest.skip("inotify is not available")
+        batches = consume(watcher)
+        assert take(batches) == [str(tmp_path / "a.jpg")]
+        write_old_file(str(tmp_path / "b.jpg"))
+        assert take(batches) == [str(tmp_path / "b.jpg")]
+
+        # 溢出期间c.jpg的事件丢失，重新扫描只应找回c.jpg，而不应再次产出已处理的a.jpg与b.jpg
+        OverflowWatcher.overflow.set()
+        write_old_file(str(tmp_path / "c.jpg"))
+        assert take(batches) == [str(tmp_path / "c.jpg")]
+
+
+def test_overflow_rescan_picks_up_changed_and_replaced_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(import_watch, "DirectoryWatcher", OverflowWatcher)
+    mtime = time.time() - 60
+    write_old_file(str(tmp_path / "a.jpg"), mtime=mtime)
+    write_old_file(str(tmp_path / "b.jpg"), mtime=mtime)
+    with ImportWatcher(str(tmp_path), debounce=0.1, poll_interval=0.1) as watcher:
+        if not watcher.native:
+            pytest.skip("inotify is not available")
+        batches = consume(watcher)
+        assert sorted(take(batches)) == [str(tmp_path / "a.jpg"), str(tmp_path / "b.jpg")]
+
+        # 溢出期间b.jpg被删除，其记录在重新扫描时被移除；之后以相同的大小与修改时间重新出现的b.jpg仍应被产出
+        OverflowWatcher.overflow.set()
+        os.remove(str(tmp_path / "b.jpg"))
+        assert take(batches, timeout=1) is None
+
+        OverflowWatcher.overflow.set()
+        write_old_file(str(tmp_path / "a.jpg"), data=b"changed")
+        write_old_file(str(tmp_path / "b.jpg"), mtime=mtime)
+        assert take_files(batches, 2) == [str(tmp_path / "a.jpg"), str(tmp_path / "b.jpg")]
+        assert take(batches, timeout=1) is None
+
+
+def test_polling_yields_file_replaced_with_same_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(watcher_module, "_load_libc", lambda: None)
+    mtime = time.time() - 60
+    write_old_file(str(tmp_path / "a.jpg"), mtime=mtime)
+    with ImportWatcher(str(tmp_path), debounce=0.1, poll_interval=0.1) as watcher:
+        assert not watcher.native
+        batches = consume(watcher)
+        assert take(batches) == [str(tmp_path / "a.jpg")]
+        os.remove(str(tmp_path / "a.jpg"))
+        time.sleep(0.3)
+        write_old_file(str(tmp_path / "a.jpg"), mtime=mtime)
+        assert take(batches) == [str(tmp_path / "a.jpg")]
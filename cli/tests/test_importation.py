@@ -0,0 +1,173 @@
+import json
+import os
+import time
+import pytest
+from module.importation import Importation, IMPORT_LIST_PAGE_SIZE
+from module.import_index import ImportIndex
+from mock_server import MockServer
+from conftest import ClientOnlyServer
+
+
+def write_files(directory: str, count: int):
+    os.makedirs(directory, exist_ok=True)
+    filepaths = []
+    for i in range(count):
+        filepath = os.path.join(directory, "%s.jpg" % (i,))
+        with open(filepath, "wb") as f:
+            f.write(("image %s" % (i,)).encode())
+        filepaths.append(filepath)
+    return filepaths
+
+
+def test_add_all_imports_every_file(server, mock, tmp_path):
+    filepaths = write_files(str(tmp_path / "files"), 30)
+    results = list(Importation(server).add_all(filepaths, False, jobs=4))
+    assert sorted(filepath for (filepath, _, _) in results) == sorted(filepaths)
+    assert all(e is None and not skipped for (_, e, skipped) in results)
+    assert mock.request_count == 30
+
+
+def test_add_all_reads_input_lazily(server, tmp_path):
+    """
+    同时在途的文件不超过jobs的两倍，filepaths在需要时才继续读取。
+    """
+    filepaths = write_files(str(tmp_path / "files"), 40)
+    consumed = []
+
+    def generate():
+        for filepath in filepaths:
+            consumed.append(filepath)
+            yield filepath
+
+    results = Importation(server).add_all(generate(), False, jobs=2)
+    next(results)
+    assert len(consumed) <= 2 * 2 + 1
+    assert len(list(results)) == 39
+
+
+def test_add_all_reports_errors_per_file(server, tmp_path):
+    filepaths = write_files(str(tmp_path / "files"), 5)
+    missing = str(tmp_path / "files/missing.jpg")
+    results = {filepath: e for (filepath, e, _) in Importation(server).add_all(filepaths + [missing], False, jobs=3)}
+    assert results.pop(missing) == "File not found."
+    assert set(results.values()) == {None}
+
+
+def test_import_add_directory(cli_env, tmp_path):
+    write_files(str(tmp_path / "files"), 12)
+    result = cli_env.run("import", "add", str(tmp_path / "files"), "-j", "3")
+    assert result.returncode == 0, result.stderr
+    assert "已添加12个文件。" in result.stdout
+    listed = cli_env.run("import", "list", "--format", "ndjson")
+    assert sorted(json.loads(line)["fileName"] for line in listed.stdout.splitlines()) == sorted("%s.jpg" % (i,) for i in range(12))
+
+
+
+@pytest.fixture
+def storing_server(channel_path):
+    """
+    连接到将导入的文件复制到存储目录中的MockServer。
+    """
+    with MockServer(channel_path, store_files=True):
+        server = ClientOnlyServer(channel_path)
+        yield server
+        server.http_client.close()
+
+
+def read_index(channel_path):
+    with open(os.path.join(channel_path, "cli-import-index.json")) as f:
+        return json.load(f)
+
+
+def test_duplicate_is_skipped_after_save(storing_server, channel_path, tmp_path):
+    [filepath] = write_files(str(tmp_path / "files"), 1)
+    importation = Importation(storing_server, ImportIndex(channel_path))
+    assert importation.add(filepath, False) == (None, False)
+    assert importation.add(filepath, False) == (None, True)
+    # 确认保存后导入项从导入列表中消失，但文件仍在存储中
+    importation.save()
+    assert importation.add(filepath, False) == (None, True)
+
+
+def test_deleted_import_is_not_a_duplicate(storing_server, channel_path, tmp_path):
+    [filepath] = write_files(str(tmp_path / "files"), 1)
+    importation = Importation(storing_server, ImportIndex(channel_path))
+    e, skipped, import_id = importation.add_with_id(filepath, False)
+    assert (e, skipped) == (None, False)
+    ok, _ = storing_server.http_client.req("DELETE", "/api/imports/%s" % (import_id,))
+    assert ok
+    e, skipped, new_id = importation.add_with_id(filepath, False)
+    assert (e, skipped) == (None, False)
+    assert new_id != import_id
+
+
+def test_sync_prunes_deleted_imports(storing_server, channel_path, tmp_path):
+    filepaths = write_files(str(tmp_path / "files"), 3)
+    # 不经过索引导入，索引只能从导入列表同步
+    import_ids = [import_id for (_, _, _, import_id) in Importation(storing_server).add_all(filepaths, False, with_id=True)]
+    index = ImportIndex(channel_path)
+    importation = Importation(storing_server, index)
+    assert importation.sync_index(channel_path) == 3
+    index.save()
+    assert sorted(read_index(channel_path)["hashes"].values()) == sorted(import_ids)
+
+    ok, _ = storing_server.http_client.req("DELETE", "/api/imports/%s" % (import_ids[0],))
+    assert ok
+    importation.save()
+    index = ImportIndex(channel_path)
+    assert Importation(storing_server, index).sync_index(channel_path) == 0
+    index.save()
+    data = read_index(channel_path)
+    assert sorted(data["hashes"].values()) == sorted(import_ids[1:])
+    assert len(data["stored"]) == 2
+    # server存储中的文件只读取一次，不记录其hash缓存
+    assert data["files"] == {}
+
+
+def test_prune_drops_missing_local_files(channel_path, tmp_path):
+    filepaths = write_files(str(tmp_path / "files"), 2)
+    index = ImportIndex(channel_path)
+    for filepath in filepaths:
+        index.digest(filepath)
+    os.remove(filepaths[0])
+    index.prune()
+    index.save()
+    assert list(read_index(channel_path)["files"].keys()) == [os.path.realpath(filepaths[1])]
+
+
+def test_list_pages_honors_limit_and_offset(server, mock):
+    total = IMPORT_LIST_PAGE_SIZE * 2 + 200
+    mock.add_imports(total)
+    importation = Importation(server)
+    assert [len(page) for page in importation.list_pages()] == [IMPORT_LIST_PAGE_SIZE, IMPORT_LIST_PAGE_SIZE, 200]
+    pages = list(importation.list_pages(limit=IMPORT_LIST_PAGE_SIZE + 10, offset=5))
+    assert [len(page) for page in pages] == [IMPORT_LIST_PAGE_SIZE, 10]
+    assert [i["id"] for page in pages for i in page] == list(range(6, IMPORT_LIST_PAGE_SIZE + 16))
+    assert list(importation.list_pages(limit=0)) == []
+    assert [i["id"] for page in importation.list_pages(order="-id", limit=3) for i in page] == [total, total - 1, total - 2]
+
+
+def test_list_pages_prefetches_next_page(server, mock):
+    mock.add_imports(IMPORT_LIST_PAGE_SIZE * 3)
+    pages = Importation(server).list_pages()
+    next(pages)
+    # 调用方还在处理第一页时，第二页已在后台请求
+    deadline = time.monotonic() + 5
+    while mock.request_count < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert mock.request_count == 2
+    assert len(list(pages)) == 2
+    assert mock.request_count == 3
+
+
+def test_import_list_formats(cli_env, tmp_path):
+    write_files(str(tmp_path / "files"), 4)
+    assert cli_env.run("import", "add", str(tmp_path / "files"), "--duplicate", "allow").returncode == 0
+    result = cli_env.run("import", "list", "--format", "tsv", "--limit", "2", "--offset", "1")
+    assert result.returncode == 0, result.stderr
+    lines = result.stdout.splitlines()
+    assert lines[0].split("\t")[:2] == ["id", "fileName"]
+    assert [line.split("\t")[0] for line in lines[1:]] == ["2", "3"]
+    result = cli_env.run("import", "list")
+    assert result.returncode == 0, result.stderr
+    assert [line.split("]")[0] for line in result.stdout.splitlines()] == ["[1", "[2", "[3", "[4"]
@@ -0,0 +1,80 @@
+import json
+import os
+from module.apply import Applier
+from module.manifest import ApplyManifest
+from conftest import ClientOnlyServer
+
+
+def apply_sources(channel_path, items, full=False):
+    server = ClientOnlyServer(channel_path)
+    try:
+        applier = Applier(server, manifest=ApplyManifest(channel_path, full=full))
+        applier.apply_validated("source", "v1", items)
+        applier.apply_validated("annotation", "v1", [{"name": "a", "canBeExported": True}])
+        applier.submit()
+        assert applier.submit_errors == []
+        return applier
+    finally:
+        server.http_client.close()
+
+
+def test_unchanged_entities_are_skipped(mock, channel_path):
+    items = [{"source": "s", "sourceId": i, "title": "t"} for i in range(10)]
+    applier = apply_sources(channel_path, items)
+    assert applier.updated == {"source": 10}
+    assert applier.created == {"annotation": 1}
+
+    items[3] = dict(items[3], title="changed")
+    applier = apply_sources(channel_path, items)
+    assert applier.updated == {"source": 1}
+    assert applier.unchanged == {"source": 9, "annotation": 1}
+
+    applier = apply_sources(channel_path, items, full=True)
+    assert applier.updated == {"source": 10, "annotation": 1}
+    assert applier.unchanged == {}
+
+
+def test_only_recorded_entities_are_unchanged(channel_path):
+    manifest = ApplyManifest(channel_path)
+    (unchanged, digest) = manifest.check_entity("source:s:1", {"title": "t"})
+    assert not unchanged
+    # 只有调用set_entity记录过的内容才被视为未变更
+    assert not ApplyManifest(channel_path).check_entity("source:s:1", {"title": "t"})[0]
+    manifest.set_entity("source:s:1", digest)
+    manifest.save()
+    assert ApplyManifest(channel_path).check_entity("source:s:1", {"title": "t"})[0]
+    assert not ApplyManifest(channel_path).check_entity("source:s:1", {"title": "x"})[0]
+    assert not ApplyManifest(channel_path, full=True).check_entity("source:s:1", {"title": "t"})[0]
+
+
+def write_source_file(filepath, ids):
+    with open(filepath, "w") as f:
+        for i in ids:
+            f.write(json.dumps({"kind": "source", "spec": [{"source": "s", "sourceId": i}]}) + "\n")
+
+
+def test_cli_skips_unchanged_files(cli_env, tmp_path):
+    directory = str(tmp_path / "docs")
+    os.makedirs(directory)
+    write_source_file(os.path.join(directory, "a.ndjson"), range(0, 5))
+    write_source_file(os.path.join(directory, "b.ndjson"), range(5, 8))
+
+    result = cli_env.run("apply", "-d", directory)
+    assert result.returncode == 0, result.stderr
+    assert "已更新8个来源数据项" in result.stdout
+
+    result = cli_env.run("apply", "-d", directory)
+    assert result.returncode == 0, result.stderr
+    assert "跳过2个未变更的文件" in result.stdout
+    assert "来源数据项" not in result.stdout
+
+    write_source_file(os.path.join(directory, "b.ndjson"), range(5, 9))
+    result = cli_env.run("apply", "-d", directory)
+    assert result.returncode == 0, result.stderr
+    assert "跳过1个未变更的文件" in result.stdout
+    assert "已更新1个来源数据项" in result.stdout
+    assert "跳过3个未变更的来源数据项" in result.stdout
+
+    result = cli_env.run("apply", "-d", directory, "--full")
+    assert result.returncode == 0, result.stderr
+    assert "已更新9个来源数据项" in result.stdout
@@ -0,0 +1,94 @@
+from module.apply import Applier
+from module.plan import same_field, same_value
+
+
+def test_same_value_distinguishes_bool_from_int():
+    assert same_value(True, True)
+    assert not same_value(True, 1)
+    assert not same_value(0, False)
+    assert same_value(1, 1)
+
+
+def test_same_value_compares_only_given_keys():
+    assert same_value({"a": 1}, {"a": 1, "b": None, "c": []})
+    # server多出的键非空，说明提交时缺省这个键会将其清空，因此不等价
+    assert not same_value({"a": 1}, {"a": 1, "b": "x"})
+    assert same_value({"a": [{"b": "x"}]}, {"a": [{"b": "x", "c": None}]})
+    assert not same_value([1, 2], [2, 1])
+    assert not same_value({"a": 1}, None)
+
+
+def test_same_field_resolves_references():
+    remote = [{"id": 1, "name": "x"}, {"id": 2, "name": "y"}]
+    assert same_field("annotations", ["x", 2], remote)
+    assert not same_field("annotations", ["x"], remote)
+    assert not same_field("annotations", ["x", "z"], remote)
+    # tag的link可以是地址，以最后一段作为名称
+    assert same_field("links", [["a", "x"], 2], remote)
+    assert same_field("target", ["AUTHOR", "TAG"], ["ARTIST", "STUDIO", "PUBLISH", "TAG"])
+    assert not same_field("target", ["AUTHOR"], ["ARTIST"])
+    remote_mappings = [{"source": "s", "name": "n", "displayName": "N", "type": "t"}]
+    assert same_field("mappingSourceTags", [{"source": "s", "name": "n"}], remote_mappings)
+    assert not same_field("mappingSourceTags", [{"source": "s", "name": "n", "type": "u"}], remote_mappings)
+
+
+AUTHORS = [{"name": "a%s" % (i,), "type": "ARTIST", "favorite": False, "keywords": ["k"]} for i in range(3)]
+
+
+def endpoint_counts(server):
+    return {endpoint: count for (endpoint, count, _, _, _) in server.http_client.stats.summary()}
+
+
+def test_plan_lists_changes_without_writing(server):
+    applier = Applier(server)
+    applier.apply_validated("author", "v1", AUTHORS)
+    applier.submit()
+    writes = {k: v for (k, v) in endpoint_counts(server).items() if not k.startswith("GET")}
+
+    changed = [dict(AUTHORS[0], favorite=True), AUTHORS[1], dict(AUTHORS[2], keywords=["k", "l"]), {"name": "new"}]
+    applier = Applier(server, diff=True, dry_run=True)
+    applier.apply_validated("author", "v1", changed)
+    applier.submit()
+    assert sorted(applier.plan) == [("create", "author", "new", []), ("update", "author", "a0", ["favorite"]), ("update", "author", "a2", ["keywords"])]
+    assert applier.created == {"author": 1}
+    assert applier.updated == {"author": 2}
+    assert applier.unchanged == {"author": 1}
+    assert {k: v for (k, v) in endpoint_counts(server).items() if not k.startswith("GET")} == writes
+
+    applier = Applier(server, diff=True)
+    applier.apply_validated("author", "v1", changed)
+    applier.submit()
+    assert applier.submit_errors == []
+    counts = endpoint_counts(server)
+    # 只对有变化的项发出PATCH，且只包含有变化的字段
+    assert counts["PATCH /api/authors/{id}"] == 2
+    assert counts["POST /api/authors"] == writes["POST /api/authors"] + 1
+
+    applier = Applier(server, diff=True, dry_run=True)
+    applier.apply_validated("author", "v1", changed)
+    applier.submit()
+    assert applier.plan == []
+    assert applier.unchanged == {"author": 4}
+
+
+def test_plan_treats_children_of_new_items_as_new(server):
+    applier = Applier(server, diff=True, dry_run=True)
+    applier.apply_validated("tag", "v1", [{"name": "t", "type": "TAG", "children": [{"name": "c", "type": "TAG"}]}])
+    applier.submit()
+    assert applier.plan == [("create", "tag", "t", []), ("create", "tag", "c", [])]
+
+
+def test_cli_plan_and_diff(cli_env, tmp_path):
+    filepath = str(tmp_path / "authors.yaml")
+    with open(filepath, "w") as f:
+        f.write("kind: author\nspec:\n- name: a\n  type: ARTIST\n")
+    result = cli_env.run("apply", "--plan", "-f", filepath)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.splitlines()[:2] == ["+ [author] a", "计划: 新建1项，修改0项，0项无变化。"]
+
+    assert cli_env.run("apply", "-f", filepath).returncode == 0
+    with open(filepath, "w") as f:
+        f.write("kind: author\nspec:\n- name: a\n  type: STUDIO\n")
+    result = cli_env.run("apply", "--diff", "-f", filepath)
+    assert result.returncode == 0, result.stderr
+    assert "~ [author] a: type" in result.stdout.splitlines()
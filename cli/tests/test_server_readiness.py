@@ -0,0 +1,69 @@
+import json
+import os
+import threading
+import time
+from utils.watcher import DirectoryWatcher
+from conftest import create_server
+
+# 桩server写出server.pid之前等待的秒数
+STUB_DELAY = 0.8
+
+
+def test_watcher_wakes_on_file_write(tmp_path):
+    with DirectoryWatcher(str(tmp_path)) as watcher:
+        if not watcher.native:
+            return
+        assert watcher.wait(0.05) == []
+        timer = threading.Timer(0.1, lambda: (tmp_path / "server.pid").write_text("{}"))
+        timer.start()
+        start = time.monotonic()
+        events = watcher.wait(5)
+        timer.join()
+        assert time.monotonic() - start < 1
+        assert "server.pid" in [name for (_, name) in events]
+
+
+def test_readiness_is_detected_when_pid_file_is_written(spawning_channel, monkeypatch):
+    monkeypatch.setenv("STUB_DELAY", str(STUB_DELAY))
+    server = create_server(spawning_channel)
+    try:
+        start = time.monotonic()
+        server.check_then_start()
+        ready_at = time.time()
+        elapsed = time.monotonic() - start
+        with open(os.path.join(spawning_channel, "server.pid")) as f:
+            written_at = json.load(f)["startTime"] / 1000
+        # server.pid写出后立即被发现，而不是等到下一个轮询周期
+        assert ready_at - written_at < 0.2
+        assert elapsed >= STUB_DELAY
+        assert STUB_DELAY / 2 < server.wait_time <= elapsed
+    finally:
+        server.http_client.close()
+
+
+def test_running_server_is_checked_without_waiting(spawning_channel):
+    server = create_server(spawning_channel)
+    try:
+        server.check_then_start()
+        wait_time = server.wait_time
+        start = time.monotonic()
+        server.check_then_start()
+        assert time.monotonic() - start < 0.1
+        assert server.wait_time == wait_time
+    finally:
+        server.http_client.close()
+
+
+def test_exited_server_is_reported(spawning_channel, monkeypatch):
+    monkeypatch.setenv("STUB_DELAY", "not a number")
+    server = create_server(spawning_channel)
+    try:
+        start = time.monotonic()
+        try:
+            server.check_then_start(timeout=10)
+            assert False, "check_then_start() should fail"
+        except Exception as e:
+            assert "exited before it was ready" in str(e)
+        assert time.monotonic() - start < 5
+    finally:
+        server.http_client.close()
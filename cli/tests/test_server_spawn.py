@@ -0,0 +1,115 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import pytest
+from module.server import get_process_start_time
+from conftest import create_server, spawned_servers, stop_servers
+
+# 同时启动的cli进程数
+CONCURRENT_STARTERS = 8
+
+
+def test_concurrent_starters_spawn_one_server(cli_env):
+    """
+    多个cli进程同时发现server未启动时，只有一个进程启动server，其余进程等待同一个server就绪。
+    """
+    processes = [cli_env.popen("import", "list", "--format", "ndjson") for _ in range(CONCURRENT_STARTERS)]
+    results = [(p.wait(timeout=60), p.stderr.read()) for p in processes]
+    for p in processes:
+        p.stdout.close()
+        p.stderr.close()
+    assert [code for (code, _) in results] == [0] * CONCURRENT_STARTERS, [err for (_, err) in results]
+
+    spawned = cli_env.spawned_servers()
+    assert len(spawned) == 1
+    with open(cli_env.channel_path() + "/server.pid") as f:
+        assert json.load(f)["pid"] == spawned[0]
+
+
+def test_running_server_is_reused(cli_env):
+    for _ in range(2):
+        result = cli_env.run("import", "list", "--format", "ndjson")
+        assert result.returncode == 0, result.stderr
+    assert len(cli_env.spawned_servers()) == 1
+
+
+def write_spawn_record(channel_path, pid, process_start_time, spawn_time):
+    with open(os.path.join(channel_path, "server.spawn.lock"), "w") as f:
+        json.dump({"pid": pid, "processStartTime": process_start_time, "spawnTime": spawn_time}, f)
+
+
+def read_spawn_record(channel_path):
+    with open(os.path.join(channel_path, "server.spawn.lock")) as f:
+        return f.read()
+
+
+def test_spawn_record_is_cleared_when_ready(spawning_channel):
+    server = create_server(spawning_channel)
+    try:
+        server.check_then_start()
+        assert len(spawned_servers(spawning_channel)) == 1
+        assert read_spawn_record(spawning_channel) == ""
+    finally:
+        server.http_client.close()
+
+
+def test_reused_pid_in_spawn_record_is_ignored(spawning_channel):
+    """
+    锁文件中记录的pid已被其他进程复用(这里用测试进程自己代替)时，不能把它当作正在启动的server而一直等待。
+    """
+    for (process_start_time, spawn_time) in ((get_process_start_time(os.getpid()), time.time() - 3600),
+                                             (-1, time.time())):
+        write_spawn_record(spawning_channel, os.getpid(), process_start_time, spawn_time)
+        server = create_server(spawning_channel)
+        try:
+            server.check_then_start(timeout=10)
+        finally:
+            server.http_client.close()
+        stop_servers(spawned_servers(spawning_channel))
+    assert len(spawned_servers(spawning_channel)) == 2
+
+
+def test_spawn_record_of_exited_spawner_is_cleared(spawning_channel):
+    """
+    其他CLI进程启动的server在就绪之前退出时，等待它的进程报告错误并清除记录，下一次调用会重新启动server。
+    """
+    process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(0.5)"])
+    write_spawn_record(spawning_channel, process.pid, get_process_start_time(process.pid), time.time())
+    server = create_server(spawning_channel)
+    try:
+        with pytest.raises(Exception, match="exited before it was ready"):
+            server.check_then_start(timeout=10)
+        process.wait()
+        assert spawned_servers(spawning_channel) == []
+        assert read_spawn_record(spawning_channel) == ""
+        server.check_then_start(timeout=10)
+        assert len(spawned_servers(spawning_channel)) == 1
+    finally:
+        server.http_client.close()
+
+
+def test_concurrent_threads_spawn_one_server(spawning_channel):
+    server = create_server(spawning_channel)
+    errors = []
+
+    def start():
+        try:
+            server.check_then_start()
+            ok, _ = server.http_client.req("GET", "/app/health")
+            assert ok
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=start) for _ in range(4)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+    finally:
+        server.http_client.close()
+    assert errors == []
+    assert len(spawned_servers(spawning_channel)) == 1
@@ -0,0 +1,53 @@
+import re
+import subprocess
+import sys
+
+# 启动阶段全部import的自身耗时之和的上限，单位为毫秒。包括解释器自身的启动部分
+IMPORT_BUDGET_MS = 150
+# 只有真正访问server或读取文件时才需要的依赖，不应在启动与导入apply模块时加载
+DEFERRED_MODULES = ("yaml", "schema", "requests", "urllib3")
+
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+\d+ \|( *)(\S+)$")
+
+
+def measure_imports(run):
+    """
+    以-X importtime执行，取三次中最少的耗时，减少偶然的抖动。
+    :return: (耗时毫秒数, 加载的模块名集合)
+    """
+    run()
+    best, modules = None, set()
+    for _ in range(3):
+        result = run()
+        assert result.returncode == 0, result.stderr
+        total = 0
+        for line in result.stderr.splitlines():
+            match = IMPORT_TIME_LINE.match(line)
+            if match is not None:
+                total += int(match.group(1))
+                modules.add(match.group(3).split(".")[0])
+        best = total if best is None else min(best, total)
+    return best / 1000, modules
+
+
+def assert_budget(ms, modules):
+    loaded = [m for m in DEFERRED_MODULES if m in modules]
+    assert loaded == [], "deferred modules loaded at startup: %s" % (loaded,)
+    assert ms <= IMPORT_BUDGET_MS, "imports took %.1fms, budget is %dms" % (ms, IMPORT_BUDGET_MS)
+
+
+def test_help_import_budget(cli_env):
+    assert_budget(*measure_imports(lambda: cli_env.run("--help", python_args=("-X", "importtime"))))
+
+
+def test_apply_help_import_budget(cli_env):
+    assert_budget(*measure_imports(lambda: cli_env.run("apply", "--help", python_args=("-X", "importtime"))))
+
+
+def test_apply_module_import_budget(cli_env):
+    code = "import sys; sys.path.insert(0, %r); import module.apply" % (cli_env.cli_path + "/src",)
+
+    def run():
+        return subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=cli_env.environ(), capture_output=True, text=True)
+
+    assert_budget(*measure_imports(run))
@@ -0,0 +1,42 @@
+import json
+import pytest
+from module.server import RequestStats
+
+
+def test_request_stats_merge():
+    stats = RequestStats()
+    stats.record("GET", "/api/tags/1", 0.002)
+    other = RequestStats()
+    other.record("GET", "/api/tags/2", 0.004)
+    other.record("POST", "/api/tags", 0.001)
+    stats.merge(other.export())
+    summary = {endpoint: (count, total, max_time) for (endpoint, count, total, _, max_time) in stats.summary()}
+    assert summary == {"GET /api/tags/{id}": (2, pytest.approx(0.006), 0.004), "POST /api/tags": (1, 0.001, 0.001)}
+
+
+def request_summary(stderr: str):
+    """
+    :return: --trace结束时输出的{endpoint: count}
+    """
+    lines = stderr.splitlines()
+    start = next(i for (i, line) in enumerate(lines) if line.startswith("endpoint"))
+    return {line.split()[0] + " " + line.split()[1]: int(line.split()[2]) for line in lines[start + 1:] if line.strip()}
+
+
+def test_trace_summarizes_requests_of_every_channel(cli_env, tmp_path):
+    for channel in ("a", "b", "c"):
+        cli_env.create_channel(channel)
+    filepath = str(tmp_path / "a.jpg")
+    with open(filepath, "wb") as f:
+        f.write(b"image")
+    trace_path = str(tmp_path / "trace.json")
+
+    result = cli_env.run("--trace", trace_path, "import", "add", filepath, "--duplicate", "allow", "--all-channels")
+    assert result.returncode == 0, result.stderr
+    assert request_summary(result.stderr)["POST /api/imports/import"] == 3
+    with open(trace_path) as f:
+        json.load(f)
+
+    result = cli_env.run("--trace", trace_path, "import", "add", filepath, "--duplicate", "allow", "--channel", "b")
+    assert result.returncode == 0, result.stderr
+    assert request_summary(result.stderr)["POST /api/imports/import"] == 1
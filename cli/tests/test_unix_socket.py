@@ -0,0 +1,62 @@
+import json
+import os
+from benchmark import Benchmark
+from mock_server import MockServer
+from module.server import ServerHttpClient
+from conftest import local_config
+
+
+def read_pid_file(channel_path):
+    with open(os.path.join(channel_path, "server.pid")) as f:
+        return json.load(f)
+
+
+def test_requests_use_unix_socket(tmp_path):
+    with MockServer(str(tmp_path), unix_socket=True) as mock:
+        pid_file = read_pid_file(str(tmp_path))
+        client = ServerHttpClient()
+        client.set_access(pid_file["port"], pid_file["token"], pid_file["socket"])
+        ok, data = client.req("GET", "/app/health")
+        assert ok and data["status"] == "LOADED"
+        assert client.transport == "unix"
+        assert mock.rejected_count == 0
+        client.close()
+
+
+def test_rejected_unix_socket_falls_back_to_tcp(tmp_path):
+    """
+    server拒绝经由unix socket的认证时，请求改用TCP重新发送，并且此后不再使用这个socket。
+    """
+    with MockServer(str(tmp_path), unix_socket=True, reject_unix=True) as mock:
+        pid_file = read_pid_file(str(tmp_path))
+        client = ServerHttpClient()
+        client.set_access(pid_file["port"], pid_file["token"], pid_file["socket"])
+        ok, data = client.req("POST", "/api/annotations", body={"name": "a", "canBeExported": False, "target": []})
+        assert ok
+        assert client.transport == "tcp"
+        assert mock.rejected_count == 1
+
+        client.set_access(pid_file["port"], pid_file["token"], pid_file["socket"])
+        ok, data = client.req("GET", "/api/annotations", query={"limit": 10})
+        assert ok and data["total"] == 1
+        assert client.transport == "tcp"
+        assert mock.rejected_count == 1
+        client.close()
+
+
+def test_cli_starts_against_server_rejecting_unix_socket(cli_env):
+    result = cli_env.run("import", "list", "--format", "ndjson", env={"STUB_REJECT_UNIX": "1"}, timeout=30)
+    assert result.returncode == 0, result.stderr
+    assert len(cli_env.spawned_servers()) == 1
+
+
+def test_benchmark_compares_unix_socket_with_tcp():
+    """
+    latency-compare场景对同一个server交替使用两种传输方式，分别统计耗时。这里只检查两者都被测量，不比较快慢。
+    """
+    result = Benchmark(local_config()).run("latency-compare", 50)
+    assert result["errors"] == 0
+    assert result["items"] == 100
+    for transport in ("unix", "tcp"):
+        assert result["transports"][transport]["requests"] == 50
+        assert 0 < result["transports"][transport]["p50"] <= result["transports"][transport]["p99"]
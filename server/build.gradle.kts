@@ -11,6 +11,7 @@ version = "0.2.0"
 dependencies {
     val kotlinVersion = "1.6.10"
     val javalinVersion = "4.3.0"
+    val jettyVersion = "9.4.44.v20210927" //与javalin依赖的jetty版本保持一致
     val ktormVersion = "3.4.1"
     val sqliteVersion = "3.36.0"
     val jacksonVersion = "2.11.4" //fk, how to upgrade it?
@@ -34,6 +35,7 @@ dependencies {
     implementation(group = "org.ktorm", name = "ktorm-core", version = ktormVersion)
     implementation(group = "org.ktorm", name = "ktorm-support-sqlite", version = ktormVersion)
     implementation(group = "io.javalin", name = "javalin", version = javalinVersion)
+    implementation(group = "org.eclipse.jetty", name = "jetty-unixsocket", version = jettyVersion)
     implementation(group = "ws.schild", name = "jave-core", version = javeVersion)
     implementation(group = "ws.schild", name = "jave-$javePlatform", version = javeVersion)
     implementation(group = "com.googlecode.plist", name = "dd-plist", version = plistVersion)
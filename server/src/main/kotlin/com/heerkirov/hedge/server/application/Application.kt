@@ -16,6 +16,7 @@ import com.heerkirov.hedge.server.components.manager.*
 import com.heerkirov.hedge.server.components.kit.*
 import com.heerkirov.hedge.server.components.manager.query.QueryManager
 import com.heerkirov.hedge.server.components.service.*
+import com.heerkirov.hedge.server.definitions.Filename
 import com.heerkirov.hedge.server.library.framework.define
 import com.heerkirov.hedge.server.library.framework.framework
 
@@ -24,7 +25,7 @@ import com.heerkirov.hedge.server.library.framework.framework
  */
 fun runApplication(options: ApplicationOptions) {
     val lifetimeOptions = LifetimeOptions(options.permanent)
-    val serverOptions = HttpServerOptions(options.frontendPath, options.forceToken, options.forcePort)
+    val serverOptions = HttpServerOptions(options.frontendPath, options.forceToken, options.forcePort, socketPath = "${options.channelPath}/${Filename.SERVER_SOCKET}")
     val webController = WebControllerImpl()
 
     framework {
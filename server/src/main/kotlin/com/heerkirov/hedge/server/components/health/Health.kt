@@ -14,7 +14,7 @@ import kotlin.system.exitProcess
  * 3. 可查询应用程序的初始化和创建状态。
  */
 interface Health : Component {
-    fun save(port: Int? = null, token: String? = null): Health
+    fun save(port: Int? = null, token: String? = null, socket: String? = null): Health
 }
 
 class HealthImpl(private val channelPath: String) : Health {
@@ -29,7 +29,7 @@ class HealthImpl(private val channelPath: String) : Health {
 
     init {
         checkCurrentProcess()
-        model = ServerPID(pid, null, null, System.currentTimeMillis())
+        model = ServerPID(pid, null, null, null, System.currentTimeMillis())
         save()
         initialized = true
     }
@@ -43,9 +43,10 @@ class HealthImpl(private val channelPath: String) : Health {
         }
     }
 
-    override fun save(port: Int?, token: String?): HealthImpl {
+    override fun save(port: Int?, token: String?, socket: String?): HealthImpl {
         if(port != null) { model.port = port }
         if(token != null) { model.token = token }
+        if(socket != null) { model.socket = socket }
         Fs.writeFile(pidPath, model)
         return this
     }
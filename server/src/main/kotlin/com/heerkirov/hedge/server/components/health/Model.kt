@@ -4,5 +4,6 @@ data class ServerPID(
     val pid: Long,
     var port: Int?,
     var token: String?,
+    var socket: String?,
     val startTime: Long
 )
\ No newline at end of file
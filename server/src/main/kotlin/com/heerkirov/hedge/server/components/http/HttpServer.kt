@@ -8,11 +8,15 @@ import com.heerkirov.hedge.server.components.http.routes.*
 import com.heerkirov.hedge.server.components.lifetime.Lifetime
 import com.heerkirov.hedge.server.components.service.AllServices
 import com.heerkirov.hedge.server.library.framework.StatefulComponent
+import com.heerkirov.hedge.server.utils.Fs
 import com.heerkirov.hedge.server.utils.Net
 import com.heerkirov.hedge.server.utils.Token
 import com.heerkirov.hedge.server.utils.objectMapper
 import io.javalin.Javalin
 import io.javalin.plugin.json.JavalinJackson
+import org.eclipse.jetty.unixsocket.UnixSocketConnector
+import org.slf4j.Logger
+import org.slf4j.LoggerFactory
 import java.net.BindException
 
 interface HttpServer : StatefulComponent {
@@ -38,7 +42,11 @@ class HttpServerOptions(
     /**
      * 当用户没有在配置中指定端口时，从此端口开始迭代。
      */
-    val defaultPort: Int = 9000
+    val defaultPort: Int = 9000,
+    /**
+     * 额外在此路径上提供unix domain socket访问。为null时只使用TCP端口。
+     */
+    val socketPath: String? = null
 )
 
 class HttpServerImpl(private val allServices: AllServices,
@@ -48,13 +56,18 @@ class HttpServerImpl(private val allServices: AllServices,
                      private val repo: DataRepository,
                      private val webController: WebController,
                      private val options: HttpServerOptions) : HttpServer {
+    private val log: Logger = LoggerFactory.getLogger(HttpServerImpl::class.java)
+
     private val token: String = options.forceToken ?: Token.token()
     private var port: Int? = null
+    private var socket: String? = null
 
     private var server: Javalin? = null
 
     private val web = WebAccessor(appdata, webController, options.frontendPath)
 
+    private val decompression = RequestDecompression()
+
     override fun load() {
         val aspect = Aspect(appdata, repo)
         val authentication = Authentication(token, web, webController)
@@ -68,6 +81,7 @@ class HttpServerImpl(private val allServices: AllServices,
                 it.enableCorsForAllOrigins()
                 it.jsonMapper(JavalinJackson(objectMapper()))
                 web.configure(it)
+                decompression.configure(it)
             }
             .handle(aspect, authentication, web, errorHandler, encoding)
             .handle(AppRoutes(lifetime, appdata, repo))
@@ -101,6 +115,9 @@ class HttpServerImpl(private val allServices: AllServices,
 
     override fun close() {
         server?.stop()
+        if(socket != null) {
+            Fs.rm(socket!!)
+        }
     }
 
     /**
@@ -126,12 +143,37 @@ class HttpServerImpl(private val allServices: AllServices,
         try {
             this.start(port)
             this@HttpServerImpl.port = port
-            health.save(port = port, token = token)
+            this@HttpServerImpl.socket = options.socketPath?.let { this.bindUnixSocket(it) }
+            health.save(port = port, token = token, socket = socket)
             return this
         }catch (e: BindException) {
             throw BindException("Binding port $port failed: ${e.message}")
         }
     }
+
+    /**
+     * 在TCP端口之外，额外在unix domain socket上提供相同的服务。本机的CLI会优先使用它，省去loopback TCP协议栈的开销。
+     * unix socket是可选的：平台不支持或绑定失败时只记录日志，CLI会继续使用TCP端口。
+     * @return 绑定成功时返回socket路径，否则返回null
+     */
+    private fun Javalin.bindUnixSocket(path: String): String? {
+        return try {
+            //移除上次异常退出时遗留的socket文件
+            Fs.rm(path)
+            val jetty = this.jettyServer()!!.server()
+            val connector = UnixSocketConnector(jetty).also { it.unixSocket = path }
+            jetty.addConnector(connector)
+            connector.start()
+            path
+        }catch (e: Exception) {
+            log.warn("Binding unix socket $path failed: ${e.message}")
+            null
+        }catch (e: LinkageError) {
+            //当前平台没有可用的native库
+            log.warn("Unix socket is not supported: ${e.message}")
+            null
+        }
+    }
 }
 
 interface Endpoints {
@@ -5,6 +5,8 @@ import com.heerkirov.hedge.server.components.http.WebController
 import com.heerkirov.hedge.server.exceptions.*
 import io.javalin.Javalin
 import io.javalin.http.Context
+import org.eclipse.jetty.server.Request
+import org.eclipse.jetty.unixsocket.UnixSocketConnector
 
 /**
  * 登录认证模块。
@@ -28,7 +30,7 @@ class Authentication(private val baseToken: String, private val webAccessor: Web
 
         if(baseToken == userToken) {
             //通过baseToken的验证
-            if(ctx.req.remoteHost !in localhost) {
+            if(!isLocal(ctx)) {
                 throw be(RemoteDisabled())
             }
             return
@@ -47,7 +49,7 @@ class Authentication(private val baseToken: String, private val webAccessor: Web
 
         if(baseToken == userToken) {
             //通过baseToken的验证
-            if(ctx.req.remoteHost !in localhost) {
+            if(!isLocal(ctx)) {
                 throw be(RemoteDisabled())
             }
             return
@@ -58,4 +60,11 @@ class Authentication(private val baseToken: String, private val webAccessor: Web
             throw be(TokenWrong())
         }
     }
-}
\ No newline at end of file
+
+    /**
+     * 判断请求是否来自本机。经由unix domain socket连接的请求没有remote host，但socket文件只有本机进程能够访问，因此同样视为本机请求。
+     */
+    private fun isLocal(ctx: Context): Boolean {
+        return ctx.req.remoteHost in localhost || Request.getBaseRequest(ctx.req)?.httpChannel?.connector is UnixSocketConnector
+    }
+}
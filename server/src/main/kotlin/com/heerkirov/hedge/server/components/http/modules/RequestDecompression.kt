@@ -0,0 +1,74 @@
+package com.heerkirov.hedge.server.components.http.modules
+
+import io.javalin.core.JavalinConfig
+import org.eclipse.jetty.servlet.FilterHolder
+import java.io.InputStream
+import java.util.*
+import java.util.zip.GZIPInputStream
+import javax.servlet.*
+import javax.servlet.http.HttpServletRequest
+import javax.servlet.http.HttpServletRequestWrapper
+
+/**
+ * 解压客户端压缩过的request body。
+ * CLI在提交较大的body时会使用gzip压缩并设置Content-Encoding: gzip，此模块在servlet filter层透明地解压，使后续的handler不需要感知压缩。
+ * 客户端通过health API的requestEncodings得知server支持的编码。
+ */
+class RequestDecompression {
+    /**
+     * 给javalin添加解压的filter。
+     */
+    fun configure(javalinConfig: JavalinConfig) {
+        javalinConfig.configureServletContextHandler {
+            it.addFilter(FilterHolder(GzipRequestFilter()), "/*", EnumSet.of(DispatcherType.REQUEST))
+        }
+    }
+
+    companion object {
+        /**
+         * server支持的request body编码。
+         */
+        val encodings = listOf("gzip")
+    }
+
+    private class GzipRequestFilter : Filter {
+        override fun doFilter(request: ServletRequest, response: ServletResponse, chain: FilterChain) {
+            if(request is HttpServletRequest && request.getHeader("Content-Encoding").equals("gzip", ignoreCase = true)) {
+                chain.doFilter(GzipRequestWrapper(request), response)
+            }else{
+                chain.doFilter(request, response)
+            }
+        }
+    }
+
+    private class GzipRequestWrapper(request: HttpServletRequest) : HttpServletRequestWrapper(request) {
+        private val stream by lazy { GzipServletInputStream(GZIPInputStream(request.inputStream)) }
+
+        override fun getInputStream(): ServletInputStream = stream
+
+        //解压后的长度未知
+        override fun getContentLength(): Int = -1
+
+        override fun getContentLengthLong(): Long = -1
+
+        override fun getHeader(name: String): String? {
+            return if(name.equals("Content-Encoding", ignoreCase = true) || name.equals("Content-Length", ignoreCase = true)) null else super.getHeader(name)
+        }
+    }
+
+    private class GzipServletInputStream(private val input: InputStream) : ServletInputStream() {
+        private var finished = false
+
+        override fun read(): Int = input.read().also { if(it < 0) finished = true }
+
+        override fun read(b: ByteArray, off: Int, len: Int): Int = input.read(b, off, len).also { if(it < 0) finished = true }
+
+        override fun isFinished(): Boolean = finished
+
+        override fun isReady(): Boolean = true
+
+        override fun setReadListener(readListener: ReadListener?) = throw UnsupportedOperationException("Async read is not supported.")
+
+        override fun close() = input.close()
+    }
+}
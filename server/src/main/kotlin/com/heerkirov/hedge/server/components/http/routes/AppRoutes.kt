@@ -3,6 +3,7 @@ package com.heerkirov.hedge.server.components.http.routes
 import com.heerkirov.hedge.server.components.appdata.AppDataDriver
 import com.heerkirov.hedge.server.components.database.DataRepository
 import com.heerkirov.hedge.server.components.http.Endpoints
+import com.heerkirov.hedge.server.components.http.modules.RequestDecompression
 import com.heerkirov.hedge.server.components.lifetime.Lifetime
 import com.heerkirov.hedge.server.enums.LoadStatus
 import com.heerkirov.hedge.server.library.form.bodyAsForm
@@ -90,7 +91,7 @@ class AppRoutes(private val lifetime: Lifetime, private val appdata: AppDataDriv
 
     data class AddResponse(val id: String)
 
-    data class HealthResponse(val status: LoadStatus)
+    data class HealthResponse(val status: LoadStatus, val requestEncodings: List<String> = RequestDecompression.encodings)
 
     data class SignalResponse(val clients: Map<String, Long>, val standaloneSignal: Long?)
 }
\ No newline at end of file
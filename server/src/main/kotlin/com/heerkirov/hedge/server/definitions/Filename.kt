@@ -9,6 +9,7 @@ object Filename {
     const val FAVICON_ICO = "favicon.ico"
 
     const val SERVER_PID = "server.pid"
+    const val SERVER_SOCKET = "server.sock"
     const val DATA_DAT = "data.dat"
     const val PUBLIC_DAT = "public.dat"
 